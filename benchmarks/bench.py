@@ -0,0 +1,230 @@
+"""
+Benchmarks for the psynteract client's hot paths.
+
+All benchmarks run against the in-memory transport, so that they
+measure the client logic rather than the network, and yield results
+that are comparable between runs on the same machine. Results are
+written as JSON, and can be compared against those of a previous
+run (e.g. of an earlier version) via the --compare option:
+
+    python benchmarks/bench.py --output new.json --compare old.json
+"""
+
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+from datetime import datetime
+
+from psynteract import Connection, MemoryTransport, indirect_lookup
+
+def measure(f, repeat, setup=None):
+    # Time repeated calls of f, running the
+    # (untimed) setup function beforehand
+    timings = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        t1 = time.perf_counter()
+        f()
+        timings.append(time.perf_counter() - t1)
+
+    return summarize(timings)
+
+def summarize(timings):
+    repeat = len(timings)
+    timings = sorted(timings)
+    return {
+        'n': repeat,
+        'min': timings[0],
+        'median': timings[len(timings) // 2],
+        'mean': sum(timings) / repeat,
+        'max': timings[-1],
+    }
+
+def session(group_size, doc_size, replaced=0, transport=None):
+    # Create a running session with a single group of
+    # clients, each of which holds *doc_size* data points.
+    # Optionally, the first clients are replaced by
+    # those in the second half of the group.
+    transport = transport or MemoryTransport()
+    session_id = transport.open_session()
+    clients = [
+        Connection(transport=transport,
+            initial_data={'round': 0, 'values': list(range(doc_size))},
+            group_size=group_size)
+        for i in range(group_size)
+    ]
+    transport.start_session(session_id, group_size=group_size)
+
+    if replaced:
+        ids = [c._id for c in clients]
+        transport.update_session(session_id, replace={
+            ids[i]: ids[i + group_size // 2] for i in range(replaced)
+        })
+
+    return transport, clients
+
+def bench_push(group_size, doc_size, repeat, delta_push=False):
+    # Push a document after modifying a single field
+    transport, clients = session(group_size, doc_size)
+    c = clients[0]
+    c.delta_push = delta_push
+
+    def push():
+        c.data['round'] += 1
+        c.push()
+
+    return measure(push, repeat)
+
+def bench_get(group_size, doc_size, repeat, replacements=True):
+    transport, clients = session(group_size, doc_size,
+        replaced=group_size // 2 if replacements else 0)
+    c = clients[-1]
+    c.use_replacements = replacements
+    return measure(lambda: c.get(clients[0]._id), repeat)
+
+def bench_wait(group_size, doc_size, repeat, check='clients'):
+    # Wait for a condition that is already met, which
+    # measures the initial evaluation of all documents
+    transport, clients = session(group_size, doc_size)
+    c = clients[0]
+    condition = (lambda doc: doc['status'] == 'running') \
+        if check == 'session' else (lambda doc: doc['data']['round'] >= 0)
+    return measure(lambda: c.wait(condition, check=check), repeat)
+
+class FeedTransport(MemoryTransport):
+    # Signal whenever a changes feed has been opened
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.feed_opened = threading.Event()
+
+    def changes(self, *args, **kwargs):
+        feed = MemoryTransport.changes(self, *args, **kwargs)
+        self.feed_opened.set()
+        return feed
+
+def bench_wait_feed(group_size, doc_size, repeat):
+    # Wait for an update to a partner's document, which is pushed
+    # from a separate thread as soon as the client follows the feed.
+    # The time from the push until the wait returns is measured.
+    transport, clients = session(group_size, doc_size,
+        transport=FeedTransport())
+    c, partner = clients[0], clients[-1]
+    timings = []
+
+    for i in range(1, repeat + 1):
+        pushed = {}
+
+        def respond():
+            transport.feed_opened.wait()
+            partner.data['round'] = i
+            pushed['time'] = time.perf_counter()
+            partner.push()
+
+        transport.feed_opened.clear()
+        thread = threading.Thread(target=respond)
+        thread.daemon = True
+        thread.start()
+        c.wait(lambda doc: doc['data']['round'] >= i or
+            doc['_id'] != partner._id)
+        done = time.perf_counter()
+        thread.join()
+        timings.append(done - pushed['time'])
+
+    return summarize(timings)
+
+def bench_replacements(group_size, doc_size, repeat):
+    transport, clients = session(group_size, doc_size,
+        replaced=group_size // 2)
+    c = clients[0]
+    return measure(lambda: c.replacements, repeat)
+
+def bench_indirect_lookup(group_size, doc_size, repeat):
+    # Resolve the full replacement chain for every key
+    d = {i: i + 1 for i in range(min(group_size, 10))}
+    return measure(lambda: [indirect_lookup(d, k) for k in d], repeat)
+
+benchmarks = {
+    'push': bench_push,
+    'push_delta': lambda *a: bench_push(*a, delta_push=True),
+    'get': lambda *a: bench_get(*a, replacements=False),
+    'get_replacements': bench_get,
+    'wait_session': lambda *a: bench_wait(*a, check='session'),
+    'wait_clients': lambda *a: bench_wait(*a, check='clients'),
+    'wait_partners': lambda *a: bench_wait(*a, check='partners'),
+    'wait_feed': bench_wait_feed,
+    'replacements': bench_replacements,
+    'indirect_lookup': bench_indirect_lookup,
+}
+
+def run(names, group_sizes, doc_sizes, repeat):
+    results = []
+    for name in names:
+        for group_size in group_sizes:
+            for doc_size in doc_sizes:
+                result = benchmarks[name](group_size, doc_size, repeat)
+                result.update({
+                    'benchmark': name,
+                    'group_size': group_size,
+                    'doc_size': doc_size,
+                })
+                results.append(result)
+                print('{:<18} group {:>4} doc {:>6}: '
+                    'median {:.6f}s'.format(
+                    name, group_size, doc_size, result['median']))
+    return results
+
+def compare(results, baseline):
+    # Print the change in median timings relative to
+    # a previous run, for all benchmarks present in both
+    key = lambda r: (r['benchmark'], r['group_size'], r['doc_size'])
+    previous = {key(r): r for r in baseline['results']}
+
+    print('\nComparison with {}:'.format(baseline.get('label') or
+        baseline['date']))
+    for r in results:
+        if key(r) in previous:
+            ratio = r['median'] / previous[key(r)]['median']
+            print('{:<18} group {:>4} doc {:>6}: {:6.2f}x'.format(
+                *key(r) + (ratio,)))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('benchmarks', nargs='*', default=sorted(benchmarks),
+        help='benchmarks to run (default: all)')
+    parser.add_argument('--group-sizes', default='2,8,32',
+        help='comma-separated group sizes')
+    parser.add_argument('--doc-sizes', default='10,1000',
+        help='comma-separated numbers of data points per document')
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--label', help='label stored with the results')
+    parser.add_argument('--output', help='file to save the results to')
+    parser.add_argument('--compare', help='results of a previous run')
+    args = parser.parse_args()
+
+    results = run(args.benchmarks,
+        [int(s) for s in args.group_sizes.split(',')],
+        [int(s) for s in args.doc_sizes.split(',')],
+        args.repeat)
+
+    output = {
+        'label': args.label,
+        'date': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'results': results,
+    }
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -14,10 +14,38 @@
 
 from __future__ import division
 
-import requests
-import pycouchdb
-import json
 import random
+import copy
+import io
+import threading
+import time
+import uuid
+
+try:
+    from collections.abc import Iterable
+except ImportError:
+    # Python 2
+    from collections import Iterable
+
+from pycouchdb.exceptions import NotFound, Conflict
+
+from .feed import ChangeListener
+from .transport import CouchTransport, MemoryTransport, read_body
+from .patch import merge_patch
+from .conditions import Condition, field, as_condition
+from .cache import DocumentCache, _rev_number
+from .metrics import Metrics, InstrumentedTransport
+from . import grouping
+from .backend import install
+from . import liveness
+
+# Names available directly from the package, including
+# those of the submodules that are commonly needed
+__all__ = [
+    'Connection', 'ReplacementIndex', 'ConditionState', 'at_least',
+    'indirect_lookup', 'CouchTransport', 'MemoryTransport',
+    'Condition', 'field', 'DocumentCache', 'Metrics', 'install',
+]
 
 # Define a function required later
 def indirect_lookup(d, key, max_iterations=10):
@@ -41,25 +69,296 @@ def indirect_lookup(d, key, max_iterations=10):
     raise RuntimeError('Maximum search depth exceeded, '
       'check for circular replacements')
 
+class ReplacementIndex(object):
+    """
+    Resolve the replacements specified in a session document,
+    mapping each replaced client directly onto its final
+    replacement (*forward*), and each final replacement onto
+    the set of clients it stands in for (*inverse*).
+
+    The index is updated incrementally as the replacements
+    change, resolving only those chains that are affected.
+    """
+    def __init__(self, replacements={}, max_iterations=10):
+        self.max_iterations = max_iterations
+        self.raw = {}
+        self.forward = {}
+        self.inverse = {}
+        # Direct predecessors of every replacement
+        # in the raw replacement chains
+        self._predecessors = {}
+        self.update(replacements)
+
+    def __contains__(self, key):
+        return key in self.forward
+
+    def __getitem__(self, key):
+        return self.forward[key]
+
+    def __len__(self):
+        return len(self.forward)
+
+    def get(self, key, default=None):
+        return self.forward.get(key, default)
+
+    def replaced_by(self, key):
+        # Clients for which the given one stands in
+        return self.inverse.get(key, ())
+
+    def _ancestors(self, keys):
+        # Find all clients whose replacement chains
+        # pass through any of the given keys
+        found = set(keys)
+        pending = list(keys)
+        while pending:
+            for k in self._predecessors.get(pending.pop(), ()):
+                if k not in found:
+                    found.add(k)
+                    pending.append(k)
+        return found
+
+    def update(self, replacements):
+        # Adopt a new set of replacements, and return
+        # the clients whose final replacement has changed
+        changed = [k for k in set(self.raw) | set(replacements)
+            if self.raw.get(k) != replacements.get(k)]
+        if not changed:
+            return set()
+
+        # Chains that pass through modified entries need to be
+        # resolved anew, both under the old and the new mapping
+        affected = self._ancestors(changed)
+
+        for k in changed:
+            if k in self.raw:
+                self._predecessors[self.raw[k]].discard(k)
+            if k in replacements:
+                self._predecessors.setdefault(replacements[k], set()).add(k)
+        self.raw = dict(replacements)
+        affected |= self._ancestors(changed)
+
+        modified = set()
+        for k in affected:
+            old = self.forward.pop(k, None)
+            if old is not None:
+                self.inverse[old].discard(k)
+                if not self.inverse[old]:
+                    del self.inverse[old]
+
+            if k in self.raw:
+                new = indirect_lookup(self.raw, k, self.max_iterations)
+                self.forward[k] = new
+                self.inverse.setdefault(new, set()).add(k)
+            else:
+                new = None
+
+            if new != old:
+                modified.add(k)
+
+        return modified
+
+class at_least(object):
+    """
+    Aggregation function for *wait*, which is satisfied
+    once the condition holds for at least *k* documents.
+    """
+    def __init__(self, k):
+        self.k = k
+
+    def __call__(self, values):
+        return sum(1 for v in values if v) >= self.k
+
+class ConditionState(dict):
+    """
+    Map document ids onto the result of a condition,
+    keeping count of the documents that satisfy it.
+
+    For the built-in aggregations (*all*, *any* and
+    *at_least*), this allows *done* to decide whether
+    waiting is complete in constant time. Any other
+    aggregation function is applied to all values.
+    """
+    def __init__(self, aggregation_function=all, values={}):
+        dict.__init__(self)
+        self.aggregation_function = aggregation_function
+        self.satisfied = 0
+        for k, v in values.items():
+            self[k] = v
+
+    def __setitem__(self, key, value):
+        if key in self and dict.__getitem__(self, key):
+            self.satisfied -= 1
+        if value:
+            self.satisfied += 1
+        dict.__setitem__(self, key, value)
+
+    def done(self):
+        f = self.aggregation_function
+        if f is all:
+            return self.satisfied == len(self)
+        elif f is any:
+            return self.satisfied > 0
+        elif isinstance(f, at_least):
+            return self.satisfied >= f.k
+        else:
+            return f(self.values())
+
+# The following helpers determine the changes to follow while
+# waiting, and are shared by Connection and psynteract.aio
+
+def _watched_ids(ids, replacements, session, use_replacements):
+    # Determine the documents to follow when checking only
+    # partners: their own documents, or those of their
+    # replacements, and the session (for replacements)
+    watched = set(replacements.get(k, k) for k in ids)
+    if use_replacements:
+        watched.add(session)
+    return watched
+
+def _feed_filter(condition, check, watched, session, use_replacements):
+    # Compute the parameters (and, optionally, request body)
+    # that restrict the changes feed to relevant documents.
+    # (the type of each individual client doc is set to
+    # 'client', but the check argument value in this case
+    # is 'clients')
+    check_doc_type = 'session' if check == 'session' else 'client'
+
+    if isinstance(condition, Condition) and check != 'session':
+        # For declarative conditions, the server can select the
+        # relevant documents itself, so that only those documents
+        # that satisfy the condition are transferred. Note that,
+        # as a consequence, documents that cease to satisfy the
+        # condition are not reported.
+        if check == 'partners':
+            relevant = {'_id': {'$in': sorted(watched - {session})}}
+        else:
+            relevant = {'session': session, 'type': check_doc_type}
+        selector = {'$and': [relevant, condition.selector]}
+        if use_replacements:
+            selector = {'$or': [{'_id': session}, selector]}
+        return {'filter': '_selector'}, {'selector': selector}
+    elif check == 'partners':
+        # Follow only the relevant documents by their ids
+        return {'filter': '_doc_ids'}, {'doc_ids': sorted(watched)}
+    else:
+        return {
+            'filter': 'psynteract/clients',
+            'session': session,
+            'type': check_doc_type,
+            'include_session': use_replacements,
+        }, None
+
+# Sessions discovered by connections in this process, by database
+# (only used by connections that opt in via cache_session)
+_discovered_sessions = {}
+
 class Connection(object):
     def __init__(self,
         server_uri='http://server.example:5984', db_name='psynteract',
         client_name=None, design='stranger',
         replacements=True,
         group_size=2, groupings_needed=1, roles=None, ghosts=False,
-        group='default', initial_data={}, offline=False):
+        group='default', initial_data={}, offline=False,
+        session_cache='rev', listen=False, transport=None,
+        delta_push=False, doc_cache=128, metrics=None, pool=None,
+        session=None, cache_session=False, lazy=False,
+        startup_jitter=0, startup_retries=0, startup_backoff=0.5,
+        heartbeat_interval=None):
         # Set offline mode
         self.offline = offline
 
-        if server_uri == 'http://server.example:5984' and not self.offline:
+        # Local copy of the session document, which is consulted
+        # for groupings, roles and replacements. It is brought up
+        # to date at most once per trial (i.e. on the first lookup
+        # after every push, or at the outset of every wait), and
+        # with the session changes observed while waiting.
+        # Depending on the caching strategy, it is either
+        # revalidated against the server's current revision
+        # ('rev'), or updated with the session changes since it
+        # was last brought up to date ('feed'). Caching can be
+        # disabled entirely by passing a false value, in which
+        # case the session document is retrieved anew on every
+        # lookup.
+        if session_cache not in ('rev', 'feed', None, False):
+            raise ValueError('Unknown session cache strategy {}'.format(
+                session_cache))
+        self.session_cache = session_cache
+        self._session_doc = None
+        self._session_current = False
+        # Sequence number up to which the cached
+        # session is known to be current ('feed')
+        self._session_seq = None
+        self._listener = None
+
+        # Copy of the document state as last sent to the server,
+        # which is used to skip pushes if nothing has changed,
+        # and, if delta pushes are enabled, to send only the
+        # modified fields. The latter requires a backend version
+        # that provides the 'merge' update handler, which applies
+        # a JSON merge patch to the stored document; if it is
+        # missing, the full document is sent instead.
+        self.delta_push = delta_push
+        self._pushed = None
+
+        # Resolved replacements, and the session
+        # revision they were last updated from
+        self._replacements = ReplacementIndex()
+        self._replacements_rev = None
+
+        # Recently retrieved documents, up to the given number,
+        # which are revalidated by their revision when requested
+        # again, and replaced by more recent versions whenever
+        # these come in through the changes feed
+        self._doc_cache = DocumentCache(doc_cache or 0)
+
+        # Timings of all database operations, and the amount of
+        # data transferred (see psynteract.metrics). An instance
+        # can be shared between connections to aggregate them.
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        # Revisions of the documents holding the attachments
+        # stored by this client, by attachment name
+        self._attachment_revs = {}
+
+        # Latest sequence number observed through changes()
+        self.last_seq = None
+
+        # Pushes and heartbeats both update the document revision,
+        # and are thus serialized. Heartbeats are sent only if the
+        # document has not been written for *heartbeat_interval*
+        # seconds (see psynteract.liveness).
+        self._push_lock = threading.RLock()
+        self._last_write = None
+        self._heartbeat_interval = heartbeat_interval
+        self._heartbeat = None
+
+        # Whether the backend provides the 'merge' update handler
+        # (used by delta pushes and heartbeats), until shown otherwise
+        self._merge_available = True
+
+        if server_uri == 'http://server.example:5984' and \
+            transport is None and not self.offline:
             print('You are trying to connect to a server, but have not yet '
                 'replaced the default URL. Please specify the url of your '
                 'server or use the offline mode for the time being.')
 
         if not self.offline:
-            self.server = pycouchdb.Server(server_uri)
-            self.db = self.server.database(db_name)
-            self.session = self.latest_session
+            # Unless a different transport is specified,
+            # connect to a CouchDB server, through the
+            # given or the process-wide connection pool
+            self.transport = InstrumentedTransport(
+                transport or CouchTransport(server_uri, db_name,
+                    self.metrics, pool, check=not lazy),
+                self.metrics)
+
+            # The session can be specified directly, and is otherwise
+            # discovered on startup (see below), optionally reusing
+            # the session found by another connection to the same
+            # database within this process.
+            self.session = session
+            self._cache_session = cache_session
+            self._session_key = (server_uri, db_name) \
+                if transport is None else transport
             # TODO: Fail if db does not contain psynteract
             # design documents
         else:
@@ -83,6 +382,12 @@ class Connection(object):
 
         if offline:
             self.doc['_id'] = 'offline'
+        else:
+            # The document id is chosen up front rather than by the
+            # server, so that repeating the first push (e.g. after
+            # its response has timed out during startup) updates
+            # the same document instead of registering another client
+            self.doc['_id'] = uuid.uuid4().hex
 
         self.design = design
         self.group_size = group_size
@@ -90,13 +395,18 @@ class Connection(object):
         self.roles = roles
         self.use_replacements = replacements
 
-        # Show warning if roles are used in offline mode
-        if offline and roles:
-            print('Warning: You are using roles in offline mode. '
-                'This is tricky and may lead to complications. '
-                'To be on the safe side, we recommend simulating. '
-                'a complete lab environment or using dummies (if '
-                'you are using code to build the experiment).')
+        # In offline mode, the client is grouped with virtual
+        # partners, whose groupings and roles are computed
+        # locally in the same form as in the session document
+        # (see grouping.simulate)
+        if offline:
+            self._offline_session = grouping.simulate(self._id,
+                design=design, group_size=group_size,
+                groupings_needed=groupings_needed, roles=roles)
+
+            # Events and attachments are kept locally
+            self._offline_events = {}
+            self._offline_attachments = {}
 
         # Start with the first grouping
         self.current_grouping = 0
@@ -105,15 +415,123 @@ class Connection(object):
         if client_name:
             self.doc['name'] = client_name
 
-        # Push all data to the server
-        self.push()
+        # Register with the server, i.e. discover the session and
+        # push all data. In lazy mode, this happens in the background,
+        # so that the experiment can be set up in the meantime; all
+        # operations that depend on the registration wait for it to
+        # complete (see ready). Startup can be spread out by a random
+        # delay of up to *startup_jitter* seconds, and retried with
+        # exponential backoff if the server cannot be reached or no
+        # session has been opened yet.
+        self._startup = None
+        self._startup_error = None
+        startup = (listen, startup_jitter, startup_retries, startup_backoff)
+        if lazy and not self.offline:
+            self._startup = threading.Thread(target=self._run_startup,
+                args=startup, name='psynteract-startup')
+            self._startup.daemon = True
+            self._startup.start()
+        else:
+            self._start(*startup)
+
+    def _start(self, listen, jitter, retries, backoff):
+        if self.offline:
+            return
+
+        if jitter:
+            time.sleep(random.uniform(0, jitter))
+
+        for attempt in range(retries + 1):
+            try:
+                if self.session is None:
+                    self._discover_session()
+
+                # Push all data to the server
+                try:
+                    self._push()
+                except Conflict:
+                    # A previous attempt has been stored, but its
+                    # response was lost; continue from its revision
+                    self.doc['_rev'] = self.transport.rev(self._id)
+                    self._push()
+                break
+            except self.transport.transient_errors + (KeyError,):
+                if attempt == retries:
+                    raise
+                # Randomize the backoff, so that the retries
+                # of many clients do not coincide again
+                time.sleep(backoff * 2 ** attempt * random.uniform(0.5, 1.5))
+
+        # Optionally, follow all session updates in the background,
+        # so that waiting does not require any additional requests
+        if listen:
+            self._listener = ChangeListener(self)
+            self._listener.start()
+
+        if self._heartbeat_interval:
+            self._heartbeat = liveness.Heartbeat(self,
+                self._heartbeat_interval)
+            self._heartbeat.start()
+
+    def _run_startup(self, *args):
+        try:
+            self._start(*args)
+        except Exception as e:
+            # Raised by the next operation that waits for startup
+            self._startup_error = e
+
+    def _discover_session(self):
+        session = None
+        if self._cache_session and \
+            self._session_key in _discovered_sessions:
+            # Reuse the session discovered previously, unless it
+            # has since been closed (which requires only a single
+            # document to be retrieved, rather than a view query)
+            session = _discovered_sessions[self._session_key]
+            try:
+                if self.transport.get(session).get('status') == 'closed':
+                    session = None
+            except NotFound:
+                session = None
+
+        if session is None:
+            session = self.latest_session
+            if self._cache_session:
+                _discovered_sessions[self._session_key] = session
+
+        self.session = session
+        self.doc['session'] = self.session
+
+    def ready(self, timeout=None):
+        # Wait until the connection has registered with the server,
+        # and return whether it has done so within the timeout.
+        # Errors during (lazy) startup are raised at this point.
+        if self._startup is not None:
+            self._startup.join(timeout)
+            if self._startup.is_alive():
+                return False
+        if self._startup_error is not None:
+            raise self._startup_error
+        return True
+
+    def close(self):
+        # Stop following the changes feed
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+        # Stop sending heartbeats
+        if self._heartbeat is not None:
+            self._heartbeat.stop()
+            self._heartbeat = None
 
     @property
     def latest_session(self):
         # Query database to find open sessions,
         # be sure to reverse the order so that the most recent
         # ones appear on top
-        sessions = self.db.query('psynteract/open_sessions', descending='true')
+        sessions = self.transport.query('psynteract/open_sessions',
+            descending='true')
 
         # Select the most recent session and return its id
         try:
@@ -121,51 +539,112 @@ class Connection(object):
         except IndexError:
             raise KeyError('There is no open session available')
 
-    def push(self):
+    def push(self, force=False):
+        self.ready()
+        self._end_trial()
+        self._push(force)
+
+    def _push(self, force=False):
         if not self.offline:
-            # Compute the URL of the update handler,
-            # leaving out the document id if it is
-            # not yet set.
-            update_url = '_design/psynteract/_update/add_timestamp/{}'.format(
-                '' if self._id is None else self._id
-            )
-
-            # Perform a put request to the update handler,
-            # sending the new document data.
-            # (note that this bypasses the db abstraction layer)
-            response, result = self.db.resource.put(
-                update_url,
-                data=json.dumps(self.doc)
-                )
-
-            # One difficulty at this point is that some of the
-            # data are updated on the server. Specifically,
-            # the update handler adds a timestamp that reflects
-            # the current server time. In addition, the document
-            # id is generated when the document is first saved,
-            # and the revision hash is computed anew after each
-            # save. These need to be represented locally so that
-            # the document can be updated (put requests always
-            # need to send along the last revision id, and need
-            # the document id as a destination).
-            # At the moment, these data are extracted from http
-            # headers. We might at some point parse the response
-            # so that the timestamp is reflected in the local data,
-            # but I have decided against that for now.
-
-            # Update document id if not previously generated
-            if self._id is None:
-                self.doc['_id'] = response.headers['X-Couch-Id']
-
-            # Update document revision hash
-            self.doc['_rev'] = response.headers['X-Couch-Update-NewRev']
+            # Hold off the heartbeat while the document and its
+            # revision are updated (see heartbeat)
+            with self._push_lock:
+                # Take a snapshot of the document to send, so that
+                # any changes made while the request is underway
+                # (e.g. during lazy startup) are left for the next push
+                state = self._snapshot()
+
+                # Skip the request if the document has not been
+                # modified since it was last pushed (unless forced to,
+                # e.g. to update the server-side timestamp)
+                if state == self._pushed and not force:
+                    return
+
+                patch = None
+                if self.delta_push and self._merge_available and \
+                    self._pushed is not None:
+                    try:
+                        patch = merge_patch(self._pushed, state)
+                    except ValueError:
+                        # Fields that are set to None need
+                        # to be sent as part of the full document
+                        pass
+
+                _rev = None
+                if patch is not None:
+                    # Send only the changed fields
+                    try:
+                        _id, _rev = self.transport.update(
+                            'merge', patch, self._id)
+                    except NotFound:
+                        # The backend does not provide the merge handler
+                        print('The backend does not provide the merge '
+                            'update handler required for delta pushes, '
+                            'sending full documents instead.')
+                        self._merge_available = False
+
+                if _rev is None:
+                    # Send the new document data to the update handler,
+                    # along with the revision it replaces
+                    doc = dict(state)
+                    if self._rev is not None:
+                        doc['_rev'] = self._rev
+                    _id, _rev = self.transport.update(
+                        'add_timestamp', doc, self._id)
+
+                # One difficulty at this point is that some of the
+                # data are updated on the server. Specifically,
+                # the update handler adds a timestamp that reflects
+                # the current server time. In addition, the document
+                # id is generated when the document is first saved,
+                # and the revision hash is computed anew after each
+                # save. These need to be represented locally so that
+                # the document can be updated (put requests always
+                # need to send along the last revision id, and need
+                # the document id as a destination).
+                # At the moment, these data are extracted from http
+                # headers by the transport. We might at some point parse
+                # the response so that the timestamp is reflected in the
+                # local data, but I have decided against that for now.
+
+                # Adopt the document id in case the server has
+                # assigned a different one
+                if self._id != _id:
+                    self.doc['_id'] = _id
+
+                # Update document revision hash
+                self.doc['_rev'] = _rev
+
+                # Any cached copy of the document is now outdated
+                self._doc_cache.invalidate(self.doc['_id'])
+
+                # Remember the state now stored on the server
+                state['_id'] = self.doc['_id']
+                self._pushed = state
+                self._last_write = liveness._clock()
 
         else:
             pass
 
+    def _snapshot(self):
+        # Copy the document state, leaving out the revision, which
+        # is assigned by the server and never part of the local
+        # changes. If the data are modified by another thread while
+        # they are copied, copying is repeated.
+        while True:
+            try:
+                return copy.deepcopy(
+                    {k: v for k, v in self.doc.items() if k != '_rev'})
+            except RuntimeError:
+                pass
+
     def refresh(self):
+        self.ready()
         if not self.offline:
-            self.doc = self.db.get(self._id)
+            with self._push_lock:
+                self.doc = self._fetch(self._id)
+                self._pushed = copy.deepcopy(
+                    {k: v for k, v in self.doc.items() if k != '_rev'})
         else:
             pass
 
@@ -187,48 +666,312 @@ class Connection(object):
         except KeyError:
             return None
 
+    def _revalidate_session(self):
+        # Check whether the cached session document is still
+        # current by retrieving only its latest revision
+        # (for CouchDB, via a HEAD request), but no body.
+        return self.transport.rev(self.session) == self._session_doc['_rev']
+
+    def _update_session(self, doc):
+        # Store a more recent copy of the session document,
+        # as observed through the changes feed or a direct
+        # request. Outdated revisions are ignored.
+        if self.session_cache and (self._session_doc is None or
+            _rev_number(doc) >= _rev_number(self._session_doc)):
+            self._session_doc = doc
+
+    def _catch_up_session(self):
+        # Apply all session changes since the cached copy was
+        # last brought up to date, closing the feed right away
+        feed = self.transport.changes({
+                'feed': 'continuous',
+                'filter': '_doc_ids',
+                'since': self._session_seq,
+                'include_docs': 'true',
+                'timeout': 1,
+            }, body={'doc_ids': [self.session]})
+        try:
+            for change in feed:
+                if 'last_seq' in change:
+                    self._session_seq = change['last_seq']
+                    break
+                self._session_seq = change['seq']
+                self._update_session(change['doc'])
+        finally:
+            feed.close()
+
+    def _end_trial(self):
+        # Bring the session up to date again on the next lookup
+        self._session_current = False
+
+    def invalidate_session(self):
+        # Discard the cached session document, so that the
+        # next lookup retrieves it from the server.
+        self._session_doc = None
+
+    def get_session(self):
+        self.ready()
+
+        # If the session is being followed in the background,
+        # the local mirror is always current
+        if self._listener is not None:
+            self._wait_listener_ready()
+            return self._listener.docs[self.session]
+
+        if not self.session_cache:
+            return self.transport.get(self.session)
+
+        # Retrieve the session document, unless a cached copy
+        # is available, and has been (or can be) brought up
+        # to date during the current trial
+        if self._session_doc is None:
+            if self.session_cache == 'feed':
+                self._session_seq = self.transport.info()['update_seq']
+            self._session_doc = self.transport.get(self.session)
+        elif self._session_current:
+            pass
+        elif self.session_cache == 'feed':
+            self._catch_up_session()
+        elif not self._revalidate_session():
+            self._session_doc = self.transport.get(self.session)
+
+        self._session_current = True
+        return self._session_doc
+
     def get(self, doc, offline_dummy=[], check_replacements=True):
+        self.ready()
         if not self.offline:
-            if check_replacements:
+            if doc == self.session:
+                # The session document is never replaced, and is
+                # served from the cache if possible. A copy is
+                # returned so that the cache cannot be modified
+                # inadvertently.
+                return copy.deepcopy(self.get_session())
+            elif check_replacements:
                 # Lookup replacement documents
-                replacements = self.replacements
-                path = doc if doc not in replacements else replacements[doc]
+                path = self.replacement_index.get(doc, doc)
             else:
                 path = doc
 
             # Return the final path
-            return self.db.get(path)
+            return self._fetch(path)
         else:
             # Offline mode handling
-            import collections
             if isinstance(offline_dummy, dict):
                 return offline_dummy
-            elif isinstance(offline_dummy, collections.Iterable) and len(offline_dummy) is not 0:
+            elif isinstance(offline_dummy, Iterable) and len(offline_dummy) != 0:
                 return random.choice(offline_dummy)
             else:
                 return self.doc
 
+    def _fetch(self, _id):
+        # Retrieve a document, revalidating a cached copy
+        # (if there is one) against the server, so that an
+        # unchanged document is not transferred again.
+        # The cache only ever holds copies of the documents
+        # handed out, so that it cannot be modified inadvertently.
+        cached = self._doc_cache.get(_id)
+        if cached is None:
+            doc = self.transport.get(_id)
+        else:
+            doc = self.transport.get_if_modified(_id, cached['_rev'])
+            if doc is None:
+                return copy.deepcopy(cached)
+
+        self._doc_cache.put(copy.deepcopy(doc))
+        return doc
+
+    def _observe(self, change):
+        # Bring cached documents up to date
+        # with a change seen on the feed
+        if change['id'] not in self._doc_cache:
+            return
+        elif change.get('doc') is not None:
+            self._doc_cache.update(copy.deepcopy(change['doc']))
+        else:
+            self._doc_cache.invalidate(change['id'])
+
+    def get_many(self, docs, offline_dummy=[], check_replacements=True):
+        # Retrieve multiple documents with a single request,
+        # returning a dictionary of the requested ids onto
+        # the documents (or their replacements). Ids without
+        # a document, such as those of ghosts, are left out.
+        self.ready()
+        if self.offline:
+            return {d: self.get(d, offline_dummy) for d in docs}
+
+        # Resolve all replacements up front, so that every
+        # document is only requested once
+        replacements = self.replacement_index if check_replacements else {}
+        paths = {d: replacements.get(d, d) for d in docs}
+
+        fetched = self.transport.get_many(
+            set(p for p in paths.values() if p != self.session))
+        for _id, doc in fetched.items():
+            self._observe({'id': _id, 'doc': doc})
+        if self.session in paths.values():
+            fetched[self.session] = copy.deepcopy(self.get_session())
+
+        return {d: fetched[p] for d, p in paths.items() if p in fetched}
+
+    def _wait_listener_ready(self):
+        self._listener.ready.wait()
+        if self._listener.error is not None:
+            raise self._listener.error
+
+    def _mirrored_clients(self, partners=None):
+        # List the clients in the mirror that are relevant
+        # to a wait, i.e. all of them or only the partners
+        return [_id for _id, doc in self._listener.docs.items()
+            if doc['type'] == 'client' and
+                (partners is None or _id in partners)]
+
+    def _missing_replacements(self, partners=None):
+        # List the replacement documents that are not part of
+        # the mirror (because they stem from outside the session)
+        replacements = self.replacement_index
+        return set(replacements[_id]
+            for _id in self._mirrored_clients(partners)
+            if _id in replacements) - set(self._listener.docs)
+
+    def _check_mirror(self, condition, check, partners=None, external={}):
+        # Evaluate the condition against the documents
+        # mirrored by the background listener, and the
+        # replacement documents retrieved separately
+        docs = self._listener.docs
+
+        if check == 'session':
+            return { self.session: condition(docs[self.session]) }
+
+        replacements = self.replacement_index
+        condition_met = {}
+        for _id in self._mirrored_clients(partners):
+            if _id in replacements:
+                # Check the replacement document instead
+                doc = docs.get(replacements[_id]) or \
+                    external.get(replacements[_id])
+                # (which might not have been stored yet)
+                condition_met[_id] = doc is not None and condition(doc)
+            else:
+                condition_met[_id] = condition(docs[_id])
+
+        return condition_met
+
+    def _update_mirror_state(self, state, condition, check, partners, ids):
+        # Re-evaluate the condition only for the clients
+        # affected by changes to the given client documents
+        # (replacements are brought up to date whenever the
+        # session changes, see _wait_mirror)
+        docs = self._listener.docs
+        replacements = self._replacements
+        for _id in ids:
+            doc = docs[_id]
+            if doc['type'] != 'client':
+                continue
+
+            # A document stands for its own client (unless that
+            # has been replaced), and the clients it replaces
+            clients = set(replacements.replaced_by(_id))
+            if _id not in replacements:
+                clients.add(_id)
+
+            for k in clients:
+                # Clients that have newly joined are added
+                if k in state or \
+                    (check == 'clients' and k == _id) or \
+                    (partners is not None and k in partners):
+                    state[k] = condition(doc)
+
+    def _wait_mirror(self, condition, check, aggregation_function):
+        self._wait_listener_ready()
+        listener = self._listener
+
+        with listener.changed:
+            version = None
+            state = None
+            while True:
+                # Stop if the listener has failed
+                if listener.error is not None:
+                    raise listener.error
+
+                # Re-check the condition whenever the mirror
+                # has been updated, and sleep otherwise
+                if listener.version != version:
+                    ids = listener.changed_since(version) \
+                        if state is not None else None
+
+                    if ids is None or self.session in ids:
+                        # Evaluate all documents at the outset, and
+                        # whenever the session (and with it, partners
+                        # and replacements) might have changed
+                        partners = set(self.current_partners) \
+                            if check == 'partners' else None
+
+                        # Retrieve replacement documents from outside
+                        # the session without holding the lock, which
+                        # would block the listener in the meantime
+                        external = {}
+                        missing = self._missing_replacements(partners) \
+                            if check != 'session' else set()
+                        while missing - set(external):
+                            listener.changed.release()
+                            try:
+                                fetched = self.transport.get_many(
+                                    missing - set(external))
+                            finally:
+                                listener.changed.acquire()
+                            external.update({_id: fetched.get(_id)
+                                for _id in missing})
+                            partners = set(self.current_partners) \
+                                if check == 'partners' else None
+                            missing = self._missing_replacements(partners)
+
+                        state = ConditionState(aggregation_function,
+                            self._check_mirror(condition, check, partners,
+                                external))
+                    elif check != 'session':
+                        self._update_mirror_state(state, condition,
+                            check, partners, ids)
+
+                    version = listener.version
+                    if state.done():
+                        return
+                listener.changed.wait()
+
     def wait(self, condition=lambda doc: True,
         check='clients', aggregation_function=all,
         timeout=None, heartbeat=60):
+        self.ready()
 
-        # Store current replacement state
-        replacements = self.replacements
+        # Record the overall time spent waiting,
+        # including the time blocked on the feed
+        # (the session is brought up to date once at the outset,
+        # and kept current through the feed while waiting)
+        self._end_trial()
+        with self.metrics.timer('wait ' + check):
+            return self._wait(condition, check, aggregation_function,
+                timeout, heartbeat)
 
-        # Define the type of documents to check during
-        # updating (the type of each individual client
-        # doc is set to 'client', but the check argument
-        # value in this case is 'clients')
-        check_doc_type = 'session' if check == 'session' else 'client'
+    def _wait(self, condition, check, aggregation_function,
+        timeout, heartbeat):
+
+        # Declarative conditions may be given as strings
+        condition = as_condition(condition)
+
+        # Store current replacement state
+        replacements = self.replacement_index
 
         if self.offline:
             # Do not wait in offline mode, but return
             # directly instead.
             return
+        elif self._listener is not None:
+            # Check against the local mirror of the session
+            return self._wait_mirror(condition, check, aggregation_function)
         else:
             # Remember the latest state with regard to the database
             # (we will later check only updates from hereon)
-            last_seq = self.db.resource.get()[1]['update_seq']
+            last_seq = self.transport.info()['update_seq']
 
             # Prepopulate a dictionary of the relevant
             # documents' ids onto whether the specified
@@ -236,13 +979,22 @@ class Connection(object):
             # This process works slightly differently
             # depending on which documents are checked,
             # but the end result is always the same.
-            if check is 'session':
-                condition_met = {
-                    self.session: condition(self.db.get(self.session))
-                }
+            if check == 'session':
+                session = self.transport.get(self.session)
+                self._update_session(session)
+                condition_met = ConditionState(aggregation_function, {
+                    self.session: condition(session)
+                })
+            elif check == 'partners':
+                # Retrieve only the partners' documents (or those
+                # of their replacements), all in a single request
+                partner_docs = self.get_many(self.current_partners)
+                condition_met = ConditionState(aggregation_function, {
+                    _id: condition(doc) for _id, doc in partner_docs.items()
+                })
             else:
                 client_data = { doc['id']: doc['doc']
-                    for doc in self.db.query('psynteract/session_clients', \
+                    for doc in self.transport.query('psynteract/session_clients', \
                         key=self.session, type='client', include_docs='true') }
 
                 condition_met = {}
@@ -250,19 +1002,19 @@ class Connection(object):
                     # If the current document has not been replaced,
                     # check it directly. Otherwise, apply the condition
                     # function to the document's replacement
-                    if not _id in replacements.keys():
+                    if not _id in replacements:
                         condition_met[_id] = condition(doc)
                     else:
                         condition_met[_id] = condition(
-                            client_data[indirect_lookup(replacements, _id)]
+                            client_data[replacements[_id]]
                         )
 
-                # If checking group members only, filter dictionary
-                if check is 'partners':
-                    condition_met = {k: v for k, v in condition_met.items()\
-                        if k in self.current_partners}
+                # Keep track of the number of documents
+                # that satisfy the condition
+                condition_met = ConditionState(
+                    aggregation_function, condition_met)
 
-            if aggregation_function(condition_met.values()):
+            if condition_met.done():
                 # If all relevant documents test positive
                 # at this point, stop waiting.
                 return
@@ -271,95 +1023,395 @@ class Connection(object):
                 # to the database and updating the dictionary
                 # accordingly.
                 while True:
-                    r = self.db.resource.get(
-                        '_changes',
-                        params={
-                            'feed': 'continuous',
-                            'filter': 'psynteract/clients',
-                            'session': self.session,
-                            'type': check_doc_type,
-                            'include_session': self.use_replacements,
-                            'since': last_seq,
-                            'include_docs': 'true',
-                            'heartbeat': heartbeat * 1000,
-                            'timeout': timeout * 1000 if not timeout is None else None
-                        },
-                        stream=True,
-                        timeout=timeout if not timeout is None else None
+                    # Documents that are being followed
+                    # (for partners only, see below)
+                    watched = self._watched_ids(condition_met) \
+                        if check == 'partners' else None
+                    params, body = self._feed_filter(
+                        condition, check, watched)
+                    params.update({
+                        'feed': 'continuous',
+                        'since': last_seq,
+                        'include_docs': 'true',
+                        'heartbeat': heartbeat * 1000,
+                        'timeout': timeout * 1000 if not timeout is None else None
+                    })
+
+                    feed = self.transport.changes(params,
+                        timeout=timeout if not timeout is None else None,
+                        body=body
                     )
 
-                    for line in r[0].iter_lines(chunk_size=1):
-                        if line: # filter out keep-alive new lines
-                            change = json.loads(line.decode("utf-8"))
-                            if not 'last_seq' in change.keys():
-                                # An actual document update has been
-                                # posted, handle it.
-
-                                # First, note that the local state is a more
-                                # recent copy of the database
-                                last_seq = change['seq']
-
-                                # Update the condition state
-                                # (only if the document is actually relevant)
-                                if change['id'] in condition_met.keys():
-                                    # Update state directly
-                                    condition_met[change['id']] = \
+                    for change in feed:
+                        if not 'last_seq' in change.keys():
+                            # An actual document update has been
+                            # posted, handle it.
+
+                            # First, note that the local state is a more
+                            # recent copy of the database
+                            last_seq = change['seq']
+                            self._observe(change)
+                            self.metrics.event(
+                                change['id'] in condition_met or
+                                bool(replacements.replaced_by(change['id'])) or
+                                change['id'] == self.session)
+
+                            # Update the condition state
+                            # (only if the document is actually relevant)
+                            if change['id'] in condition_met and \
+                                change['id'] not in replacements:
+                                # Update state directly
+                                condition_met[change['id']] = \
+                                    condition(change['doc'])
+
+                            # Update the state of all documents
+                            # that the changed one replaces
+                            for k in replacements.replaced_by(change['id']):
+                                if k in condition_met:
+                                    condition_met[k] = \
                                         condition(change['doc'])
-                                elif change['id'] in replacements.values():
-                                    # Search for the documents that any given
-                                    # update updates, and update their state
-                                    for k, v in replacements:
-                                        if k in condition_met.keys() and\
-                                            change['id'] == v:
-                                            condition_met[k] = \
-                                                condition(change['doc'])
-
-                                # TODO: Potentially compute a set of relevant
-                                # docs for replacements or invert replacement
-                                # dictionary to reduce computation in the
-                                # second branch above. (it should be taken
-                                # relatively infrequently, so the practical
-                                # effect should be minimal)
-
-                                # If a session change comes in, replacements
-                                # might potentially have changed. In this case,
-                                # we need to re-check all replaced docs
-                                if change['doc']['type'] == 'session':
-                                    # Update state of replacements
-                                    replacements = change['doc']['replace']
-
-                                    # Load and re-check all replaced documents
-                                    for replaced_doc in replacements.keys():
-                                        # Only check documents that are being
-                                        # monitored anyway
-                                        if replaced_doc in condition_met.keys():
-                                            condition_met[replaced_doc] =\
-                                                condition(self.get(
-                                                    replacements[replaced_doc]
-                                                ))
-
-                                # Stop waiting if the condition is met
-                                # for all monitored clients
-                                if aggregation_function(condition_met.values()):
-                                    return
-                            else:
-                                # This does not seem to have been
-                                # a substantive document
-                                last_seq = change['last_seq']
+
+                            # If a session change comes in, replacements
+                            # might potentially have changed. In this case,
+                            # we need to re-check all replaced docs
+                            # (identified by id, so that the documents
+                            # of other changes need not be decoded)
+                            if change['id'] == self.session:
+                                # Keep the local session copy current
+                                self._update_session(change['doc'])
+
+                                # Update state of replacements, and
+                                # load and re-check the documents whose
+                                # replacement has changed (only those
+                                # that are being monitored anyway),
+                                # retrieving them in one go
+                                modified = self._update_replacements(
+                                    change['doc'])
+                                replaced_docs = self.get_many(
+                                    [k for k in modified
+                                        if k in condition_met])
+                                for replaced_doc, doc in replaced_docs.items():
+                                    condition_met[replaced_doc] = condition(doc)
+
+                            # Stop waiting if the condition is met
+                            # for all monitored clients
+                            if condition_met.done():
+                                feed.close()
+                                return
+
+                            # If the followed documents have changed
+                            # due to new replacements, subscribe anew
+                            if watched is not None and \
+                                self._watched_ids(condition_met) != watched:
+                                feed.close()
+                                break
+                        else:
+                            # This does not seem to have been
+                            # a substantive document
+                            last_seq = change['last_seq']
+
+    def changes(self, check='clients', since=None, condition=None,
+        heartbeat=60, include_docs=True, retry_interval=1):
+        # Iterate over the changes to the session's documents,
+        # as they happen. The documents to include are chosen
+        # as for wait, i.e. via the check argument, and optionally
+        # restricted further by a declarative condition.
+        # Changes are retrieved from the sequence number *since*
+        # onwards; if this is not specified, iteration resumes
+        # after the last change observed in a previous call,
+        # or, failing that, starts with the next change. The
+        # latest sequence number is available as *last_seq*.
+        # If the feed is interrupted, it is re-established
+        # transparently from the last sequence number seen,
+        # waiting increasingly longer (starting at about
+        # *retry_interval* seconds, and up to a minute) while
+        # reconnecting does not produce any changes.
+        if self.offline:
+            return
+
+        self.ready()
+        if condition is not None:
+            condition = as_condition(condition)
+
+        if since is not None:
+            self.last_seq = since
+        elif self.last_seq is None:
+            self.last_seq = self.transport.info()['update_seq']
+
+        failures = 0
+        while True:
+            feed = None
+            try:
+                watched = self._watched_ids(self.current_partners) \
+                    if check == 'partners' else None
+                params, body = self._feed_filter(condition, check, watched)
+                params.update({
+                    'feed': 'continuous',
+                    'since': self.last_seq,
+                    'include_docs': 'true' if include_docs else 'false',
+                    'heartbeat': heartbeat * 1000,
+                })
+
+                feed = self.transport.changes(params,
+                    # Allow for some delay beyond the heartbeat
+                    # interval before considering the feed stalled
+                    timeout=2 * heartbeat, body=body)
+
+                for change in feed:
+                    if 'last_seq' in change:
+                        # The server has ended the feed,
+                        # so we need to reconnect
+                        self.last_seq = change['last_seq']
+                        break
+                    else:
+                        failures = 0
+                        self.last_seq = change['seq']
+                        self._observe(change)
+                        self.metrics.event()
+                        yield change
+            except self.transport.transient_errors:
+                # Reconnect after network problems
+                pass
+            finally:
+                if feed is not None:
+                    feed.close()
+
+            # Back off before reconnecting, randomized so that
+            # the reconnects of many clients do not coincide
+            time.sleep(min(retry_interval * 2 ** failures, 60) *
+                random.uniform(0.5, 1.5))
+            failures += 1
+
+    def _watched_ids(self, ids):
+        return _watched_ids(ids, self.replacement_index,
+            self.session, self.use_replacements)
+
+    def _feed_filter(self, condition, check, watched):
+        return _feed_filter(condition, check, watched,
+            self.session, self.use_replacements)
+
+    @staticmethod
+    def event_id(client, round):
+        # Events are identified by client and round, so that
+        # they can be retrieved directly, and listed in order
+        # of rounds (via _all_docs) without requiring a view
+        return '{}:event:{:06d}'.format(client, round)
+
+    def push_event(self, round, data=None):
+        # Store the data of a single round (or trial) as a
+        # separate, immutable event document. In contrast to
+        # accumulating the data of all rounds in the client
+        # document, which is then sent anew on every push, the
+        # amount of data sent per round remains constant.
+        self.ready()
+
+        event = {
+            'type': 'event',
+            'session': self.session,
+            'client': self._id,
+            'round': round,
+            'data': data if data is not None else {},
+        }
+
+        if self.offline:
+            self._offline_events[round] = event
+        else:
+            self.transport.update('add_timestamp', event,
+                self.event_id(self._id, round))
+
+        return event
+
+    def _replacement_chain(self, client):
+        # List a client and all clients that successively
+        # replaced it, according to the session
+        chain = [client]
+        if not self.offline and self.use_replacements:
+            raw = self.replacement_index.raw
+            while chain[-1] in raw and len(chain) <= \
+                self._replacements.max_iterations:
+                chain.append(raw[chain[-1]])
+        return chain
+
+    def history(self, client=None):
+        # Retrieve the events of a client (by default, the
+        # current one) in the order of rounds. If the client
+        # has been replaced, the events of its replacements
+        # are merged in, taking precedence for every round
+        # in which both have stored an event.
+        self.ready()
+
+        if self.offline:
+            return [self._offline_events[r]
+                for r in sorted(self._offline_events)]
+
+        events = {}
+        for c in self._replacement_chain(client or self._id):
+            prefix = '{}:event:'.format(c)
+            for row in self.transport.all_docs(
+                startkey=prefix, endkey=prefix + u'\ufff0'):
+                events[row['doc']['round']] = row['doc']
+
+        return [events[r] for r in sorted(events)]
+
+    def wait_events(self, round, check='partners',
+        aggregation_function=all, timeout=None, heartbeat=60):
+        # Wait until the relevant clients (the current partners,
+        # or all clients in the session) have stored an event for
+        # the given round, and return the events by client id.
+        # (replacements are resolved once, at the outset)
+        self.ready()
+
+        if self.offline:
+            return {}
+
+        if check == 'partners':
+            clients = self.current_partners
+        else:
+            clients = [row['id'] for row in self.transport.query(
+                'psynteract/session_clients', key=self.session)]
+
+        # Map the event ids onto the clients they stand for
+        # (several, if clients share the same replacement)
+        replacements = self.replacement_index
+        ids = {}
+        for c in clients:
+            ids.setdefault(
+                self.event_id(replacements.get(c, c), round), set()).add(c)
+        events = {}
+        stored = ConditionState(aggregation_function,
+            {c: False for c in clients})
+
+        # Follow the event documents from the very beginning
+        # of the feed, which reports those that already exist
+        # right away, and any others as they are stored
+        feed = self.transport.changes({
+                'feed': 'continuous',
+                'filter': '_doc_ids',
+                'since': 0,
+                'include_docs': 'true',
+                'heartbeat': heartbeat * 1000,
+                'timeout': timeout * 1000 if timeout is not None else None,
+            },
+            timeout=timeout, body={'doc_ids': sorted(ids)})
+
+        try:
+            for change in feed:
+                if 'last_seq' in change:
+                    # The feed timed out
+                    break
+                self.metrics.event()
+                for client in ids[change['id']]:
+                    events[client] = change['doc']
+                    stored[client] = True
+                if stored.done():
+                    break
+        finally:
+            feed.close()
+
+        return events
+
+    @staticmethod
+    def attachment_id(client, name):
+        # Attachments are stored on documents of their own,
+        # so that the client document, and with it the changes
+        # feed, is not affected by them (feeds only ever carry
+        # attachment stubs, and the attachment documents are
+        # excluded by the session filters in any case)
+        return '{}:attachment:{}'.format(client, name)
+
+    def put_attachment(self, name, data,
+        content_type='application/octet-stream'):
+        # Store binary data as a named attachment. The data can
+        # be given as bytes, any object supporting the buffer
+        # protocol (e.g. a memoryview or a contiguous NumPy array),
+        # a file opened in binary mode, or an iterable of chunks,
+        # and are streamed to the server as they are, rather than
+        # encoded as JSON.
+        self.ready()
+
+        if self.offline:
+            self._offline_attachments[name] = read_body(data)
+            return
+
+        _id = self.attachment_id(self._id, name)
+        rev = self._attachment_revs.get(name)
+        if rev is None:
+            # The attachment may have been stored previously
+            # (e.g. before the experiment was restarted)
+            try:
+                rev = self.transport.rev(_id)
+            except NotFound:
+                pass
+
+        self._attachment_revs[name] = self.transport.put_attachment(
+            _id, 'data', data, content_type, rev)
+
+    def get_attachment(self, name, client=None, stream=False,
+        check_replacements=True):
+        # Retrieve an attachment stored by a client (by default,
+        # the current one), either in full as bytes, or as a file
+        # from which the data can be read as they arrive.
+        # Attachments are only ever transferred on request.
+        self.ready()
+
+        if self.offline:
+            data = self._offline_attachments[name]
+            return io.BytesIO(data) if stream else data
+
+        client = client or self._id
+        if check_replacements:
+            client = self.replacement_index.get(client, client)
+
+        return self.transport.get_attachment(
+            self.attachment_id(client, name), 'data', stream)
 
     def heartbeat(self):
-        pass
+        # Show the client to be alive by updating
+        # the server-side timestamp of its document
+        self.ready()
+        self._beat()
+
+    def _beat(self):
+        if self.offline:
+            return
+
+        with self._push_lock:
+            # Nothing to keep alive before the first push
+            if self._pushed is None:
+                return
+
+            _id, _rev = None, None
+            if self._merge_available:
+                # An empty patch leaves the data unchanged, so that
+                # only the timestamp and the revision are updated
+                try:
+                    _id, _rev = self.transport.update('merge', {}, self._id)
+                except NotFound:
+                    # The backend does not provide the merge handler
+                    self._merge_available = False
+
+            if _rev is None:
+                # Otherwise, the state last pushed is sent again
+                # (any local changes since are left to the next push)
+                _id, _rev = self.transport.update('add_timestamp',
+                    dict(self._pushed, _rev=self._rev), self._id)
+            self.doc['_rev'] = _rev
+            self._doc_cache.invalidate(_id)
+            self._last_write = liveness._clock()
+
+    def _assignment(self):
+        # Retrieve the groupings and roles, either from
+        # the session or, in offline mode, the simulation
+        return self._offline_session if self.offline \
+            else self.get_session()
 
     @property
     def current_partners(self):
-        if self.offline:
-            return [self._id] * (self.group_size - 1)
-        else:
-            # Using the current grouping state, extract the
-            # other clients assigned to the current connection
-            return self.get(self.session)['groupings']\
-                [self.current_grouping]\
-                [self._id]
+        # Using the current grouping state, extract the
+        # other clients assigned to the current connection
+        return self._assignment()['groupings']\
+            [self.current_grouping]\
+            [self._id]
 
     def get_role(self, player=None):
         # If no player is specified,
@@ -371,15 +1423,8 @@ class Connection(object):
         # return 'None' in any case.
         if self.roles == None:
             return None
-        elif self.offline:
-            # In offline mode, choose a role at random
-            print('You are in offline mode, in which you only interact with '
-                'yourself, but have specified multiple roles for the players. '
-                'This might lead to problems, please check the documentation '
-                'for methods of circumventing them.')
-            return random.sample(self.roles, 1)[0]
         else:
-            return self.get(self.session)['roles']\
+            return self._assignment()['roles']\
                 [self.current_grouping]\
                 [player]
 
@@ -389,67 +1434,60 @@ class Connection(object):
 
     @property
     def current_partner_roles(self):
-        if self.offline:
-            # In the offline mode, the client is partnered
-            # with itself, so the following will return a
-            # dictionary containing the client's own id,
-            # followed by the first role specified.
-            return dict(zip(
-                self.current_partners,
-                self.roles[1,]
-            ))
-        else:
-            # In the online mode, with full access to other clients,
-            # return a dictionary of ids mapping to roles
-            # for each of the current partners.
-            return {
-                partner: get_role(partner)
-                for partner in self.current_partners
-            }
+        # Return a dictionary of ids mapping to roles
+        # for each of the current partners (in offline
+        # mode, these are the simulated partners).
+        roles = self._assignment()['roles'][self.current_grouping]
+        return {
+            partner: roles[partner]
+            for partner in self.current_partners
+        }
+
+    @property
+    def current_partner_docs(self):
+        # Retrieve the documents of all current partners
+        # (or their replacements) at once
+        return self.get_many(self.current_partners)
 
     def reassign_grouping(self, allow_rollover=False):
         # Switch to the next grouping available, and
         # return the currently assigned partners.
-        if self.offline:
-            # Mappings never switch in offline mode
-            return self.current_partners
-        else:
-            self.current_grouping += 1
+        # (this applies to the simulated groupings
+        # in offline mode just the same)
+        self.current_grouping += 1
 
-            # If rollovers are permitted, start from the
-            # first grouping if the available groupings have
-            # already been exceeded.
-            if allow_rollover:
-                self.current_grouping = self.current_grouping % self.groupings
+        # If rollovers are permitted, start from the
+        # first grouping if the available groupings have
+        # already been exceeded.
+        if allow_rollover:
+            self.current_grouping = self.current_grouping % self.groupings
+        elif self.offline:
+            # Otherwise, the simulation stays with the last grouping
+            self.current_grouping = min(self.current_grouping,
+                len(self._offline_session['groupings']) - 1)
 
-            return self.current_partners
+        return self.current_partners
+
+    def _update_replacements(self, session):
+        # Bring the replacement index up to date with a
+        # session document, returning the clients whose
+        # replacement has changed
+        if self.offline or not self.use_replacements or \
+            session['_rev'] == self._replacements_rev:
+            return set()
+
+        self._replacements_rev = session['_rev']
+        return self._replacements.update(session['replace'])
+
+    @property
+    def replacement_index(self):
+        if not self.offline and self.use_replacements:
+            self._update_replacements(self.get_session())
+        return self._replacements
 
     @property
     def replacements(self):
-        if self.offline or not self.use_replacements:
-            # No replacements in this case
-            return {}
-        else:
-            # We won't check replacements here
-            # to avoid infinite recursion
-            r = self.get(self.session, check_replacements=False)['replace']
-
-            # Remove indirect replacements
-            r = {k: indirect_lookup(r, k) for k, v in r.items()}
-
-            return r
-
-def install(db_uri, create_db=True):
-    import os
-    print('Locating backend blob')
-    backend_path = os.path.join(
-        os.path.dirname(os.path.realpath(__file__)),
-        'backend.json'
-        )
-
-    print('Uploading backend')
-    requests.put(
-        db_uri + '/_design/psynteract',
-        data=open(backend_path).read()
-        )
-    return db_uri + '/_design/psynteract/index.html'
+        # Map replaced clients directly onto their
+        # final replacements (in offline mode or if
+        # replacements are disabled, this is empty)
+        return dict(self.replacement_index.forward)
@@ -0,0 +1,807 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Asynchronous client for psynteract, built on asyncio.
+
+The :class:`AsyncConnection` mirrors :class:`psynteract.Connection`,
+but all operations that require network access are coroutines, so
+that many clients can share a single event loop (and a single HTTP
+connection pool).
+
+As in the synchronous client, the database is accessed through a
+transport, whose operations are coroutines here. The
+:class:`AsyncCouchTransport` talks to a CouchDB server via aiohttp,
+and the :class:`AsyncMemoryTransport` exposes a
+:class:`psynteract.MemoryTransport`, so that asynchronous clients can
+be tested, and run alongside synchronous ones, without a server. This
+module requires Python 3, and aiohttp for the former.
+"""
+
+import asyncio
+import collections.abc
+import copy
+import json
+import random
+import threading
+
+import pycouchdb.exceptions
+
+from . import ReplacementIndex, ConditionState, MemoryTransport
+from . import _rev_number, _watched_ids, _feed_filter
+from . import codec
+from . import grouping
+from .cache import DocumentCache
+from .feed import ChangeReader
+from .conditions import as_condition
+from .metrics import Metrics
+
+def _encode_params(params):
+    # Drop unset parameters and convert the remaining
+    # ones into the string representation CouchDB expects
+    encoded = {}
+    for k, v in params.items():
+        if v is None:
+            continue
+        elif isinstance(v, bool):
+            encoded[k] = 'true' if v else 'false'
+        else:
+            encoded[k] = str(v)
+    return encoded
+
+def _encode_keys(params):
+    # View and document keys need to be JSON-encoded
+    params = dict(params)
+    for k in ('key', 'startkey', 'endkey'):
+        if k in params:
+            params[k] = json.dumps(params[k])
+    return params
+
+class AsyncChangesStream(object):
+    """
+    Iterate asynchronously over the changes
+    in a streamed aiohttp response.
+    """
+    def __init__(self, response):
+        self.response = response
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        reader = ChangeReader()
+        try:
+            async for chunk in self.response.content.iter_any():
+                for change in reader.feed(chunk):
+                    yield change
+        finally:
+            self.response.close()
+
+    def close(self):
+        self.response.close()
+
+class AsyncCouchTransport(object):
+    """
+    Asynchronous counterpart of :class:`psynteract.CouchTransport`.
+    Transports may share an aiohttp session, and with it a
+    connection pool; otherwise, each creates (and later closes)
+    its own.
+    """
+    def __init__(self, server_uri, db_name, http_session=None):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError('The asynchronous client requires aiohttp')
+        self._aiohttp = aiohttp
+
+        # Errors after which a changes feed can be re-established
+        self.transient_errors = (
+            aiohttp.ClientConnectionError,
+            aiohttp.ClientPayloadError,
+            asyncio.TimeoutError,
+        )
+
+        self.db_uri = '{}/{}/'.format(server_uri.rstrip('/'), db_name)
+        self.http = http_session
+        self._own_http = http_session is None
+
+    def _session(self):
+        # The session is created on first use,
+        # because this requires a running event loop
+        if self.http is None:
+            self.http = self._aiohttp.ClientSession(headers={
+                'Accept': 'application/json',
+                'Content-Type': 'application/json',
+            })
+        return self.http
+
+    async def close(self):
+        if self._own_http and self.http is not None:
+            await self.http.close()
+            self.http = None
+
+    def _raise_for_status(self, response, result):
+        # Raise the same errors as the synchronous transport
+        if response.status == 404:
+            raise pycouchdb.exceptions.NotFound(str(result))
+        elif response.status == 409:
+            raise pycouchdb.exceptions.Conflict(str(result))
+        elif response.status >= 400:
+            raise self._aiohttp.ClientResponseError(
+                response.request_info, response.history,
+                status=response.status, message=str(result),
+                headers=response.headers)
+
+    async def _request(self, method, path='', params=None, data=None,
+        headers=None):
+        # Perform a request relative to the database URL,
+        # and return the response status and headers
+        # alongside the decoded body
+        async with self._session().request(method, self.db_uri + path,
+            params=_encode_params(params or {}), data=data,
+            headers=headers) as response:
+            body = await response.text()
+            try:
+                result = codec.loads(body) if body else None
+            except ValueError:
+                # Update handlers may respond with plain text
+                result = body
+            self._raise_for_status(response, result)
+            return response.status, response.headers, result
+
+    async def info(self):
+        return (await self._request('GET'))[2]
+
+    async def get(self, _id):
+        return (await self._request('GET', _id))[2]
+
+    async def get_if_modified(self, _id, rev):
+        # See CouchTransport.get_if_modified
+        status, headers, result = await self._request('GET', _id,
+            headers={'If-None-Match': '"{}"'.format(rev)})
+        return None if status == 304 else result
+
+    async def get_many(self, ids):
+        status, headers, result = await self._request('POST', '_all_docs',
+            params={'include_docs': True},
+            data=codec.dumps({'keys': list(ids)}))
+        return { row['id']: row['doc']
+            for row in result['rows'] if row.get('doc') is not None }
+
+    async def rev(self, _id):
+        status, headers, result = await self._request('HEAD', _id)
+        return headers.get('ETag', '').strip('"')
+
+    async def query(self, name, **params):
+        design, view = name.split('/')
+        status, headers, result = await self._request('GET',
+            '_design/{}/_view/{}'.format(design, view),
+            params=_encode_keys(params))
+        return result['rows']
+
+    async def all_docs(self, **params):
+        status, headers, result = await self._request('GET', '_all_docs',
+            params=_encode_keys(params))
+        return result['rows']
+
+    async def update(self, handler, doc, _id=None):
+        # As in the synchronous transport, the update handler
+        # assigns the id and revision, which are retrieved
+        # from the response headers.
+        status, headers, result = await self._request('PUT',
+            '_design/psynteract/_update/{}/{}'.format(
+                handler, '' if _id is None else _id),
+            data=codec.dumps(doc))
+        return headers['X-Couch-Id'], headers['X-Couch-Update-NewRev']
+
+    async def changes(self, params, timeout=None, body=None):
+        # Open a changes feed, see CouchTransport.changes
+        kwargs = {
+            'params': _encode_params(params),
+            'timeout': self._aiohttp.ClientTimeout(total=None,
+                sock_read=timeout),
+        }
+        if body is not None:
+            kwargs['data'] = codec.dumps(body)
+        response = await self._session().request(
+            'GET' if body is None else 'POST',
+            self.db_uri + '_changes', **kwargs)
+        if response.status >= 400:
+            result = await response.text()
+            response.release()
+            self._raise_for_status(response, result)
+        return AsyncChangesStream(response)
+
+class ThreadedChangesStream(object):
+    """
+    Iterate asynchronously over a blocking changes feed, which
+    is read by a thread of its own (so that the event loop and
+    its executor are not blocked while waiting for changes).
+    """
+    def __init__(self, feed):
+        self.feed = feed
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue()
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+            except RuntimeError:
+                # The event loop has been closed
+                pass
+
+        def read():
+            try:
+                for change in self.feed:
+                    put((change, None))
+                put((None, None))
+            except Exception as e:
+                put((None, e))
+
+        thread = threading.Thread(target=read)
+        thread.daemon = True
+        thread.start()
+
+        try:
+            while True:
+                change, error = await queue.get()
+                if error is not None:
+                    raise error
+                elif change is None:
+                    return
+                yield change
+        finally:
+            self.feed.close()
+
+    def close(self):
+        self.feed.close()
+
+class AsyncMemoryTransport(object):
+    """
+    Expose a :class:`psynteract.MemoryTransport` (by default,
+    a new one) to asynchronous clients. The underlying transport
+    can be shared with synchronous clients.
+    """
+    def __init__(self, transport=None):
+        self.transport = transport if transport is not None \
+            else MemoryTransport()
+        self.transient_errors = self.transport.transient_errors
+
+    async def close(self):
+        pass
+
+    # All operations but the changes feed complete right away
+
+    async def info(self):
+        return self.transport.info()
+
+    async def get(self, _id):
+        return self.transport.get(_id)
+
+    async def get_if_modified(self, _id, rev):
+        return self.transport.get_if_modified(_id, rev)
+
+    async def get_many(self, ids):
+        return self.transport.get_many(ids)
+
+    async def rev(self, _id):
+        return self.transport.rev(_id)
+
+    async def query(self, name, **params):
+        return self.transport.query(name, **params)
+
+    async def all_docs(self, **params):
+        return self.transport.all_docs(**params)
+
+    async def update(self, handler, doc, _id=None):
+        return self.transport.update(handler, doc, _id)
+
+    async def changes(self, params, timeout=None, body=None):
+        return ThreadedChangesStream(
+            self.transport.changes(params, timeout, body))
+
+class AsyncInstrumentedTransport(object):
+    """
+    Wrap an asynchronous transport so that all operations are
+    timed and recorded in *metrics*, see InstrumentedTransport.
+    """
+    def __init__(self, transport, metrics):
+        self.transport = transport
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        # Pass on all other attributes, e.g. transient_errors
+        return getattr(self.transport, name)
+
+    async def info(self):
+        with self.metrics.timer('info'):
+            return await self.transport.info()
+
+    async def get(self, _id):
+        with self.metrics.timer('get'):
+            return await self.transport.get(_id)
+
+    async def get_if_modified(self, _id, rev):
+        with self.metrics.timer('get_if_modified'):
+            doc = await self.transport.get_if_modified(_id, rev)
+        if doc is None:
+            self.metrics.count('not_modified')
+        return doc
+
+    async def get_many(self, ids):
+        with self.metrics.timer('get_many'):
+            return await self.transport.get_many(ids)
+
+    async def rev(self, _id):
+        with self.metrics.timer('rev'):
+            return await self.transport.rev(_id)
+
+    async def query(self, name, **params):
+        with self.metrics.timer('query ' + name):
+            return await self.transport.query(name, **params)
+
+    async def all_docs(self, **params):
+        with self.metrics.timer('all_docs'):
+            return await self.transport.all_docs(**params)
+
+    async def update(self, handler, doc, _id=None):
+        with self.metrics.timer('update ' + handler):
+            return await self.transport.update(handler, doc, _id)
+
+    async def changes(self, params, timeout=None, body=None):
+        # Only the time to open the feed is recorded
+        with self.metrics.timer('changes'):
+            return await self.transport.changes(params, timeout, body)
+
+class AsyncConnection(object):
+    def __init__(self,
+        server_uri='http://server.example:5984', db_name='psynteract',
+        client_name=None, design='stranger',
+        replacements=True,
+        group_size=2, groupings_needed=1, roles=None, ghosts=False,
+        group='default', initial_data={}, offline=False,
+        session_cache='rev', http_session=None, transport=None,
+        doc_cache=128, metrics=None):
+        # The constructor only stores the settings; the
+        # connection is established by awaiting connect(),
+        # or by using the connection as a context manager:
+        #
+        #   async with AsyncConnection(...) as c:
+        #       await c.wait(...)
+        self.offline = offline
+
+        # Local copy of the session document, which is brought
+        # up to date at most once per trial, see Connection
+        if session_cache not in ('rev', 'feed', None, False):
+            raise ValueError('Unknown session cache strategy {}'.format(
+                session_cache))
+        self.session_cache = session_cache
+        self._session_doc = None
+        self._session_current = False
+        self._session_seq = None
+
+        self._replacements = ReplacementIndex()
+        self._replacements_rev = None
+
+        # Recently retrieved documents, and the timings
+        # of all database operations, as for Connection
+        self._doc_cache = DocumentCache(doc_cache or 0)
+        self.metrics = metrics if metrics is not None else Metrics()
+
+        if server_uri == 'http://server.example:5984' and \
+            transport is None and not self.offline:
+            print('You are trying to connect to a server, but have not yet '
+                'replaced the default URL. Please specify the url of your '
+                'server or use the offline mode for the time being.')
+
+        # Database access goes through an asynchronous transport,
+        # by default one for CouchDB (which may share an aiohttp
+        # session, and with it a connection pool, with others)
+        self.transport = None
+        self._own_transport = transport is None
+        if not self.offline:
+            if transport is None:
+                transport = AsyncCouchTransport(server_uri, db_name,
+                    http_session)
+            self.transport = AsyncInstrumentedTransport(
+                transport, self.metrics)
+
+        self.session = 'offline' if self.offline else None
+
+        self.doc = {
+            'data': initial_data,
+            'session': self.session,
+            'group': group,
+            'type': 'client',
+            'design': {
+                'type': design,
+                'group_size': group_size,
+                'groupings_needed': groupings_needed,
+                'roles': roles,
+                'ghosts': ghosts,
+                'replacements': replacements,
+                }
+            }
+
+        if offline:
+            self.doc['_id'] = 'offline'
+
+        self.design = design
+        self.group_size = group_size
+        self.groupings = groupings_needed
+        self.roles = roles
+        self.use_replacements = replacements
+
+        # In offline mode, the client is grouped with virtual
+        # partners, as for Connection (see grouping.simulate)
+        if offline:
+            self._offline_session = grouping.simulate(self._id,
+                design=design, group_size=group_size,
+                groupings_needed=groupings_needed, roles=roles)
+
+        self.current_grouping = 0
+
+        if client_name:
+            self.doc['name'] = client_name
+
+    async def connect(self):
+        # Find the current session and register the client
+        if not self.offline:
+            self.session = await self.latest_session()
+            self.doc['session'] = self.session
+
+        await self.push()
+        return self
+
+    async def close(self):
+        if self._own_transport and self.transport is not None:
+            await self.transport.close()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def latest_session(self):
+        sessions = await self.transport.query('psynteract/open_sessions',
+            descending='true')
+
+        try:
+            return sessions[0]['id']
+        except IndexError:
+            raise KeyError('There is no open session available')
+
+    async def push(self):
+        self._end_trial()
+        if not self.offline:
+            _id, _rev = await self.transport.update('add_timestamp',
+                self.doc, self._id)
+
+            if self._id != _id:
+                self.doc['_id'] = _id
+            self.doc['_rev'] = _rev
+            self._doc_cache.invalidate(_id)
+
+    async def refresh(self):
+        if not self.offline:
+            self.doc = await self.transport.get(self._id)
+
+    @property
+    def data(self):
+        return self.doc['data']
+
+    @property
+    def _id(self):
+        return self.doc.get('_id')
+
+    @property
+    def _rev(self):
+        return self.doc.get('_rev')
+
+    def _update_session(self, doc):
+        if self.session_cache and (self._session_doc is None or
+            _rev_number(doc) >= _rev_number(self._session_doc)):
+            self._session_doc = doc
+
+    def _end_trial(self):
+        # Bring the session up to date again on the next lookup
+        self._session_current = False
+
+    def invalidate_session(self):
+        self._session_doc = None
+
+    async def _revalidate_session(self):
+        return await self.transport.rev(self.session) == \
+            self._session_doc['_rev']
+
+    async def _catch_up_session(self):
+        # Apply all session changes since the cached
+        # copy was last brought up to date
+        feed = await self.transport.changes({
+                'feed': 'continuous',
+                'filter': '_doc_ids',
+                'since': self._session_seq,
+                'include_docs': 'true',
+                'timeout': 1,
+            }, body={'doc_ids': [self.session]})
+        try:
+            async for change in feed:
+                if 'last_seq' in change:
+                    self._session_seq = change['last_seq']
+                    break
+                self._session_seq = change['seq']
+                self._update_session(change['doc'])
+        finally:
+            feed.close()
+
+    async def get_session(self):
+        if not self.session_cache:
+            return await self.transport.get(self.session)
+
+        # See Connection.get_session
+        if self._session_doc is None:
+            if self.session_cache == 'feed':
+                self._session_seq = \
+                    (await self.transport.info())['update_seq']
+            self._session_doc = await self.transport.get(self.session)
+        elif self._session_current:
+            pass
+        elif self.session_cache == 'feed':
+            await self._catch_up_session()
+        elif not await self._revalidate_session():
+            self._session_doc = await self.transport.get(self.session)
+
+        self._session_current = True
+        return self._session_doc
+
+    def _update_replacements(self, session):
+        if self.offline or not self.use_replacements or \
+            session['_rev'] == self._replacements_rev:
+            return set()
+
+        self._replacements_rev = session['_rev']
+        return self._replacements.update(session['replace'])
+
+    async def replacement_index(self):
+        if not self.offline and self.use_replacements:
+            self._update_replacements(await self.get_session())
+        return self._replacements
+
+    async def replacements(self):
+        return dict((await self.replacement_index()).forward)
+
+    async def get(self, doc, offline_dummy=[], check_replacements=True):
+        if not self.offline:
+            if doc == self.session:
+                return copy.deepcopy(await self.get_session())
+            elif check_replacements:
+                path = (await self.replacement_index()).get(doc, doc)
+            else:
+                path = doc
+
+            return await self._fetch(path)
+        else:
+            if isinstance(offline_dummy, dict):
+                return offline_dummy
+            elif isinstance(offline_dummy, collections.abc.Iterable) and \
+                len(offline_dummy) != 0:
+                return random.choice(offline_dummy)
+            else:
+                return self.doc
+
+    async def _fetch(self, _id):
+        # Retrieve a document, revalidating a cached copy,
+        # see Connection._fetch
+        cached = self._doc_cache.get(_id)
+        if cached is None:
+            doc = await self.transport.get(_id)
+        else:
+            doc = await self.transport.get_if_modified(_id, cached['_rev'])
+            if doc is None:
+                return copy.deepcopy(cached)
+
+        self._doc_cache.put(copy.deepcopy(doc))
+        return doc
+
+    def _observe(self, change):
+        # Bring cached documents up to date
+        # with a change seen on the feed
+        if change['id'] not in self._doc_cache:
+            return
+        elif change.get('doc') is not None:
+            self._doc_cache.update(copy.deepcopy(change['doc']))
+        else:
+            self._doc_cache.invalidate(change['id'])
+
+    async def get_many(self, docs, offline_dummy=[], check_replacements=True):
+        # Retrieve multiple documents through a single request,
+        # see Connection.get_many
+        if self.offline:
+            return {d: await self.get(d, offline_dummy) for d in docs}
+
+        replacements = await self.replacement_index() \
+            if check_replacements else {}
+        paths = {d: replacements.get(d, d) for d in docs}
+
+        keys = set(p for p in paths.values() if p != self.session)
+        fetched = await self.transport.get_many(keys) if keys else {}
+        for _id, doc in fetched.items():
+            self._observe({'id': _id, 'doc': doc})
+        if self.session in paths.values():
+            fetched[self.session] = copy.deepcopy(await self.get_session())
+
+        return {d: fetched[p] for d, p in paths.items() if p in fetched}
+
+    async def wait(self, condition=lambda doc: True,
+        check='clients', aggregation_function=all,
+        timeout=None, heartbeat=60):
+        # See Connection.wait for a detailed description;
+        # the logic is identical, only the network access
+        # does not block the event loop.
+        if self.offline:
+            return
+
+        self._end_trial()
+        with self.metrics.timer('wait ' + check):
+            return await self._wait(condition, check, aggregation_function,
+                timeout, heartbeat)
+
+    async def _wait(self, condition, check, aggregation_function,
+        timeout, heartbeat):
+        condition = as_condition(condition)
+        replacements = await self.replacement_index()
+
+        last_seq = (await self.transport.info())['update_seq']
+
+        if check == 'session':
+            session = await self.transport.get(self.session)
+            self._update_session(session)
+            condition_met = ConditionState(aggregation_function,
+                { self.session: condition(session) })
+        elif check == 'partners':
+            # Retrieve only the partners' documents (or those
+            # of their replacements), all in a single request
+            partner_docs = await self.get_many(await self.current_partners())
+            condition_met = ConditionState(aggregation_function, {
+                _id: condition(doc) for _id, doc in partner_docs.items()
+            })
+        else:
+            client_data = { row['id']: row['doc']
+                for row in await self.transport.query(
+                    'psynteract/session_clients', key=self.session,
+                    type='client', include_docs='true') }
+
+            condition_met = {}
+            for _id, doc in client_data.items():
+                if _id not in replacements:
+                    condition_met[_id] = condition(doc)
+                else:
+                    condition_met[_id] = condition(
+                        client_data[replacements[_id]]
+                    )
+
+            condition_met = ConditionState(aggregation_function, condition_met)
+
+        if condition_met.done():
+            return
+
+        while True:
+            # Follow only the partners' documents if possible,
+            # subscribing anew whenever their replacements change
+            watched = _watched_ids(condition_met, replacements,
+                self.session, self.use_replacements) \
+                if check == 'partners' else None
+            params, body = _feed_filter(condition, check, watched,
+                self.session, self.use_replacements)
+            params.update({
+                'feed': 'continuous',
+                'since': last_seq,
+                'include_docs': 'true',
+                'heartbeat': heartbeat * 1000,
+                'timeout': timeout * 1000 if timeout is not None else None,
+            })
+
+            feed = await self.transport.changes(params, timeout=timeout,
+                body=body)
+            try:
+                async for change in feed:
+                    if 'last_seq' in change:
+                        last_seq = change['last_seq']
+                        continue
+
+                    last_seq = change['seq']
+                    self._observe(change)
+                    self.metrics.event(
+                        change['id'] in condition_met or
+                        bool(replacements.replaced_by(change['id'])) or
+                        change['id'] == self.session)
+
+                    if change['id'] in condition_met and \
+                        change['id'] not in replacements:
+                        condition_met[change['id']] = condition(change['doc'])
+
+                    for k in replacements.replaced_by(change['id']):
+                        if k in condition_met:
+                            condition_met[k] = condition(change['doc'])
+
+                    if change['id'] == self.session:
+                        self._update_session(change['doc'])
+
+                        # Re-check documents whose replacement has changed
+                        modified = self._update_replacements(change['doc'])
+                        replaced = await self.get_many([k for k in modified
+                            if k in condition_met])
+                        for k, doc in replaced.items():
+                            condition_met[k] = condition(doc)
+
+                    if condition_met.done():
+                        return
+
+                    if watched is not None and watched != _watched_ids(
+                        condition_met, replacements, self.session,
+                        self.use_replacements):
+                        break
+            finally:
+                feed.close()
+
+    async def _assignment(self):
+        # Retrieve the groupings and roles, either from
+        # the session or, in offline mode, the simulation
+        return self._offline_session if self.offline \
+            else await self.get_session()
+
+    async def current_partners(self):
+        return (await self._assignment())['groupings']\
+            [self.current_grouping]\
+            [self._id]
+
+    async def get_role(self, player=None):
+        if player is None:
+            player = self._id
+
+        if self.roles is None:
+            return None
+        else:
+            return (await self._assignment())['roles']\
+                [self.current_grouping]\
+                [player]
+
+    async def current_role(self):
+        return await self.get_role()
+
+    async def current_partner_roles(self):
+        partners = await self.current_partners()
+        roles = (await self._assignment())['roles'][self.current_grouping]
+        return {partner: roles[partner] for partner in partners}
+
+    async def current_partner_docs(self):
+        return await self.get_many(await self.current_partners())
+
+    async def reassign_grouping(self, allow_rollover=False):
+        # See Connection.reassign_grouping
+        self.current_grouping += 1
+
+        if allow_rollover:
+            self.current_grouping = self.current_grouping % self.groupings
+        elif self.offline:
+            self.current_grouping = min(self.current_grouping,
+                len(self._offline_session['groupings']) - 1)
+
+        return await self.current_partners()
@@ -0,0 +1,136 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Installation of the psynteract backend (i.e. the design document
+bundled as backend.json) into one or many databases.
+
+The installation is idempotent: the hash of the installed backend is
+recorded in a local (non-replicated) document, and a database whose
+backend is unchanged is skipped, so that its views are not rebuilt.
+Otherwise, the backend is streamed from disk, replacing the current
+revision of the design document. Multiple databases are installed
+concurrently where concurrent.futures is available (i.e. on Python 3,
+or with the futures backport), and one after another otherwise.
+"""
+
+import hashlib
+import os
+
+from .pool import default_pool
+
+backend_path = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)),
+    'backend.json'
+    )
+
+design_path = '/_design/psynteract'
+marker_path = '/_local/psynteract-backend'
+
+# Views that are queried when clients connect and wait,
+# and which can be built ahead of time
+views = ['open_sessions', 'session_clients']
+
+def file_hash(path, chunk_size=64 * 1024):
+    # Hash a file without reading it into memory at once
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _rev(session, uri):
+    # Retrieve the current revision of a document, if it exists
+    response = session.head(uri)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return response.headers['ETag'].strip('"')
+
+def _install(session, db_uri, digest, create_db, warm, force):
+    db_uri = db_uri.rstrip('/')
+
+    if create_db and session.head(db_uri).status_code == 404:
+        print('Creating database {}'.format(db_uri))
+        response = session.put(db_uri)
+        # Another installer may have been faster
+        if response.status_code != 412:
+            response.raise_for_status()
+
+    # Compare the backend against the one installed previously,
+    # which must also not have been modified in the meantime
+    rev = _rev(session, db_uri + design_path)
+    marker = session.get(db_uri + marker_path)
+    marker = marker.json() if marker.status_code == 200 else {}
+
+    if not force and rev is not None and \
+        marker.get('hash') == digest and marker.get('design_rev') == rev:
+        print('Backend in {} is up to date'.format(db_uri))
+    else:
+        print('Uploading backend to {}'.format(db_uri))
+        for attempt in range(2):
+            with open(backend_path, 'rb') as f:
+                response = session.put(db_uri + design_path,
+                    params={'rev': rev} if rev else None, data=f)
+            # If the design document was replaced concurrently,
+            # retry once with its new revision
+            if response.status_code != 409:
+                break
+            rev = _rev(session, db_uri + design_path)
+        response.raise_for_status()
+
+        marker.update({
+            'hash': digest,
+            'design_rev': response.json()['rev'],
+        })
+        session.put(db_uri + marker_path,
+            json=marker).raise_for_status()
+
+    if warm:
+        # Querying a view builds its index
+        for view in views:
+            session.get(db_uri + design_path + '/_view/' + view,
+                params={'limit': 0}).raise_for_status()
+
+    return db_uri + design_path + '/index.html'
+
+def install(db_uri, create_db=True, pool=None, warm=False, force=False,
+    max_workers=8):
+    """
+    Install the backend into the database at *db_uri*, or, given a
+    list of URIs, into all of them at once, and return the address(es)
+    of the experimenter's interface. The database is created if it does
+    not exist (and *create_db* is set). Unless *force* is set, databases
+    that already hold the current backend are left unchanged. If *warm*
+    is set, the view indices are built right away.
+    """
+    print('Locating backend blob')
+    digest = file_hash(backend_path)
+    pool = pool or default_pool()
+
+    # Every installation uses a session of its own (sessions are not
+    # thread-safe), all of which share the pool's connections
+    def install_one(uri):
+        return _install(pool.session(), uri, digest, create_db, warm, force)
+
+    if isinstance(db_uri, (list, tuple)):
+        try:
+            from concurrent.futures import ThreadPoolExecutor
+        except ImportError:
+            return [install_one(uri) for uri in db_uri]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(install_one, db_uri))
+    else:
+        return install_one(db_uri)
@@ -0,0 +1,277 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Simulate many psynteract clients within a single process.
+
+The :class:`Harness` connects a number of virtual clients ('bots')
+to a session, and runs them through a series of trials. In every
+trial, all bots start simultaneously, respond according to the
+behaviour assigned to their role, push their response, and wait
+until all other bots have responded as well. The harness records
+how long it takes for the last response to reach every bot, and
+summarizes these synchronization latencies per trial and overall.
+
+All bots share one HTTP connection pool, and (by default) a single
+changes feed, so that hundreds of participants can be simulated
+without hundreds of interpreters. Alternatively, the bots can share
+an asynchronous transport given to the harness, e.g. one based on a
+MemoryTransport, so that they run without a server. This module
+requires Python 3, and aiohttp for connecting to a server.
+"""
+
+import asyncio
+import math
+
+from . import ConditionState
+from .aio import AsyncConnection
+
+def respond():
+    # Default behaviour: respond immediately
+    async def behaviour(bot, trial):
+        pass
+    return behaviour
+
+def delay(seconds):
+    # Respond after a fixed delay, like the
+    # 'slacker' in the original benchmark
+    async def behaviour(bot, trial):
+        await asyncio.sleep(seconds)
+    return behaviour
+
+def summarize(values):
+    # Compute descriptive statistics for a list of latencies
+    values = sorted(values)
+    n = len(values)
+    if n == 0:
+        return {'n': 0}
+
+    def percentile(p):
+        return values[min(n - 1, int(math.ceil(p / 100 * n)) - 1)]
+
+    return {
+        'n': n,
+        'mean': sum(values) / n,
+        'min': values[0],
+        'median': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'max': values[-1],
+    }
+
+class SharedFeed(object):
+    """
+    Mirror the client documents of a session using a single
+    changes feed, and allow any number of bots to wait for
+    conditions on the mirror.
+
+    Bots that wait for the same condition (object) share its
+    state, which is evaluated once for all documents, and then
+    only for every changed document. The cost of a change thus
+    does not depend on the number of bots waiting.
+    """
+    def __init__(self, connection, heartbeat=60):
+        self.connection = connection
+        self.heartbeat = heartbeat
+        self.docs = {}
+        self._task = None
+        self._feed = None
+
+        # Conditions waited for, by condition and aggregation,
+        # with their states and the events that signal they are
+        # met (the states are discarded at that point, so that
+        # only conditions still pending need to be updated)
+        self._watches = {}
+        self._pending = {}
+
+    async def start(self):
+        c = self.connection
+        last_seq = (await c.transport.info())['update_seq']
+        for row in await c.transport.query('psynteract/session_clients',
+            key=c.session, type='client', include_docs='true'):
+            self.docs[row['id']] = row['doc']
+        self._task = asyncio.ensure_future(self._follow(last_seq))
+
+    async def _follow(self, last_seq):
+        c = self.connection
+        while True:
+            self._feed = await c.transport.changes({
+                    'feed': 'continuous',
+                    'filter': 'psynteract/clients',
+                    'session': c.session,
+                    'type': 'client',
+                    'since': last_seq,
+                    'include_docs': 'true',
+                    'heartbeat': self.heartbeat * 1000,
+                }, timeout=2 * self.heartbeat)
+            try:
+                async for change in self._feed:
+                    if 'last_seq' in change:
+                        last_seq = change['last_seq']
+                        continue
+                    last_seq = change['seq']
+                    self.docs[change['id']] = change['doc']
+                    self._update(change['id'], change['doc'])
+            finally:
+                self._feed.close()
+
+    def _update(self, _id, doc):
+        # Re-evaluate the pending conditions for a changed document
+        for key, state in list(self._pending.items()):
+            if _id in state:
+                state[_id] = key[0](doc)
+                if state.done():
+                    del self._pending[key]
+                    self._watches[key].set()
+
+    async def wait(self, condition, ids, aggregation_function=all):
+        # Wait until the condition holds for the documents
+        # with the given ids (which must already be mirrored,
+        # and be the same for all bots waiting on the condition)
+        key = (condition, aggregation_function)
+        if key not in self._watches:
+            state = ConditionState(aggregation_function,
+                {_id: condition(self.docs[_id]) for _id in ids})
+            self._watches[key] = asyncio.Event()
+            if state.done():
+                self._watches[key].set()
+            else:
+                self._pending[key] = state
+        await self._watches[key].wait()
+
+    async def stop(self):
+        if self._feed is not None:
+            self._feed.close()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+
+class Harness(object):
+    def __init__(self,
+        server_uri='http://localhost:5984', db_name='psynteract',
+        bots=4, roles=None, behaviours=None, trials=10,
+        shared_feed=True, wait_for_start=True, max_connections=100,
+        transport=None, **connection_options):
+        # Number of virtual clients, and their roles
+        # (which are also passed on to the session design)
+        self.server_uri = server_uri
+        self.db_name = db_name
+        self.bots = bots
+        self.roles = roles
+        self.trials = trials
+
+        # Behaviours are coroutine functions, indexed by role,
+        # that are called with the bot's connection and the
+        # trial number, and complete once the bot has 'responded'.
+        # The special key None applies to bots without a role.
+        self.behaviours = behaviours or {}
+
+        self.shared_feed = shared_feed
+        self.wait_for_start = wait_for_start
+        self.max_connections = max_connections
+
+        # Asynchronous transport shared by all bots (by default,
+        # every bot connects to the server through a common pool)
+        self.transport = transport
+        self.connection_options = connection_options
+
+        # Latencies per trial, in seconds, measured for each
+        # bot from the moment the last response was stored
+        # until the bot learned about it
+        self.latencies = []
+
+    def _behaviour(self, role):
+        return self.behaviours.get(role, self.behaviours.get(None, respond()))
+
+    async def _trial(self, bot, role, trial, feed, pushed, condition):
+        loop = asyncio.get_event_loop()
+
+        await self._behaviour(role)(bot, trial)
+
+        bot.data['round'] = trial
+        await bot.push()
+        pushed.append(loop.time())
+
+        if feed is not None:
+            await feed.wait(condition, self._ids)
+        else:
+            await bot.wait(condition)
+
+        return loop.time()
+
+    async def run(self):
+        if self.transport is not None:
+            return await self._run(transport=self.transport)
+
+        import aiohttp
+        connector = aiohttp.TCPConnector(limit=self.max_connections)
+        async with aiohttp.ClientSession(connector=connector, headers={
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        }) as http:
+            return await self._run(http_session=http)
+
+    async def _run(self, **options):
+        # Connect all bots concurrently
+        options.update(self.connection_options)
+        bots = [AsyncConnection(self.server_uri, self.db_name,
+                initial_data={'round': -1}, roles=self.roles,
+                group_size=self.bots,
+                client_name='bot {}'.format(i), **options)
+            for i in range(self.bots)]
+        await asyncio.gather(*[b.connect() for b in bots])
+
+        if self.wait_for_start:
+            await bots[0].wait(
+                lambda session: session['status'] == 'running',
+                check='session')
+
+        roles = await asyncio.gather(*[b.current_role() for b in bots])
+        self._ids = [b._id for b in bots]
+
+        feed = None
+        if self.shared_feed:
+            feed = SharedFeed(bots[0])
+            await feed.start()
+
+        try:
+            for trial in range(self.trials):
+                pushed = []
+                # All bots wait for the same condition,
+                # which the shared feed evaluates once
+                condition = lambda doc, trial=trial: \
+                    doc['data'].get('round', -1) >= trial
+                received = await asyncio.gather(*[
+                    self._trial(b, r, trial, feed, pushed, condition)
+                    for b, r in zip(bots, roles)])
+                self.latencies.append([t - max(pushed) for t in received])
+        finally:
+            if feed is not None:
+                await feed.stop()
+
+        return self.report()
+
+    def report(self):
+        return {
+            'bots': self.bots,
+            'trials': [summarize(l) for l in self.latencies],
+            'overall': summarize([t for l in self.latencies for t in l]),
+        }
+
+    def run_sync(self):
+        # Convenience wrapper for use outside of coroutines
+        return asyncio.run(self.run())
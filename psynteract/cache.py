@@ -0,0 +1,75 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import OrderedDict
+
+def _rev_number(doc):
+    # Extract the numeric prefix of a document's
+    # revision hash, which counts its updates
+    return int(doc['_rev'].split('-', 1)[0])
+
+class DocumentCache(object):
+    """
+    Keep the most recently used documents, by id, up to a
+    maximum number of *size* entries. Each entry carries its
+    revision, against which the document can be revalidated.
+    The cache is thread-safe, so that it can be updated from
+    changes observed in the background.
+    """
+    def __init__(self, size=128):
+        self.size = size
+        self._docs = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, _id):
+        return _id in self._docs
+
+    def get(self, _id):
+        with self._lock:
+            doc = self._docs.pop(_id, None)
+            if doc is not None:
+                # Mark as most recently used
+                self._docs[_id] = doc
+            return doc
+
+    def put(self, doc):
+        if self.size <= 0:
+            return
+
+        with self._lock:
+            self._docs.pop(doc['_id'], None)
+            self._docs[doc['_id']] = doc
+
+            # Evict the least recently used entries
+            while len(self._docs) > self.size:
+                self._docs.popitem(last=False)
+
+    def update(self, doc):
+        # Replace a cached document with a more recent
+        # revision, if the document is cached at all
+        with self._lock:
+            cached = self._docs.get(doc['_id'])
+            if cached is not None and _rev_number(doc) >= _rev_number(cached):
+                self._docs[doc['_id']] = doc
+
+    def invalidate(self, _id=None):
+        with self._lock:
+            if _id is None:
+                self._docs.clear()
+            else:
+                self._docs.pop(_id, None)
@@ -0,0 +1,178 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+JSON encoding and decoding of documents.
+
+By default, the fastest available JSON library is used: orjson or
+ujson if either is installed, and the standard library's json module
+otherwise. A specific library can be selected via *use*, and further
+ones added via *register*. Encoded documents are always bytes (UTF-8),
+and both bytes and text can be decoded. Other modules call
+``codec.dumps`` and ``codec.loads`` through the module, so that
+they always use the codec currently selected.
+
+Changes feed events are decoded lazily (see :class:`Change`), so that
+documents that are never looked at are never decoded in full.
+"""
+
+import json
+
+_codecs = {}
+_preference = ['orjson', 'ujson', 'json']
+
+def register(name, dumps, loads):
+    # Add a codec, given a function that encodes an object
+    # as UTF-8 bytes, and one that decodes bytes or text.
+    # Decoding errors must be raised as ValueErrors.
+    _codecs[name] = (dumps, loads)
+
+def _json_loads(data):
+    if isinstance(data, bytes):
+        data = data.decode('utf-8')
+    return json.loads(data)
+
+register('json',
+    lambda obj: json.dumps(obj).encode('utf-8'),
+    _json_loads)
+
+try:
+    import orjson
+    register('orjson',
+        # Like the standard library, accept non-string keys
+        lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+        orjson.loads)
+except ImportError:
+    pass
+
+try:
+    import ujson
+    register('ujson',
+        lambda obj: ujson.dumps(obj, ensure_ascii=False).encode('utf-8'),
+        ujson.loads)
+except ImportError:
+    pass
+
+def available():
+    return [name for name in _preference if name in _codecs] + \
+        sorted(set(_codecs) - set(_preference))
+
+def use(name=None):
+    # Select the codec used throughout psynteract,
+    # or, if no name is given, the fastest one available
+    global name_in_use, dumps, loads
+    if name is None:
+        name = available()[0]
+    elif name not in _codecs:
+        raise ValueError('JSON codec {} is not available'.format(name))
+    name_in_use = name
+    dumps, loads = _codecs[name]
+
+use()
+
+# CouchDB lists the document last among the fields of a change,
+# so that the remainder of the line can be set aside undecoded.
+# (the sequence cannot occur within a string, where quotes are
+# escaped, and the fields that precede it contain no objects)
+_doc_field = b',"doc":'
+
+class Change(dict):
+    """
+    A change from the changes feed, whose document is only
+    decoded when it is first accessed. Until then, the 'doc'
+    key is reported as present, but its value is held as the
+    undecoded remainder of the line. Copies (and pickles) of
+    a change are plain dictionaries.
+    """
+    def __init__(self, fields, line=None, offset=None):
+        dict.__init__(self, fields)
+        self._line = line
+        self._offset = offset
+
+    def _decode(self):
+        if self._line is None:
+            return
+        line, offset = self._line, self._offset
+        self._line = None
+        try:
+            dict.__setitem__(self, 'doc', loads(line[offset:-1]))
+        except ValueError:
+            # Fields following the document after all,
+            # which are recovered along with it
+            dict.update(self, loads(line))
+
+    @property
+    def decoded(self):
+        return self._line is None
+
+    def __missing__(self, key):
+        if key == 'doc' and self._line is not None:
+            self._decode()
+            return dict.__getitem__(self, 'doc')
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return (key == 'doc' and self._line is not None) or \
+            dict.__contains__(self, key)
+
+    def has_key(self, key):
+        return key in self
+
+    def get(self, key, default=None):
+        if key == 'doc':
+            self._decode()
+        return dict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        if key == 'doc':
+            self._line = None
+        dict.__setitem__(self, key, value)
+
+    def __reduce_ex__(self, protocol):
+        self._decode()
+        return (dict, (dict.copy(self),))
+
+    def __reduce__(self):
+        return self.__reduce_ex__(2)
+
+def _decoding(name):
+    # Wrap a dict method so that the document is
+    # decoded before all contents are accessed
+    method = getattr(dict, name)
+    def wrapper(self, *args, **kwargs):
+        self._decode()
+        return method(self, *args, **kwargs)
+    wrapper.__name__ = name
+    return wrapper
+
+for _name in ['__iter__', '__len__', '__eq__', '__ne__', '__repr__',
+    '__delitem__', 'keys', 'values', 'items', 'copy', 'pop', 'popitem',
+    'setdefault', 'update', 'clear',
+    'iterkeys', 'itervalues', 'iteritems', 'viewkeys', 'viewvalues',
+    'viewitems']:
+    if hasattr(dict, _name):
+        setattr(Change, _name, _decoding(_name))
+
+def decode_change(line):
+    # Decode a line of the changes feed,
+    # deferring the decoding of the document
+    offset = line.find(_doc_field)
+    if offset == -1 or not line.endswith(b'}'):
+        return loads(line)
+
+    try:
+        fields = loads(line[:offset] + b'}')
+    except ValueError:
+        return loads(line)
+    return Change(fields, line, offset + len(_doc_field))
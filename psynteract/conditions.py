@@ -0,0 +1,188 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Declarative conditions for *wait*.
+
+Instead of an opaque function, a condition can be expressed as a
+comparison of a document field, e.g. ``field('data.round') >= 3``,
+or the equivalent string ``'data.round >= 3'``. Such conditions are
+translated into a CouchDB (Mango) selector, which is evaluated
+locally as well as on the server, so that the changes feed only
+carries documents that satisfy the condition.
+"""
+
+import json
+import re
+
+try:
+    _string_types = basestring
+except NameError:
+    _string_types = str
+
+_missing = object()
+
+def _lookup(doc, path):
+    # Retrieve a (dotted) field path from a document
+    for key in path.split('.'):
+        if not isinstance(doc, dict) or key not in doc:
+            return _missing
+        doc = doc[key]
+    return doc
+
+def _compare(operator, value, argument):
+    if operator == '$exists':
+        return (value is not _missing) == argument
+    elif value is _missing:
+        return False
+    elif operator == '$eq':
+        return value == argument
+    elif operator == '$ne':
+        return value != argument
+    elif operator == '$in':
+        return value in argument
+    elif operator == '$nin':
+        return value not in argument
+
+    # Ordering comparisons only apply to
+    # values of compatible types
+    try:
+        if operator == '$lt':
+            return value < argument
+        elif operator == '$lte':
+            return value <= argument
+        elif operator == '$gt':
+            return value > argument
+        elif operator == '$gte':
+            return value >= argument
+    except TypeError:
+        return False
+
+    raise ValueError('Unsupported operator {}'.format(operator))
+
+def match(selector, doc):
+    """
+    Check whether a document matches a Mango *selector*.
+    Supported are the combination operators $and, $or
+    and $not, as well as the conditions $eq, $ne, $lt,
+    $lte, $gt, $gte, $in, $nin and $exists.
+    """
+    for key, argument in selector.items():
+        if key == '$and':
+            if not all(match(s, doc) for s in argument):
+                return False
+        elif key == '$or':
+            if not any(match(s, doc) for s in argument):
+                return False
+        elif key == '$not':
+            if match(argument, doc):
+                return False
+        else:
+            value = _lookup(doc, key)
+            if isinstance(argument, dict) and argument and \
+                all(k.startswith('$') for k in argument):
+                if not all(_compare(op, value, arg)
+                    for op, arg in argument.items()):
+                    return False
+            elif not _compare('$eq', value, argument):
+                return False
+    return True
+
+class Condition(object):
+    """
+    A condition on a document, represented by a
+    selector. Conditions can be combined using the
+    & (and), | (or) and ~ (not) operators.
+    """
+    def __init__(self, selector):
+        self.selector = selector
+
+    def __call__(self, doc):
+        return match(self.selector, doc)
+
+    def __and__(self, other):
+        return Condition({'$and': [self.selector, other.selector]})
+
+    def __or__(self, other):
+        return Condition({'$or': [self.selector, other.selector]})
+
+    def __invert__(self):
+        return Condition({'$not': self.selector})
+
+    def __repr__(self):
+        return 'Condition({})'.format(json.dumps(self.selector))
+
+class field(object):
+    """
+    Refer to a document field by its (dotted) path,
+    e.g. field('data.round'), and compare it to a
+    value to obtain a condition.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def _condition(self, operator, value):
+        return Condition({self.path: {operator: value}})
+
+    def __eq__(self, value):
+        return self._condition('$eq', value)
+
+    def __ne__(self, value):
+        return self._condition('$ne', value)
+
+    def __lt__(self, value):
+        return self._condition('$lt', value)
+
+    def __le__(self, value):
+        return self._condition('$lte', value)
+
+    def __gt__(self, value):
+        return self._condition('$gt', value)
+
+    def __ge__(self, value):
+        return self._condition('$gte', value)
+
+    def isin(self, values):
+        return self._condition('$in', list(values))
+
+    def exists(self, exists=True):
+        return self._condition('$exists', exists)
+
+_operators = {
+    '==': '$eq', '!=': '$ne',
+    '<': '$lt', '<=': '$lte',
+    '>': '$gt', '>=': '$gte',
+}
+
+_expression = re.compile(r'^\s*([\w.]+)\s*(==|!=|<=|>=|<|>)\s*(.+?)\s*$')
+
+def parse(expression):
+    """
+    Translate a string such as 'data.round >= 3' into a
+    condition. The value on the right-hand side is read
+    as JSON, so strings need to be enclosed in double
+    quotes (e.g. 'status == "running"').
+    """
+    m = _expression.match(expression)
+    if m is None:
+        raise ValueError('Could not parse condition {}'.format(expression))
+    path, operator, value = m.groups()
+    return Condition({path: {_operators[operator]: json.loads(value)}})
+
+def as_condition(condition):
+    # Accept conditions given as strings,
+    # leaving all others untouched
+    if isinstance(condition, _string_types):
+        return parse(condition)
+    return condition
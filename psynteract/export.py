@@ -0,0 +1,242 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Export the data collected in a session.
+
+The client documents of a session are retrieved page by page through
+the session_clients view, and flattened into one row per client, with
+a column for every (nested) field of its data, e.g. 'data.round'.
+Alternatively, one row is produced per event stored by a client (see
+Connection.push_event). Rows are written as they arrive, so that the
+memory required does not depend on the size of the session.
+
+Supported formats are CSV, newline-delimited JSON and, if pyarrow is
+installed, Parquet. Because CSV and Parquet require all columns to be
+known in advance, the documents are read twice for these formats,
+unless the columns are specified. For example::
+
+    from psynteract import export
+    export.export('http://localhost:5984', 'psynteract',
+        'results.csv', session='...')
+
+Exports do not register as a client, so that they can safely run
+while a session is in progress.
+"""
+
+import csv
+import json
+
+from . import codec
+from .transport import CouchTransport
+
+def latest_session(transport):
+    rows = transport.query('psynteract/open_sessions',
+        descending='true', limit=1)
+    if not rows:
+        raise KeyError('There is no open session available')
+    return rows[0]['id']
+
+def documents(transport, session, page_size=100):
+    # Iterate over the client documents of a session,
+    # retrieving them in pages of the given size, each
+    # starting after the last document of the previous
+    last = None
+    while True:
+        params = {
+            'startkey': session,
+            'endkey': session,
+            'include_docs': 'true',
+            'limit': page_size,
+        }
+        if last is not None:
+            params.update(startkey_docid=last, skip=1)
+
+        rows = transport.query('psynteract/session_clients', **params)
+        for row in rows:
+            yield row['doc']
+
+        if len(rows) < page_size:
+            return
+        last = rows[-1]['id']
+
+def client_events(transport, client, page_size=100):
+    # Iterate over the events of a client in the order of rounds
+    # (i.e. of their ids), retrieving them in pages as above
+    prefix = '{}:event:'.format(client)
+    startkey = prefix
+    while True:
+        params = {
+            'startkey': startkey,
+            'endkey': prefix + u'\ufff0',
+            'include_docs': 'true',
+            'limit': page_size,
+        }
+        if startkey != prefix:
+            params['skip'] = 1
+
+        rows = transport.all_docs(**params)
+        for row in rows:
+            yield row['doc']
+
+        if len(rows) < page_size:
+            return
+        startkey = rows[-1]['id']
+
+def flatten(value, prefix=''):
+    # Map nested dictionaries onto a single level,
+    # joining the keys of each path with dots
+    if not isinstance(value, dict):
+        return {prefix: value}
+
+    flat = {}
+    for key, v in value.items():
+        flat.update(flatten(v, '{}.{}'.format(prefix, key) if prefix else key))
+    return flat
+
+def _client_fields(doc):
+    return {
+        'client': doc['_id'],
+        'name': doc.get('name'),
+        'group': doc.get('group'),
+    }
+
+def rows(transport, session=None, page_size=100, events=False):
+    """
+    Iterate over the rows of a session export: one per client or,
+    if *events* is set, one per event, in the order of rounds.
+    """
+    if session is None:
+        session = latest_session(transport)
+
+    for doc in documents(transport, session, page_size):
+        if not events:
+            row = _client_fields(doc)
+            row['updated'] = doc.get('updated')
+            row.update(flatten({'data': doc.get('data', {})}))
+            yield row
+        else:
+            for event in client_events(transport, doc['_id'], page_size):
+                row = _client_fields(doc)
+                row['round'] = event['round']
+                row['updated'] = event.get('updated')
+                row.update(flatten({'data': event.get('data', {})}))
+                yield row
+
+def columns(rows):
+    # Collect all columns in the order of their first
+    # appearance, together with the types of their values
+    types = {}
+    for row in rows:
+        for column, value in row.items():
+            if value is not None:
+                types.setdefault(column, set()).add(type(value))
+            else:
+                types.setdefault(column, set())
+    return types
+
+def _cell(value):
+    # Values that do not fit into a single cell
+    # (i.e. lists) are stored as JSON
+    if isinstance(value, (list, tuple)):
+        return json.dumps(value)
+    return value
+
+def to_csv(rows, f, fieldnames):
+    writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+    writer.writeheader()
+    for row in rows:
+        writer.writerow({k: _cell(v) for k, v in row.items()})
+
+def to_ndjson(rows, f):
+    # Write to a file opened in binary mode
+    for row in rows:
+        f.write(codec.dumps(row))
+        f.write(b'\n')
+
+def _arrow_type(pa, types):
+    types = set(types)
+    if types <= {bool}:
+        return pa.bool_()
+    elif types <= {int}:
+        return pa.int64()
+    elif types <= {int, float}:
+        return pa.float64()
+    else:
+        return pa.string()
+
+def to_parquet(rows, path, types, batch_size=1000):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError('Exporting to Parquet requires pyarrow')
+
+    schema = pa.schema([(c, _arrow_type(pa, t)) for c, t in types.items()])
+    strings = [c for c, t in types.items()
+        if _arrow_type(pa, t) == pa.string()]
+
+    def write(writer, batch):
+        for row in batch:
+            # Columns of mixed or complex types are stored as text
+            for c in strings:
+                if row.get(c) is not None and not isinstance(row[c], str):
+                    row[c] = json.dumps(row[c])
+        writer.write_table(pa.Table.from_pylist(batch, schema=schema))
+
+    with pq.ParquetWriter(path, schema) as writer:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= batch_size:
+                write(writer, batch)
+                batch = []
+        if batch:
+            write(writer, batch)
+
+formats = {
+    '.csv': 'csv',
+    '.ndjson': 'ndjson',
+    '.jsonl': 'ndjson',
+    '.parquet': 'parquet',
+}
+
+def export(server_uri, db_name, path, session=None, format=None,
+    page_size=100, events=False, fields=None, transport=None):
+    """
+    Export the clients (or events) of a *session* (by default,
+    the latest open one) to the file at *path*, in a format
+    given by its extension unless specified. For CSV, the
+    columns can be given as *fields* to avoid a second pass.
+    """
+    transport = transport or CouchTransport(server_uri, db_name)
+    if session is None:
+        session = latest_session(transport)
+    if format is None:
+        format = next((f for ext, f in formats.items()
+            if path.endswith(ext)), 'csv')
+
+    def read():
+        return rows(transport, session, page_size, events)
+
+    if format == 'ndjson':
+        with open(path, 'wb') as f:
+            to_ndjson(read(), f)
+    elif format == 'csv':
+        with open(path, 'w', newline='') as f:
+            to_csv(read(), f, fields or list(columns(read())))
+    elif format == 'parquet':
+        to_parquet(read(), path, columns(read()))
+    else:
+        raise ValueError('Unknown export format {}'.format(format))
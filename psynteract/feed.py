@@ -0,0 +1,231 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+from collections import deque
+
+from . import codec
+
+class ChangeReader(object):
+    """
+    Incrementally decode a continuous CouchDB changes feed.
+
+    Raw chunks of the HTTP response are passed to *feed*,
+    which returns the changes contained in all lines that
+    have been completed so far. Partial lines are kept in
+    a buffer until the remainder arrives, and empty lines
+    (which CouchDB sends as keep-alive heartbeats) are
+    skipped. The documents contained in the changes are
+    only decoded once they are accessed.
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        # Position up to which the buffer has already been
+        # searched for line breaks, so that long documents
+        # arriving in many chunks are not scanned repeatedly
+        self._scanned = 0
+        self.heartbeats = 0
+
+    def feed(self, chunk):
+        self.buffer.extend(chunk)
+        changes = []
+        start = 0
+
+        while True:
+            end = self.buffer.find(b'\n', self._scanned)
+            if end == -1:
+                break
+
+            line = bytes(self.buffer[start:end]).strip()
+            start = self._scanned = end + 1
+
+            if line:
+                changes.append(codec.decode_change(line))
+            else:
+                # Heartbeat newline, which only signals
+                # that the connection is still alive
+                self.heartbeats += 1
+
+        # Discard all completed lines from the buffer,
+        # the remainder contains no further line breaks
+        if start:
+            del self.buffer[:start]
+        self._scanned = len(self.buffer)
+
+        return changes
+
+def read_changes(response, chunk_size=64 * 1024, on_read=None):
+    """
+    Iterate over the changes in a streamed continuous
+    changes feed *response*, reading the body in large
+    chunks. Because CouchDB sends every change as a separate
+    HTTP chunk, each change is still available as soon as
+    its line is complete, rather than once *chunk_size*
+    bytes have accumulated. If given, *on_read* is called
+    with the size of every chunk received.
+    """
+    reader = ChangeReader()
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        if on_read is not None:
+            on_read(len(chunk))
+        for change in reader.feed(chunk):
+            yield change
+
+class ChangeListener(threading.Thread):
+    """
+    Maintain a local mirror of a session's documents
+    by following the changes feed in the background.
+
+    The listener loads the session and client documents
+    once, and then keeps a single continuous changes
+    request open, reconnecting from the last observed
+    sequence number if it is interrupted. Every update
+    to the mirror increments *version* and notifies all
+    threads waiting on the *changed* condition, which
+    can find out the documents that have been updated
+    through *changed_since*.
+    """
+    def __init__(self, connection, heartbeat=60, retry_interval=1,
+        log_size=1000):
+        threading.Thread.__init__(self, name='psynteract-listener')
+        self.daemon = True
+
+        self.connection = connection
+        self.heartbeat = heartbeat
+        self.retry_interval = retry_interval
+
+        # Mirror of the session and client documents, by id
+        self.docs = {}
+        self.version = 0
+        self.changed = threading.Condition()
+
+        # Ids of the most recently updated documents, with the
+        # versions at which they were updated, and the version
+        # from which on the log is complete
+        self._log = deque(maxlen=log_size)
+        self._log_start = 0
+
+        self.ready = threading.Event()
+        self.error = None
+        self._stopped = threading.Event()
+        self._feed = None
+
+    def _load(self):
+        transport = self.connection.transport
+        session = self.connection.session
+
+        # Note the database state before loading the documents,
+        # so that no update is missed in between
+        last_seq = transport.info()['update_seq']
+
+        docs = { row['id']: row['doc']
+            for row in transport.query('psynteract/session_clients',
+                key=session, type='client', include_docs='true') }
+        docs[session] = transport.get(session)
+
+        with self.changed:
+            self.docs.update(docs)
+            self.version += 1
+            self._log_start = self.version
+            self.changed.notify_all()
+
+        return last_seq
+
+    def _apply(self, doc):
+        self.connection._observe({'id': doc['_id'], 'doc': doc})
+        with self.changed:
+            self.docs[doc['_id']] = doc
+            self.version += 1
+            if len(self._log) == self._log.maxlen:
+                self._log_start = self._log[0][0]
+            self._log.append((self.version, doc['_id']))
+            self.changed.notify_all()
+
+    def changed_since(self, version):
+        # Return the ids of the documents updated after the given
+        # version, or None if these are no longer known (to be
+        # called while holding the *changed* condition)
+        if version is None or version < self._log_start:
+            return None
+        ids = set()
+        for v, _id in reversed(self._log):
+            if v <= version:
+                break
+            ids.add(_id)
+        return ids
+
+    def _fail(self, error):
+        # Store the error so that waiting threads can raise it
+        self.error = error
+        with self.changed:
+            self.changed.notify_all()
+
+    def run(self):
+        try:
+            last_seq = self._load()
+        except Exception as e:
+            # Without an initial state, the mirror is useless
+            self._fail(e)
+            return
+        finally:
+            self.ready.set()
+
+        while not self._stopped.is_set():
+            try:
+                feed = self.connection.transport.changes({
+                        'feed': 'continuous',
+                        'filter': 'psynteract/clients',
+                        'session': self.connection.session,
+                        'type': 'client',
+                        'include_session': 'true',
+                        'since': last_seq,
+                        'include_docs': 'true',
+                        'heartbeat': self.heartbeat * 1000,
+                    },
+                    # Allow for some delay beyond the heartbeat
+                    # interval before considering the feed stalled
+                    timeout=2 * self.heartbeat
+                )
+                self._feed = feed
+
+                for change in feed:
+                    if 'last_seq' in change:
+                        last_seq = change['last_seq']
+                    else:
+                        last_seq = change['seq']
+
+                        # Skip revisions already in the mirror (e.g.
+                        # after reconnecting), without decoding them
+                        current = self.docs.get(change['id'])
+                        unchanged = current is not None and \
+                            current['_rev'] == change['changes'][0]['rev']
+                        self.connection.metrics.event(not unchanged)
+                        if not unchanged:
+                            self._apply(change['doc'])
+            except self.connection.transport.transient_errors:
+                # The feed was interrupted due to network
+                # problems, reconnect after a short pause
+                self._stopped.wait(self.retry_interval)
+            except Exception as e:
+                # Closing the feed (when the listener is stopped)
+                # may interrupt it with arbitrary errors, all others
+                # are not expected to go away by reconnecting
+                if not self._stopped.is_set():
+                    self._fail(e)
+                return
+
+    def stop(self):
+        self._stopped.set()
+        if self._feed is not None:
+            self._feed.close()
@@ -0,0 +1,382 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Local assignment of clients to groups and roles.
+
+*assign* computes the 'groupings' and 'roles' of a session document,
+i.e. one dictionary per grouping that maps every client onto the
+list of its partners, and one that maps every client onto its role.
+This allows the offline mode to simulate complete groups, and
+designs to be precomputed and checked (see *quality*) without
+a server.
+
+Clients are distributed across one pool per position in the group
+(and role, if roles are specified), and every group draws one client
+from each pool. Clients thus retain their role across groupings.
+The designs differ in how the pools are combined:
+
+- 'partner': the same groups in every grouping
+- 'stranger': groups are drawn at random for every grouping
+- 'perfect_stranger': no two clients are grouped together
+  more than once. The pools are shifted against each other by
+  construction (using the arithmetic of finite fields, or by
+  rotation) where this is possible, and otherwise, groups are
+  drawn at random from the clients that have not yet met, within
+  a limited number of attempts.
+
+If the number of clients is not a multiple of the group size, the
+remaining places can be filled with ghosts, placeholder clients whose
+ids start with 'ghost_'. Ghosts are added to the last pools, and thus
+take the last position in their groups; if there are more ghosts than
+clients per position, they fill the preceding positions as well.
+"""
+
+import random
+from collections import Counter
+
+designs = ('partner', 'stranger', 'perfect_stranger')
+
+def _pools(clients, group_size, ghosts, rng):
+    # Shuffle the clients and divide them into
+    # one pool per position in the group
+    clients = list(clients)
+    rng.shuffle(clients)
+
+    remainder = len(clients) % group_size
+    if remainder:
+        if not ghosts:
+            raise ValueError('{} clients cannot be divided into groups '
+                'of {} without ghosts'.format(len(clients), group_size))
+        clients += ['ghost_{}'.format(i + 1)
+            for i in range(group_size - remainder)]
+
+    m = len(clients) // group_size
+    return [clients[r * m:(r + 1) * m] for r in range(group_size)]
+
+def _groups(pools, design, rng):
+    # Combine the pools into the groups of a single grouping
+    if design == 'partner':
+        return zip(*pools)
+    else:
+        # The first pool keeps its order, the others are shuffled
+        shuffled = [pools[0]]
+        for pool in pools[1:]:
+            pool = list(pool)
+            rng.shuffle(pool)
+            shuffled.append(pool)
+        return zip(*shuffled)
+
+def _gcd(a, b):
+    while b:
+        a, b = b, a % b
+    return a
+
+def _factorize(n):
+    # Decompose n into prime powers, as (prime, exponent) pairs
+    factors = []
+    p = 2
+    while n > 1:
+        e = 0
+        while n % p == 0:
+            n //= p
+            e += 1
+        if e:
+            factors.append((p, e))
+        p += 1
+    return factors
+
+def _digits(x, p, e):
+    # Coefficients of the polynomial represented by x (lowest first)
+    return [(x // p ** i) % p for i in range(e)]
+
+def _number(digits, p):
+    return sum(d * p ** i for i, d in enumerate(digits))
+
+def _remainder(a, f, p):
+    # Divide the polynomial a by the monic polynomial f,
+    # with coefficients modulo p, and return the remainder
+    a = list(a)
+    while len(a) >= len(f):
+        c = a.pop()
+        shift = len(a) - len(f) + 1
+        for i, x in enumerate(f[:-1]):
+            a[shift + i] = (a[shift + i] - c * x) % p
+    return a
+
+def _irreducible(p, e):
+    # Find a monic polynomial of degree e that cannot be
+    # factored over the integers modulo p, by trial division
+    for x in range(p ** e):
+        f = _digits(x, p, e) + [1]
+        if all(any(_remainder(f, _digits(y, p, d) + [1], p))
+            for d in range(1, e // 2 + 1) for y in range(p ** d)):
+            return f
+
+class _Field(object):
+    # Arithmetic in the finite field with p**e elements, which are
+    # represented by the integers below p**e (the digits of which,
+    # in base p, are the coefficients of a polynomial modulo f)
+    def __init__(self, p, e):
+        self.p, self.e = p, e
+        self.size = p ** e
+        self.f = _irreducible(p, e)
+
+    def add(self, a, b):
+        return _number([(x + y) % self.p for x, y in zip(
+            _digits(a, self.p, self.e), _digits(b, self.p, self.e))], self.p)
+
+    def multiply(self, a, b):
+        product = [0] * (2 * self.e - 1)
+        for i, x in enumerate(_digits(a, self.p, self.e)):
+            for j, y in enumerate(_digits(b, self.p, self.e)):
+                product[i + j] = (product[i + j] + x * y) % self.p
+        return _number(_remainder(product, self.f, self.p), self.p)
+
+def _field_rotation(pools, groupings_needed):
+    # Number the positions within the pools by the elements of a
+    # product of finite fields (one per prime power dividing the
+    # pool size), and shift every pool r by k * r in grouping k.
+    # Two clients from pools r and s then meet in groupings k and
+    # l only if (k - l) * (r - s) is zero, which cannot happen in
+    # a field unless k = l. This requires a distinct element per
+    # pool in every field, i.e. no more pools than the smallest
+    # field has elements, or returns None otherwise.
+    m = len(pools[0])
+    fields = [_Field(p, e) for p, e in _factorize(m)]
+    if any(field.size < len(pools) for field in fields):
+        return None
+
+    def split(x):
+        parts = []
+        for field in fields:
+            x, part = divmod(x, field.size)
+            parts.append(part)
+        return parts
+
+    def join(parts):
+        x = 0
+        for field, part in reversed(list(zip(fields, parts))):
+            x = x * field.size + part
+        return x
+
+    positions = [split(g) for g in range(m)]
+    groupings = []
+    for k in range(groupings_needed):
+        shifts = [[field.multiply(part, r)
+            for field, part in zip(fields, split(k))]
+            for r in range(len(pools))]
+        groupings.append([
+            [pool[join([field.add(a, b) for field, a, b
+                in zip(fields, position, shifts[r])])]
+                for r, pool in enumerate(pools)]
+            for position in positions
+        ])
+    return groupings
+
+def _multipliers(m, n, groupings_needed, limit=10000):
+    # Choose one multiplier per pool, such that rotating the pools by
+    # the grouping number times their multiplier (modulo m) brings no
+    # two clients together twice. Clients from two pools meet again
+    # after m / gcd(d, m) groupings, where d is the difference of the
+    # pools' multipliers, so this must not fall short of the number
+    # of groupings needed. The search is abandoned (returning None)
+    # after a limited number of steps.
+    admissible = set(d for d in range(1, m)
+        if m // _gcd(d, m) >= groupings_needed)
+    chosen = [0]
+    candidates = [1]
+    steps = 0
+    while len(chosen) < n:
+        steps += 1
+        if steps > limit:
+            return None
+        a = candidates[-1]
+        if a >= m:
+            # Backtrack to the previous pool
+            candidates.pop()
+            if not candidates:
+                return None
+            chosen.pop()
+            candidates[-1] += 1
+        elif all((a - c) % m in admissible for c in chosen):
+            chosen.append(a)
+            candidates.append(a + 1)
+        else:
+            candidates[-1] += 1
+    return chosen
+
+def _rotation(pools, multipliers, k):
+    # Rotate every pool by its multiplier times k
+    m = len(pools[0])
+    return [
+        [pool[(g + k * a) % m] for a, pool in zip(multipliers, pools)]
+        for g in range(m)
+    ]
+
+def _draw(pools, met, rng):
+    # Draw the groups of a single grouping at random, such that
+    # no two clients in a group have met before, or return None
+    # if this fails
+    remaining = [list(pool) for pool in pools[1:]]
+    groups = []
+    for client in pools[0]:
+        group = [client]
+        for pool in remaining:
+            candidates = [c for c in pool
+                if not any(frozenset((c, other)) in met for other in group)]
+            if not candidates:
+                return None
+            choice = rng.choice(candidates)
+            pool.remove(choice)
+            group.append(choice)
+        groups.append(group)
+    return groups
+
+def _perfect_stranger(pools, groupings_needed, rng, attempts=10):
+    # Find groupings in which no two clients meet more than once,
+    # by construction where possible, and otherwise by a limited
+    # number of random draws (so that impossible designs fail fast)
+    groupings = _field_rotation(pools, groupings_needed)
+    if groupings is not None:
+        return groupings
+
+    multipliers = _multipliers(len(pools[0]), len(pools), groupings_needed)
+    if multipliers is not None:
+        return [_rotation(pools, multipliers, k)
+            for k in range(groupings_needed)]
+
+    for attempt in range(attempts):
+        met = set()
+        groupings = []
+        for k in range(groupings_needed):
+            for retry in range(attempts):
+                groups = _draw(pools, met, rng)
+                if groups is not None:
+                    break
+            else:
+                # Start over with different earlier groupings
+                break
+
+            groupings.append(groups)
+            for group in groups:
+                met.update(frozenset((a, b))
+                    for a in group for b in group if a != b)
+        else:
+            return groupings
+
+def _as_grouping(groups):
+    # Map every client onto the other members of its group
+    grouping = {}
+    for group in groups:
+        for client in group:
+            grouping[client] = [c for c in group if c != client]
+    return grouping
+
+def assign(clients, design='stranger', group_size=2, groupings_needed=1,
+    roles=None, ghosts=False, seed=None):
+    """
+    Assign *clients* (a list of ids) to groups and roles,
+    and return the 'groupings' and 'roles' fields of a
+    session document.
+    """
+    if design not in designs:
+        raise ValueError('Unknown design {}'.format(design))
+    if roles is not None and len(roles) != group_size:
+        raise ValueError('The number of roles must match the group size')
+
+    rng = random.Random(seed)
+    pools = _pools(clients, group_size, ghosts, rng)
+
+    if design == 'perfect_stranger' and groupings_needed > len(pools[0]):
+        raise ValueError('A perfect stranger design with {0} clients per '
+            'position allows for at most {0} groupings'.format(
+                len(pools[0])))
+
+    # Roles are tied to positions, and thus
+    # remain the same across groupings
+    assigned_roles = {
+        client: roles[r] if roles else None
+        for r, pool in enumerate(pools) for client in pool
+    }
+
+    if design == 'perfect_stranger':
+        groups = _perfect_stranger(pools, groupings_needed, rng)
+        if groups is None:
+            raise ValueError('No perfect stranger design was found '
+                'with {} clients per position and {} groupings'.format(
+                    len(pools[0]), groupings_needed))
+    else:
+        groups = [zip(*pools)] + [_groups(pools, design, rng)
+            for k in range(1, groupings_needed)]
+
+    groupings = [_as_grouping(g) for g in groups]
+
+    return {
+        'groupings': groupings,
+        'roles': [assigned_roles] * groupings_needed,
+    }
+
+def simulate(client, design='stranger', group_size=2, groupings_needed=1,
+    roles=None, seed=None):
+    """
+    Assign a single *client* to groups with virtual partners (whose
+    ids start with 'offline_'), as a stand-in for the session
+    document in offline mode.
+    """
+    # Designs unknown to the local engine are simulated as stranger
+    # designs, and perfect strangers need new partners every time
+    if design not in designs:
+        design = 'stranger'
+    groupings_needed = max(groupings_needed, 1)
+    per_position = groupings_needed if design == 'perfect_stranger' else 1
+    clients = [client] + ['offline_{}'.format(i + 1)
+        for i in range(group_size * per_position - 1)]
+
+    # Roles that do not match the group size are drawn at random
+    matching = roles if roles is not None and \
+        len(roles) == group_size else None
+
+    try:
+        result = assign(clients, design, group_size, groupings_needed,
+            matching, seed=seed)
+    except ValueError:
+        result = assign(clients, 'stranger', group_size, groupings_needed,
+            matching, seed=seed)
+
+    if roles and matching is None:
+        rng = random.Random(seed)
+        drawn = {c: rng.choice(roles) for c in clients}
+        result['roles'] = [drawn] * groupings_needed
+
+    return result
+
+def encounters(groupings):
+    # Count how often every pair of clients is grouped together
+    counts = Counter()
+    for grouping in groupings:
+        for client, partners in grouping.items():
+            for partner in partners:
+                if client < partner:
+                    counts[client, partner] += 1
+    return counts
+
+def quality(groupings):
+    # Summarize the repeated encounters in a sequence of groupings
+    counts = encounters(groupings)
+    return {
+        'pairs': len(counts),
+        'repeated_pairs': sum(1 for n in counts.values() if n > 1),
+        'max_encounters': max(counts.values()) if counts else 0,
+    }
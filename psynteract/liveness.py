@@ -0,0 +1,74 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Background heartbeat that shows a client to be alive.
+
+Every write to a client document updates its server-side timestamp
+('updated'), so that the experimenter can tell how long ago a client
+was last heard from. During regular trials, the pushes of the
+experiment suffice for this; the heartbeat only writes if no push has
+happened within its interval, e.g. while a subject takes their time
+reading instructions, and then sends an empty patch instead of the
+entire document (or, if the backend lacks the merge handler, the
+state last pushed; see Connection.heartbeat).
+"""
+
+import threading
+import time
+
+# Pushes are timed with a clock that is not
+# affected by changes to the system time
+_clock = getattr(time, 'monotonic', time.time)
+
+class Heartbeat(threading.Thread):
+    def __init__(self, connection, interval=30):
+        threading.Thread.__init__(self, name='psynteract-heartbeat')
+        self.daemon = True
+
+        self.connection = connection
+        self.interval = interval
+        self.error = None
+        self._stopped = threading.Event()
+
+    def _idle(self):
+        # Time since the document was last written,
+        # by a regular push or a previous heartbeat
+        last = self.connection._last_write
+        return self.interval if last is None else _clock() - last
+
+    def run(self):
+        delay = self.interval
+        while not self._stopped.wait(delay):
+            idle = self._idle()
+            if idle < self.interval:
+                # Wait until the interval has passed since the last write
+                delay = self.interval - idle
+                continue
+
+            try:
+                self.connection._beat()
+            except self.connection.transport.transient_errors:
+                # The server may be back by the next interval
+                pass
+            except Exception as e:
+                # Stop, but keep the error for inspection
+                self.error = e
+                print('The heartbeat of client {} has stopped due to '
+                    'an error: {!r}'.format(self.connection._id, e))
+                return
+            delay = self.interval
+
+    def stop(self):
+        self._stopped.set()
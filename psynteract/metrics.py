@@ -0,0 +1,245 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Instrumentation of the database operations a connection makes.
+
+Every operation is timed, and its latency is recorded in a histogram
+under the operation's name (e.g. 'query psynteract/open_sessions' or
+'update add_timestamp'). In addition, the metrics count the bytes
+sent and received (for transports that report them), and the changes
+feed events processed, as well as those that were relevant to the
+condition being waited for. Callbacks can subscribe to individual
+operations as they complete, and *snapshot* summarizes the state,
+e.g. to log it alongside the data of every trial.
+"""
+
+from __future__ import division
+
+import bisect
+import threading
+import time
+
+try:
+    _clock = time.perf_counter
+except AttributeError:
+    _clock = time.time
+
+# Upper bounds of the latency histogram buckets, in seconds,
+# doubling from a tenth of a millisecond up to about a minute
+BUCKETS = [0.0001 * 2 ** i for i in range(20)]
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.total += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, p):
+        # Estimate a percentile as the upper
+        # bound of the bucket that contains it
+        if not self.count:
+            return None
+        rank = p / 100 * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank and n:
+                return BUCKETS[i] if i < len(BUCKETS) else self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'total': self.total,
+            'mean': self.total / self.count if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'p50': self.percentile(50),
+            'p90': self.percentile(90),
+            'p99': self.percentile(99),
+            'buckets': {
+                BUCKETS[i] if i < len(BUCKETS) else 'inf': n
+                for i, n in enumerate(self.counts) if n
+            },
+        }
+
+class Metrics(object):
+    """
+    Thread-safe collection of operation latencies, byte and
+    event counters. A single instance may be shared by several
+    connections to aggregate their operations.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hooks = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.latencies = {}
+            self.errors = {}
+            self.counters = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.events_processed = 0
+            self.events_relevant = 0
+
+    def subscribe(self, callback):
+        # Register a function that is called with the name,
+        # the duration (in seconds) and the error (if any) of
+        # every operation as it completes
+        self._hooks.append(callback)
+        return callback
+
+    def unsubscribe(self, callback):
+        self._hooks.remove(callback)
+
+    def record(self, operation, duration, error=None):
+        with self._lock:
+            if operation not in self.latencies:
+                self.latencies[operation] = Histogram()
+            self.latencies[operation].add(duration)
+            if error is not None:
+                self.errors[operation] = self.errors.get(operation, 0) + 1
+
+        for hook in self._hooks:
+            hook(operation, duration, error)
+
+    def timer(self, operation):
+        return _Timer(self, operation)
+
+    def count(self, counter, n=1):
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + n
+
+    def transferred(self, sent=0, received=0):
+        with self._lock:
+            self.bytes_sent += sent
+            self.bytes_received += received
+
+    def event(self, relevant=True):
+        # Note a change received from the changes feed,
+        # and whether it had any bearing on the client
+        with self._lock:
+            self.events_processed += 1
+            if relevant:
+                self.events_relevant += 1
+
+    def snapshot(self, reset=False):
+        # Summarize the metrics collected so far,
+        # optionally starting anew (e.g. for every trial)
+        with self._lock:
+            result = {
+                'operations': {
+                    operation: dict(histogram.summary(),
+                        errors=self.errors.get(operation, 0))
+                    for operation, histogram in self.latencies.items()
+                },
+                'counters': dict(self.counters),
+                'bytes_sent': self.bytes_sent,
+                'bytes_received': self.bytes_received,
+                'events_processed': self.events_processed,
+                'events_relevant': self.events_relevant,
+            }
+        if reset:
+            self.reset()
+        return result
+
+class _Timer(object):
+    # Context manager that records the duration of its block
+    def __init__(self, metrics, operation):
+        self.metrics = metrics
+        self.operation = operation
+
+    def __enter__(self):
+        self.start = _clock()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.metrics.record(self.operation, _clock() - self.start, value)
+        return False
+
+class InstrumentedTransport(object):
+    """
+    Wrap a transport so that all operations
+    are timed and recorded in *metrics*.
+    """
+    def __init__(self, transport, metrics):
+        self.transport = transport
+        self.metrics = metrics
+
+    def __getattr__(self, name):
+        # Pass on all other attributes, e.g. transient_errors
+        return getattr(self.transport, name)
+
+    def info(self):
+        with self.metrics.timer('info'):
+            return self.transport.info()
+
+    def get(self, _id):
+        with self.metrics.timer('get'):
+            return self.transport.get(_id)
+
+    def get_if_modified(self, _id, rev):
+        with self.metrics.timer('get_if_modified'):
+            doc = self.transport.get_if_modified(_id, rev)
+        if doc is None:
+            self.metrics.count('not_modified')
+        return doc
+
+    def get_many(self, ids):
+        with self.metrics.timer('get_many'):
+            return self.transport.get_many(ids)
+
+    def rev(self, _id):
+        with self.metrics.timer('rev'):
+            return self.transport.rev(_id)
+
+    def query(self, name, **params):
+        with self.metrics.timer('query ' + name):
+            return self.transport.query(name, **params)
+
+    def all_docs(self, **params):
+        with self.metrics.timer('all_docs'):
+            return self.transport.all_docs(**params)
+
+    def put_attachment(self, _id, name, data, content_type, rev=None):
+        with self.metrics.timer('put_attachment'):
+            return self.transport.put_attachment(
+                _id, name, data, content_type, rev)
+
+    def get_attachment(self, _id, name, stream=False):
+        # For streams, only the time until the
+        # download begins is recorded
+        with self.metrics.timer('get_attachment'):
+            return self.transport.get_attachment(_id, name, stream)
+
+    def update(self, handler, doc, _id=None):
+        with self.metrics.timer('update ' + handler):
+            return self.transport.update(handler, doc, _id)
+
+    def changes(self, params, timeout=None, body=None):
+        # Only the time to open the feed is recorded
+        # here, the time spent waiting is part of 'wait'
+        with self.metrics.timer('changes'):
+            return self.transport.changes(params, timeout, body)
@@ -0,0 +1,60 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+def merge_patch(old, new):
+    """
+    Compute a JSON merge patch (RFC 7386) that transforms
+    the document *old* into *new*. Nested dictionaries are
+    compared recursively, all other values (including lists)
+    are replaced as a whole if they differ, and removed keys
+    are marked by None. Because of the latter, None values
+    cannot be set through a patch; in this case, a ValueError
+    is raised.
+    """
+    patch = {}
+
+    for k in old:
+        if k not in new:
+            patch[k] = None
+
+    for k, v in new.items():
+        if k in old and isinstance(v, dict) and isinstance(old[k], dict):
+            p = merge_patch(old[k], v)
+            if p:
+                patch[k] = p
+        elif k not in old or v != old[k]:
+            if v is None:
+                raise ValueError('None values cannot be set via a patch')
+            patch[k] = v
+
+    return patch
+
+def apply_merge_patch(doc, patch):
+    """
+    Apply a JSON merge *patch* to the dictionary *doc*
+    in place, and return it. Nested patches are merged
+    into an empty dictionary where the target is not one,
+    so that None values are removed throughout.
+    """
+    for k, v in patch.items():
+        if v is None:
+            doc.pop(k, None)
+        elif isinstance(v, dict):
+            if not isinstance(doc.get(k), dict):
+                doc[k] = {}
+            apply_merge_patch(doc[k], v)
+        else:
+            doc[k] = v
+
+    return doc
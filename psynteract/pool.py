@@ -0,0 +1,94 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+HTTP connections shared by all clients within a process.
+
+A :class:`Pool` keeps persistent (keep-alive) connections to every
+server, up to a limit per host. It provides separate lanes for the
+long-running changes feeds and for all other, short requests, so
+that open feeds never occupy the connections needed for pushes.
+
+All connections and the backend installation draw on the default
+pool unless told otherwise. Every user of the pool receives its own
+requests session (with its own headers, authentication and hooks),
+but all sessions of a lane share the same underlying connections.
+"""
+
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+lanes = ('requests', 'feeds')
+
+class Pool(object):
+    def __init__(self, max_per_host=10, max_feeds_per_host=10,
+        max_hosts=10, block=False):
+        # Up to *max_per_host* connections are kept open to every
+        # one of *max_hosts* servers for short requests, and
+        # *max_feeds_per_host* for changes feeds. Requests beyond
+        # this limit open additional connections, which are closed
+        # after use rather than kept. If *block* is set, they wait
+        # for a free connection instead, without any time limit:
+        # as changes feeds and unread attachment streams hold on to
+        # their connections, more feeds (e.g. listening connections
+        # or threads waiting) or streams than the limit then wait
+        # forever. Blocking is thus only safe if the limits exceed
+        # the number of feeds and streams open at the same time.
+        self._adapters = {
+            'requests': HTTPAdapter(pool_connections=max_hosts,
+                pool_maxsize=max_per_host, pool_block=block),
+            'feeds': HTTPAdapter(pool_connections=max_hosts,
+                pool_maxsize=max_feeds_per_host, pool_block=block),
+        }
+
+    def session(self, lane='requests'):
+        # Create a session that uses the connections of a lane
+        if lane not in lanes:
+            raise ValueError('Unknown lane {}'.format(lane))
+
+        session = requests.Session()
+        for prefix in ('http://', 'https://'):
+            session.mount(prefix, self._adapters[lane])
+        session.headers.update({
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+        })
+        return session
+
+    def close(self):
+        for adapter in self._adapters.values():
+            adapter.close()
+
+_default = None
+_default_lock = threading.Lock()
+
+def default_pool():
+    # Retrieve the pool shared within the process,
+    # creating it on first use
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = Pool()
+        return _default
+
+def configure(**options):
+    # Replace the default pool by one with different limits
+    # (connections of the previous pool remain open until
+    # the sessions using them are discarded)
+    global _default
+    with _default_lock:
+        _default = Pool(**options)
+        return _default
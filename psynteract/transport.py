@@ -0,0 +1,553 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Transports through which a :class:`psynteract.Connection`
+reaches the database.
+
+A transport provides the handful of database operations the client
+relies upon: database info, (conditional) document retrieval and
+revision checks, view queries, the psynteract update handler, and
+the continuous changes feed. The :class:`CouchTransport` talks to an actual CouchDB
+server, whereas the :class:`MemoryTransport` implements the relevant
+parts of the psynteract backend in memory, so that the client logic
+can be tested and benchmarked without a server.
+"""
+
+import copy
+import io
+import threading
+import time
+import uuid
+
+import pycouchdb
+import requests
+from pycouchdb.resource import Resource
+from pycouchdb.utils import extract_credentials, urljoin
+
+from . import codec
+from .feed import read_changes
+from .patch import apply_merge_patch
+from .conditions import match
+from .grouping import assign
+from .pool import default_pool
+
+class ChangesStream(object):
+    """
+    Iterate over the changes in a streamed response.
+    The stream can be closed from another thread.
+    """
+    def __init__(self, response, metrics=None):
+        self.response = response
+        self.metrics = metrics
+
+    def _received(self, size):
+        self.metrics.transferred(received=size)
+
+    def __iter__(self):
+        return read_changes(self.response,
+            on_read=None if self.metrics is None else self._received)
+
+    def close(self):
+        self.response.close()
+
+class BufferReader(object):
+    """
+    Expose a buffer (bytes, a memoryview, or any other object
+    supporting the buffer protocol, such as a NumPy array) as a
+    file, so that it can be sent in blocks without copying it
+    as a whole.
+    """
+    def __init__(self, data):
+        self.view = memoryview(data).cast('B')
+        self.len = len(self.view)
+        self.position = 0
+
+    def read(self, size=-1):
+        end = self.len if size is None or size < 0 else \
+            min(self.position + size, self.len)
+        block = self.view[self.position:end].tobytes()
+        self.position = end
+        return block
+
+def as_body(data):
+    # Prepare binary data to be sent as a request body:
+    # files and iterables of chunks are streamed as they are,
+    # buffers are read block by block
+    if hasattr(data, 'read') or isinstance(data, bytes):
+        return data
+    try:
+        view = memoryview(data)
+    except TypeError:
+        return data
+    return BufferReader(view)
+
+def read_body(data):
+    # Read a request body prepared by as_body in full
+    data = as_body(data)
+    if hasattr(data, 'read'):
+        return data.read()
+    elif isinstance(data, bytes):
+        return data
+    return b''.join(data)
+
+class CouchTransport(object):
+    # Errors after which a changes feed can be re-established
+    transient_errors = (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.ChunkedEncodingError,
+    )
+
+    def __init__(self, server_uri, db_name, metrics=None, pool=None,
+        check=True):
+        # Draw on the connections of a shared pool (by default, the
+        # one of the process, see psynteract.pool), using one lane
+        # for the changes feed and another for all other requests
+        pool = pool or default_pool()
+        base_url, credentials = extract_credentials(server_uri)
+        db_url = urljoin(base_url, db_name)
+
+        sessions = pool.session('requests'), pool.session('feeds')
+        for session in sessions:
+            session.auth = credentials
+            # Optionally, count the bytes transferred
+            # (see psynteract.metrics)
+            session.hooks['response'].append(self._count_bytes)
+        self.metrics = metrics
+
+        self.db = pycouchdb.client.Database(
+            Resource(db_url, session=sessions[0]), db_name)
+        self.feeds = Resource(db_url, session=sessions[1])
+
+        # Fail early if the database does not exist
+        # (unless the check is deferred to the first request)
+        if check:
+            try:
+                self.db.resource.head()
+            except pycouchdb.exceptions.NotFound:
+                raise pycouchdb.exceptions.NotFound(
+                    "Database '{}' does not exist".format(db_name))
+
+    def _count_bytes(self, response, stream=False, **kwargs):
+        if self.metrics is None:
+            return
+        # (streamed request bodies of unknown length are not counted)
+        self.metrics.transferred(
+            sent=int(response.request.headers.get('Content-Length', 0)),
+            # Streamed bodies are counted as they are read
+            received=0 if stream else len(response.content))
+
+    def info(self):
+        return self.db.resource.get()[1]
+
+    def get(self, _id):
+        return self.db.get(_id)
+
+    def get_if_modified(self, _id, rev):
+        # Retrieve a document only if its revision differs from
+        # the one given, and return None otherwise. CouchDB uses
+        # the revision as the document's ETag, so that an unchanged
+        # document is answered with an empty 304 response. (The
+        # request is sent through the underlying http session,
+        # because the db abstraction layer treats 304 as an error)
+        resource = self.db.resource(_id)
+        response = resource.session.get(resource.base_url,
+            headers={'If-None-Match': '"{}"'.format(rev)},
+            timeout=resource.timeout)
+
+        if response.status_code == 304:
+            return None
+        elif response.status_code == 404:
+            raise pycouchdb.exceptions.NotFound(
+                'Document {} not found'.format(_id))
+        response.raise_for_status()
+        return codec.loads(response.content)
+
+    def get_many(self, ids):
+        # Retrieve multiple documents through a single
+        # request to _all_docs, and return them by id
+        # (leaving out those that do not exist)
+        response, result = self.db.resource.post(
+            '_all_docs',
+            params={'include_docs': 'true'},
+            data=codec.dumps({'keys': list(ids)})
+            )
+
+        return { row['id']: row['doc']
+            for row in result['rows'] if row.get('doc') is not None }
+
+    def rev(self, _id):
+        # Retrieve the latest revision of a document
+        # without transferring its body
+        response, result = self.db.resource(_id).head()
+        return response.headers.get('ETag', '').strip('"')
+
+    def query(self, name, **params):
+        return list(self.db.query(name, **params))
+
+    def put_attachment(self, _id, name, data, content_type, rev=None):
+        # Upload an attachment, creating the document if
+        # it does not exist yet, and return the new revision
+        response, result = self.db.resource(_id).put(name,
+            params={'rev': rev} if rev else None,
+            data=as_body(data),
+            headers={'Content-Type': content_type})
+        return result['rev']
+
+    def get_attachment(self, _id, name, stream=False):
+        # Download an attachment, either in full, or as a
+        # stream that can be read from as the data arrive
+        response, result = self.db.resource(_id).get(name, stream=stream)
+        if stream:
+            response.raw.decode_content = True
+            return response.raw
+        return response.content
+
+    def all_docs(self, **params):
+        # List documents by id, e.g. within a range
+        # given by startkey and endkey (which, like view
+        # keys, are JSON-encoded by the db layer)
+        return self.db.all(as_list=True, **params)
+
+    def update(self, handler, doc, _id=None):
+        # Send a document to a psynteract update handler
+        # (note that this bypasses the db abstraction layer),
+        # and return the document id and its new revision,
+        # which are provided as response headers.
+        response, result = self.db.resource.put(
+            '_design/psynteract/_update/{}/{}'.format(
+                handler, '' if _id is None else _id),
+            data=codec.dumps(doc)
+            )
+        return response.headers['X-Couch-Id'], \
+            response.headers['X-Couch-Update-NewRev']
+
+    def changes(self, params, timeout=None, body=None):
+        # Open a changes feed with the given query parameters;
+        # the timeout applies to the underlying http request.
+        # Built-in filters (_selector and _doc_ids) receive their
+        # arguments as the body of a POST request.
+        if body is None:
+            r = self.feeds.get(
+                '_changes',
+                params=params,
+                stream=True,
+                timeout=timeout
+            )
+        else:
+            r = self.feeds.post(
+                '_changes',
+                params=params,
+                data=codec.dumps(body),
+                stream=True,
+                timeout=timeout
+            )
+        return ChangesStream(r[0], self.metrics)
+
+def _true(value):
+    # Query parameters may arrive as strings or booleans
+    return value in (True, 'true', 'True')
+
+class MemoryChangesStream(object):
+    def __init__(self, transport, params):
+        self.transport = transport
+        self.params = params
+        self.closed = False
+
+    def __iter__(self):
+        t = self.transport
+        since = int(self.params.get('since') or 0)
+        continuous = self.params.get('feed') == 'continuous'
+        timeout = self.params.get('timeout')
+        deadline = None if timeout is None else \
+            time.time() + int(timeout) / 1000
+
+        while True:
+            with t.lock:
+                changes = t._changes_since(since, self.params)
+                while continuous and not changes and not self.closed:
+                    remaining = None if deadline is None else \
+                        deadline - time.time()
+                    if remaining is not None and remaining <= 0:
+                        break
+                    t.lock.wait(remaining)
+                    changes = t._changes_since(since, self.params)
+
+            for change in changes:
+                since = change['seq']
+                yield change
+
+            if not continuous or not changes or self.closed:
+                # Signal the end of the feed, like CouchDB
+                yield {'last_seq': since}
+                return
+
+    def close(self):
+        with self.transport.lock:
+            self.closed = True
+            self.transport.lock.notify_all()
+
+class MemoryTransport(object):
+    """
+    In-memory stand-in for a CouchDB database
+    with the psynteract backend installed.
+
+    Besides the operations used by the client, the transport
+    offers *open_session* and *start_session* to play the part
+    of the experimenter. All operations are thread-safe, so that
+    multiple connections can share a single transport.
+    """
+    transient_errors = ()
+
+    def __init__(self):
+        self.docs = {}
+        self.seq = 0
+        # Sequence number of each document's latest change,
+        # which is all the changes feed reports
+        self._doc_seq = {}
+        self.attachments = {}
+        self.lock = threading.Condition()
+
+    def _store(self, doc):
+        # Save a document under a new revision
+        # and announce the change
+        with self.lock:
+            previous = self.docs.get(doc['_id'])
+            n = 1 if previous is None else \
+                int(previous['_rev'].split('-', 1)[0]) + 1
+            doc['_rev'] = '{}-{}'.format(n, uuid.uuid4().hex)
+
+            self.seq += 1
+            self.docs[doc['_id']] = doc
+            self._doc_seq[doc['_id']] = self.seq
+            self.lock.notify_all()
+            return doc['_id'], doc['_rev']
+
+    def info(self):
+        with self.lock:
+            return {
+                'db_name': 'memory',
+                'doc_count': len(self.docs),
+                'update_seq': self.seq,
+            }
+
+    def get(self, _id):
+        with self.lock:
+            try:
+                return copy.deepcopy(self.docs[_id])
+            except KeyError:
+                raise pycouchdb.exceptions.NotFound('missing')
+
+    def get_if_modified(self, _id, rev):
+        with self.lock:
+            if _id in self.docs and self.docs[_id]['_rev'] == rev:
+                return None
+            return self.get(_id)
+
+    def get_many(self, ids):
+        with self.lock:
+            return {_id: self.get(_id) for _id in ids if _id in self.docs}
+
+    def rev(self, _id):
+        return self.get(_id)['_rev']
+
+    def put_attachment(self, _id, name, data, content_type, rev=None):
+        data = read_body(data)
+        with self.lock:
+            doc = copy.deepcopy(self.docs.get(_id, {'_id': _id}))
+            if doc.get('_rev') != rev:
+                raise pycouchdb.exceptions.Conflict('Document update conflict')
+
+            # Documents only carry stubs, the data are kept separately
+            doc.setdefault('_attachments', {})[name] = {
+                'content_type': content_type,
+                'length': len(data),
+                'stub': True,
+            }
+            self.attachments[_id, name] = data
+            return self._store(doc)[1]
+
+    def get_attachment(self, _id, name, stream=False):
+        with self.lock:
+            try:
+                data = self.attachments[_id, name]
+            except KeyError:
+                raise pycouchdb.exceptions.NotFound('missing')
+        return io.BytesIO(data) if stream else data
+
+    def query(self, name, **params):
+        with self.lock:
+            if name == 'psynteract/open_sessions':
+                # Sessions that have not been closed,
+                # in the order in which they were opened
+                rows = sorted([
+                    {'id': _id, 'key': doc['opened'], 'value': None}
+                    for _id, doc in self.docs.items()
+                    if doc.get('type') == 'session' and
+                        doc.get('status') != 'closed'
+                ], key=lambda row: row['key'])
+            elif name == 'psynteract/session_clients':
+                rows = sorted([
+                    {'id': _id, 'key': doc['session'], 'value': None}
+                    for _id, doc in self.docs.items()
+                    if doc.get('type') == 'client' and
+                        ('key' not in params or
+                            doc['session'] == params['key'])
+                ], key=lambda row: (row['key'], row['id']))
+            else:
+                raise pycouchdb.exceptions.NotFound(
+                    'missing_named_view')
+
+            # Ranges (in ascending order only) and paging,
+            # which, like in CouchDB, apply to the rows as
+            # ordered by key and document id
+            if 'startkey' in params:
+                start = (params['startkey'], params.get('startkey_docid', ''))
+                rows = [r for r in rows if (r['key'], r['id']) >= start]
+            if 'endkey' in params:
+                rows = [r for r in rows if r['key'] <= params['endkey']]
+            if _true(params.get('descending')):
+                rows.reverse()
+            skip = int(params.get('skip', 0))
+            limit = params.get('limit')
+            rows = rows[skip:None if limit is None else skip + int(limit)]
+
+            if _true(params.get('include_docs')):
+                for row in rows:
+                    row['doc'] = copy.deepcopy(self.docs[row['id']])
+
+            return rows
+
+    def all_docs(self, **params):
+        with self.lock:
+            startkey = params.get('startkey')
+            endkey = params.get('endkey')
+            rows = [
+                {'id': _id, 'key': _id,
+                    'value': {'rev': self.docs[_id]['_rev']}}
+                for _id in sorted(self.docs)
+                if (startkey is None or _id >= startkey) and
+                    (endkey is None or _id <= endkey)
+            ]
+
+            skip = int(params.get('skip', 0))
+            limit = params.get('limit')
+            rows = rows[skip:None if limit is None else skip + int(limit)]
+
+            if _true(params.get('include_docs', True)):
+                for row in rows:
+                    row['doc'] = copy.deepcopy(self.docs[row['id']])
+
+            return rows
+
+    def update(self, handler, doc, _id=None):
+        doc = codec.loads(codec.dumps(doc))
+
+        with self.lock:
+            if handler == 'merge':
+                # Apply a JSON merge patch to the stored document
+                # (which carries its current revision)
+                doc = apply_merge_patch(self.get(_id), doc)
+            elif handler == 'add_timestamp':
+                doc['_id'] = _id or uuid.uuid4().hex
+                # As on the server, the document replaces the stored
+                # one only if it is based on the latest revision
+                current = self.docs.get(doc['_id'])
+                if current is not None and \
+                    doc.get('_rev') != current['_rev']:
+                    raise pycouchdb.exceptions.Conflict(
+                        'Document update conflict')
+            else:
+                raise pycouchdb.exceptions.NotFound(
+                    'missing_update_handler')
+
+            doc.pop('_rev', None)
+
+            # Like the update handler on the server,
+            # add the time of the update (in ms since the epoch)
+            doc['updated'] = int(time.time() * 1000)
+
+            return self._store(doc)
+
+    def _matches(self, doc, params):
+        # Implements the psynteract/clients, _selector
+        # and _doc_ids filters
+        if params.get('filter') == '_selector':
+            return match(params['selector'], doc)
+        elif params.get('filter') == '_doc_ids':
+            return doc['_id'] in params['doc_ids']
+        elif params.get('filter') != 'psynteract/clients':
+            return True
+        elif _true(params.get('include_session')) and \
+            doc['_id'] == params.get('session'):
+            return True
+        else:
+            return doc.get('session') == params.get('session') and \
+                doc.get('type') == params.get('type')
+
+    def _changes_since(self, since, params):
+        changes = []
+        for _id, seq in sorted(self._doc_seq.items(), key=lambda i: i[1]):
+            doc = self.docs[_id]
+            if seq > since and self._matches(doc, params):
+                change = {
+                    'seq': seq, 'id': _id,
+                    'changes': [{'rev': doc['_rev']}],
+                }
+                if _true(params.get('include_docs')):
+                    change['doc'] = copy.deepcopy(doc)
+                changes.append(change)
+        return changes
+
+    def changes(self, params, timeout=None, body=None):
+        return MemoryChangesStream(self, dict(params, **(body or {})))
+
+    def open_session(self, **fields):
+        # Create a new session document, as the
+        # experimenter's interface would
+        with self.lock:
+            doc = {
+                '_id': uuid.uuid4().hex,
+                'type': 'session',
+                'status': 'open',
+                'opened': self.seq,
+                'groupings': [],
+                'roles': [],
+                'replace': {},
+            }
+            doc.update(fields)
+            return self._store(doc)[0]
+
+    def start_session(self, session, group_size=2, groupings_needed=1,
+        roles=None, design='partner', ghosts=False, seed=None):
+        # Assign the session's clients to groups and roles
+        # (see psynteract.grouping), and start the session
+        with self.lock:
+            doc = copy.deepcopy(self.docs[session])
+            clients = [row['id'] for row in self.query(
+                'psynteract/session_clients', key=session)]
+
+            doc.update(assign(clients, design=design,
+                group_size=group_size, groupings_needed=groupings_needed,
+                roles=roles, ghosts=ghosts, seed=seed))
+            doc['status'] = 'running'
+            return self._store(doc)[1]
+
+    def update_session(self, session, **fields):
+        # Modify a session, e.g. to add replacements
+        with self.lock:
+            doc = copy.deepcopy(self.docs[session])
+            doc.update(fields)
+            return self._store(doc)[1]
@@ -71,5 +71,10 @@ setup(
     # Run-time dependencies
     install_requires=['requests', 'pycouchdb'],
 
+    # Optional dependencies, e.g. for the asyncio client
+    extras_require={
+        'async': ['aiohttp'],
+    },
+
     zip_safe=False,
 )
@@ -0,0 +1,60 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+from psynteract import MemoryTransport
+
+@pytest.fixture
+def transport():
+    # An in-memory database with an open session
+    transport = MemoryTransport()
+    transport.session = transport.open_session()
+    return transport
+
+@pytest.fixture
+def later():
+    # Run functions in the background after a delay,
+    # waiting for all of them at the end of the test
+    threads = []
+
+    def schedule(delay, f, *args, **kwargs):
+        def run():
+            time.sleep(delay)
+            f(*args, **kwargs)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    yield schedule
+
+    for thread in threads:
+        thread.join(10)
+
+@pytest.fixture
+def wait_until():
+    # Poll for a condition that is met in the background,
+    # and return whether it was met within the timeout
+    def wait_until(predicate, timeout=5):
+        deadline = time.time() + timeout
+        while not predicate():
+            if time.time() > deadline:
+                return False
+            time.sleep(0.01)
+        return True
+    return wait_until
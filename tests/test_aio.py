@@ -0,0 +1,108 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+
+import pytest
+
+from psynteract import Connection
+from psynteract.aio import AsyncConnection, AsyncMemoryTransport
+from psynteract.bots import Harness
+
+def run(coroutine):
+    return asyncio.run(asyncio.wait_for(coroutine, 10))
+
+class RecordingTransport(AsyncMemoryTransport):
+    # Keep track of the feeds opened
+    def __init__(self, transport):
+        AsyncMemoryTransport.__init__(self, transport)
+        self.feeds = []
+
+    async def changes(self, params, timeout=None, body=None):
+        self.feeds.append((params, body))
+        return await AsyncMemoryTransport.changes(self, params, timeout, body)
+
+def test_wait_for_synchronous_partner(transport):
+    async def main():
+        c = await AsyncConnection(transport=RecordingTransport(transport),
+            initial_data={'round': 0}).connect()
+        partner = Connection(transport=transport, initial_data={'round': 0})
+        others = [Connection(transport=transport, initial_data={'round': 0})
+            for i in range(2)]
+        transport.start_session(transport.session, group_size=2, seed=1)
+        partners = await c.current_partners()
+        partner = next(p for p in [partner] + others if p._id in partners)
+
+        async def respond():
+            await asyncio.sleep(0.05)
+            partner.data['round'] = 1
+            partner.push()
+
+        task = asyncio.ensure_future(respond())
+        await c.wait(lambda doc: doc['data']['round'] >= 1,
+            check='partners')
+        await task
+
+        # Only the partner and the session were followed
+        params, body = c.transport.feeds[-1]
+        assert params['filter'] == '_doc_ids'
+        assert body['doc_ids'] == sorted([partner._id, transport.session])
+        return c
+
+    c = run(main())
+    summary = c.metrics.snapshot()
+    assert 'wait partners' in summary['operations']
+    assert summary['events_processed'] >= 1
+
+def test_documents_are_revalidated(transport):
+    async def main():
+        c = await AsyncConnection(transport=AsyncMemoryTransport(transport),
+            initial_data={}).connect()
+        other = Connection(transport=transport, initial_data={'a': 1})
+        assert (await c.get(other._id))['data'] == {'a': 1}
+        assert (await c.get(other._id))['data'] == {'a': 1}
+        other.data['a'] = 2
+        other.push()
+        assert (await c.get(other._id))['data'] == {'a': 2}
+        return c
+
+    c = run(main())
+    assert c.metrics.snapshot()['counters'] == {'not_modified': 1}
+
+def test_offline():
+    async def main():
+        c = await AsyncConnection(offline=True, group_size=3,
+            initial_data={}).connect()
+        await c.wait()
+        assert len(await c.current_partners()) == 2
+    run(main())
+
+@pytest.mark.parametrize('shared_feed', [True, False])
+def test_harness(transport, shared_feed):
+    async def start():
+        # Start the session once all bots have connected
+        while len(transport.query('psynteract/session_clients',
+            key=transport.session)) < 4:
+            await asyncio.sleep(0.01)
+        transport.start_session(transport.session, group_size=4)
+
+    async def main():
+        harness = Harness(bots=4, trials=3, shared_feed=shared_feed,
+            transport=AsyncMemoryTransport(transport))
+        report, _ = await asyncio.gather(harness.run(), start())
+        return report
+
+    report = run(main())
+    assert len(report['trials']) == 3
+    assert report['overall']['n'] == 12
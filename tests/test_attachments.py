@@ -0,0 +1,83 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import array
+import io
+
+import pytest
+import pycouchdb.exceptions
+
+from psynteract import Connection
+from psynteract.transport import as_body, read_body
+
+@pytest.mark.parametrize('data', [
+    b'abc',
+    bytearray(b'abc'),
+    memoryview(b'abc'),
+    io.BytesIO(b'abc'),
+    [b'a', b'bc'],
+])
+def test_bodies(data):
+    assert read_body(data) == b'abc'
+
+def test_buffers_are_read_in_blocks():
+    values = array.array('i', [1, 2, 3])
+    body = as_body(values)
+    assert body.read(4) == values.tobytes()[:4]
+    assert body.read() == values.tobytes()[4:]
+    assert body.read() == b''
+
+def test_attachments(transport):
+    c, other = [Connection(transport=transport, initial_data={})
+        for i in range(2)]
+    c.put_attachment('recording', memoryview(b'abc'), 'audio/wav')
+
+    _id = Connection.attachment_id(c._id, 'recording')
+    stub = transport.get(_id)['_attachments']['data']
+    assert stub == {'content_type': 'audio/wav', 'length': 3, 'stub': True}
+    # The client document is not affected
+    assert '_attachments' not in transport.get(c._id)
+
+    assert c.get_attachment('recording') == b'abc'
+    assert other.get_attachment('recording', c._id) == b'abc'
+    assert other.get_attachment('recording', c._id, stream=True).read() \
+        == b'abc'
+
+    # Attachments can be replaced
+    c.put_attachment('recording', io.BytesIO(b'def'))
+    assert c.get_attachment('recording') == b'def'
+
+def test_attachments_stored_previously(transport):
+    # The revision of an existing attachment is looked up
+    c = Connection(transport=transport, initial_data={})
+    c.put_attachment('recording', b'abc')
+    c._attachment_revs.clear()
+    c.put_attachment('recording', [b'de', b'f'])
+    assert c.get_attachment('recording') == b'def'
+
+def test_attachments_of_replacements(transport):
+    c, other, replacement = [Connection(transport=transport,
+        initial_data={}) for i in range(3)]
+    replacement.put_attachment('recording', b'abc')
+    transport.update_session(transport.session,
+        replace={other._id: replacement._id})
+    assert c.get_attachment('recording', other._id) == b'abc'
+    with pytest.raises(pycouchdb.exceptions.NotFound):
+        c.get_attachment('recording', other._id, check_replacements=False)
+
+def test_offline_attachments():
+    c = Connection(offline=True)
+    c.put_attachment('recording', bytearray(b'abc'))
+    assert c.get_attachment('recording') == b'abc'
+    assert c.get_attachment('recording', stream=True).read() == b'abc'
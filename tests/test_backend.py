@@ -0,0 +1,160 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import threading
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+import pytest
+
+from psynteract import backend
+from psynteract.pool import Pool
+
+class CouchHandler(BaseHTTPRequestHandler):
+    # Just enough of CouchDB's document API to install the backend
+    def log_message(self, *args):
+        pass
+
+    def split(self):
+        url = urlparse(self.path)
+        parts = url.path.strip('/').split('/', 1)
+        return parts[0], parts[1] if len(parts) > 1 else None, \
+            parse_qs(url.query)
+
+    def send(self, code, body=None, headers={}):
+        self.send_response(code)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        data = json.dumps(body).encode() if body is not None else b''
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def do_HEAD(self):
+        db, _id, query = self.split()
+        if db not in self.server.dbs:
+            return self.send(404)
+        elif _id is None:
+            return self.send(200)
+        doc = self.server.dbs[db].get(_id)
+        if doc is None:
+            return self.send(404)
+        self.send(200, headers={'ETag': '"{}"'.format(doc['_rev'])})
+
+    def do_GET(self):
+        db, _id, query = self.split()
+        self.server.log.append(('GET', self.path))
+        if '/_view/' in (_id or ''):
+            return self.send(200, {'rows': []})
+        doc = self.server.dbs.get(db, {}).get(_id)
+        if doc is None:
+            return self.send(404, {'error': 'not_found'})
+        self.send(200, doc)
+
+    def do_PUT(self):
+        db, _id, query = self.split()
+        self.server.log.append(('PUT', self.path))
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        if _id is None:
+            if db in self.server.dbs:
+                return self.send(412, {'error': 'file_exists'})
+            self.server.dbs[db] = {}
+            return self.send(201, {'ok': True})
+
+        doc = json.loads(body.decode())
+        current = self.server.dbs[db].get(_id)
+        rev = query.get('rev', [doc.get('_rev')])[0]
+        if current and current['_rev'] != rev:
+            return self.send(409, {'error': 'conflict'})
+        n = int(current['_rev'].split('-')[0]) + 1 if current else 1
+        doc['_rev'] = '{}-x'.format(n)
+        self.server.dbs[db][_id] = doc
+        self.send(201, {'ok': True, 'rev': doc['_rev']})
+
+class Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+@pytest.fixture
+def server(tmp_path, monkeypatch):
+    server = Server(('127.0.0.1', 0), CouchHandler)
+    server.dbs, server.log = {}, []
+    server.uri = 'http://127.0.0.1:{}/'.format(server.server_port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    path = tmp_path / 'backend.json'
+    server.set_backend = lambda doc: path.write_text(json.dumps(doc))
+    server.set_backend({'_id': '_design/psynteract', 'views': {}})
+    monkeypatch.setattr(backend, 'backend_path', str(path))
+
+    yield server
+    server.shutdown()
+    server.server_close()
+
+class CountingPool(Pool):
+    def __init__(self):
+        Pool.__init__(self)
+        self.sessions = []
+
+    def session(self, lane='requests'):
+        session = Pool.session(self, lane)
+        self.sessions.append(session)
+        return session
+
+def test_install_into_many_databases(server):
+    uris = [server.uri + 'db{}'.format(i) for i in range(5)]
+    pool = CountingPool()
+    result = backend.install(uris, warm=True, pool=pool)
+    assert result == [uri + '/_design/psynteract/index.html' for uri in uris]
+    assert all(server.dbs['db{}'.format(i)]['_design/psynteract']['_rev']
+        == '1-x' for i in range(5))
+    # Every installation has a session of its own
+    assert len(set(map(id, pool.sessions))) == 5
+    assert sum(1 for method, path in server.log if '/_view/' in path) == \
+        5 * len(backend.views)
+
+def test_unchanged_backend_is_skipped(server):
+    uri = server.uri + 'db'
+    backend.install(uri)
+    del server.log[:]
+    backend.install(uri)
+    assert not [path for method, path in server.log if method == 'PUT']
+
+    # Reinstallation can be forced
+    backend.install(uri, force=True)
+    assert server.dbs['db']['_design/psynteract']['_rev'] == '2-x'
+
+def test_modified_backend_is_replaced(server):
+    uri = server.uri + 'db'
+    backend.install(uri)
+
+    # Modified on the server
+    server.dbs['db']['_design/psynteract']['_rev'] = '2-y'
+    backend.install(uri)
+    assert server.dbs['db']['_design/psynteract']['_rev'] == '3-x'
+
+    # Modified locally
+    server.set_backend({'_id': '_design/psynteract', 'views': {'a': {}}})
+    backend.install(uri)
+    assert server.dbs['db']['_design/psynteract']['views'] == {'a': {}}
@@ -0,0 +1,124 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from psynteract import Connection, MemoryTransport
+from psynteract.cache import DocumentCache
+
+def doc(_id, n):
+    return {'_id': _id, '_rev': '{}-abc'.format(n)}
+
+def test_least_recently_used_are_evicted():
+    cache = DocumentCache(2)
+    cache.put(doc('a', 1))
+    cache.put(doc('b', 1))
+    assert cache.get('a')['_id'] == 'a'
+    cache.put(doc('c', 1))
+    assert 'b' not in cache
+    assert 'a' in cache and 'c' in cache
+    assert len(cache) == 2
+
+def test_update_keeps_the_latest_revision():
+    cache = DocumentCache()
+    cache.put(doc('a', 2))
+    cache.update(doc('a', 1))
+    assert cache.get('a')['_rev'] == '2-abc'
+    cache.update(doc('a', 3))
+    assert cache.get('a')['_rev'] == '3-abc'
+
+    # Documents that are not cached are not added
+    cache.update(doc('b', 1))
+    assert 'b' not in cache
+
+def test_invalidate():
+    cache = DocumentCache()
+    cache.put(doc('a', 1))
+    cache.put(doc('b', 1))
+    cache.invalidate('a')
+    assert cache.get('a') is None and 'b' in cache
+    cache.invalidate()
+    assert len(cache) == 0
+
+def test_disabled_cache():
+    cache = DocumentCache(0)
+    cache.put(doc('a', 1))
+    assert 'a' not in cache
+
+class CountingTransport(MemoryTransport):
+    # Count full retrievals and revalidations of client documents
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.requests = []
+
+    def _record(self, request, _id):
+        if self.docs[_id]['type'] == 'client':
+            self.requests.append(request)
+
+    def get(self, _id):
+        self._record('get', _id)
+        return MemoryTransport.get(self, _id)
+
+    def get_if_modified(self, _id, rev):
+        self._record('get_if_modified', _id)
+        with self.lock:
+            if self.docs[_id]['_rev'] == rev:
+                return None
+            return MemoryTransport.get(self, _id)
+
+def test_documents_are_revalidated():
+    transport = CountingTransport()
+    transport.open_session()
+    c, other = [Connection(transport=transport, initial_data={'round': 0})
+        for i in range(2)]
+
+    del transport.requests[:]
+    first = c.get(other._id)
+    assert transport.requests == ['get']
+
+    # An unchanged document is revalidated, and a copy returned
+    first['data']['round'] = 5
+    second = c.get(other._id)
+    assert transport.requests == ['get', 'get_if_modified']
+    assert second['data']['round'] == 0
+
+    # A changed document is transferred again
+    other.data['round'] = 1
+    other.push()
+    assert c.get(other._id)['data']['round'] == 1
+
+def test_pushes_invalidate_the_own_document():
+    transport = MemoryTransport()
+    transport.open_session()
+    c = Connection(transport=transport, initial_data={'round': 0})
+    c.refresh()
+    assert c._id in c._doc_cache
+    c.data['round'] = 1
+    c.push()
+    assert c._id not in c._doc_cache
+    c.refresh()
+    assert c.data['round'] == 1
+
+def test_observed_changes_update_the_cache():
+    transport = MemoryTransport()
+    transport.open_session()
+    c, other = [Connection(transport=transport, initial_data={'round': 0})
+        for i in range(2)]
+    c.get(other._id)
+    other.data['round'] = 1
+    other.push()
+
+    current = transport.get(other._id)
+    c._observe({'id': other._id, 'doc': current})
+    assert c._doc_cache.get(other._id)['_rev'] == current['_rev']
+    c._observe({'id': other._id})
+    assert other._id not in c._doc_cache
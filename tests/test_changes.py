@@ -0,0 +1,99 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+
+import requests
+
+from psynteract import Connection, MemoryTransport
+
+class FailingTransport(MemoryTransport):
+    # Raise the given errors when opening the next changes feeds
+    transient_errors = (requests.exceptions.Timeout,)
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.errors = []
+        self.feeds = 0
+
+    def changes(self, *args, **kwargs):
+        self.feeds += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return MemoryTransport.changes(self, *args, **kwargs)
+
+def connect(transport, n=2):
+    transport.open_session()
+    return [Connection(transport=transport, initial_data={'round': 0})
+        for i in range(n)]
+
+def push(c, round):
+    c.data['round'] = round
+    c.push()
+
+def take(iterator, n):
+    return list(itertools.islice(iterator, n))
+
+def test_changes_as_they_happen(later):
+    transport = MemoryTransport()
+    c, other = connect(transport)
+    # Changes that precede the call are skipped
+    push(other, 1)
+    later(0.05, push, other, 2)
+    later(0.1, push, other, 3)
+
+    changes = take(c.changes(), 2)
+    assert [change['doc']['data']['round'] for change in changes] == [2, 3]
+    assert c.last_seq == changes[-1]['seq']
+    assert c.metrics.events_processed >= 2
+
+def test_changes_resume():
+    transport = MemoryTransport()
+    c, first, second = connect(transport, 3)
+    start = transport.info()['update_seq']
+    push(first, 1)
+    push(second, 2)
+    assert [change['id']
+        for change in take(c.changes(since=start), 1)] == [first._id]
+
+    # Later calls continue after the last change seen
+    assert [change['id']
+        for change in take(c.changes(), 1)] == [second._id]
+
+    # ... unless told otherwise
+    assert [change['id'] for change in take(c.changes(since=start), 2)] \
+        == [first._id, second._id]
+
+def test_changes_without_docs():
+    transport = MemoryTransport()
+    c, other = connect(transport)
+    since = transport.info()['update_seq']
+    push(other, 1)
+    change, = take(c.changes(since=since, include_docs=False), 1)
+    assert change['id'] == other._id and 'doc' not in change
+
+def test_changes_reconnect():
+    transport = FailingTransport()
+    c, other = connect(transport)
+    since = transport.info()['update_seq']
+    transport.errors = [requests.exceptions.Timeout('Lost')] * 2
+    push(other, 1)
+
+    change, = take(c.changes(since=since, retry_interval=0.01), 1)
+    assert change['doc']['data']['round'] == 1
+    assert transport.feeds == 3
+
+def test_offline_changes():
+    c = Connection(offline=True)
+    assert list(c.changes()) == []
@@ -0,0 +1,81 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import pickle
+
+import pytest
+
+from psynteract import codec
+from psynteract.codec import Change, decode_change
+
+line = b'{"seq":3,"id":"a","changes":[{"rev":"1-x"}],' \
+    b'"doc":{"_id":"a","data":{"text":"\\"doc\\":,}"}}}'
+
+def test_document_is_decoded_on_access():
+    change = decode_change(line)
+    assert isinstance(change, Change)
+    assert change['seq'] == 3 and change['id'] == 'a'
+    assert 'doc' in change and not change.decoded
+
+    assert change['doc']['data'] == {'text': '"doc":,}'}
+    assert change.decoded
+
+def test_get_decodes():
+    change = decode_change(line)
+    assert change.get('doc')['_id'] == 'a'
+    assert change.get('missing', 1) == 1
+
+def test_setting_the_document_discards_the_line():
+    change = decode_change(line)
+    change['doc'] = None
+    assert change.decoded and change['doc'] is None
+
+def test_whole_change_equals_eager_decoding():
+    expected = codec.loads(line)
+    assert decode_change(line) == expected
+    assert dict(decode_change(line)) == expected
+    assert sorted(decode_change(line).keys()) == sorted(expected)
+
+@pytest.mark.parametrize('duplicate', [
+    copy.copy, copy.deepcopy,
+    lambda change: pickle.loads(pickle.dumps(change)),
+])
+def test_copies_are_plain_dictionaries(duplicate):
+    result = duplicate(decode_change(line))
+    assert type(result) is dict
+    assert result == codec.loads(line)
+
+@pytest.mark.parametrize('other', [
+    # No document at all
+    b'{"seq":3,"id":"a","changes":[{"rev":"1-x"}]}',
+    # The last seq at the end of a feed
+    b'{"last_seq":3,"pending":0}',
+    # Fields that follow the document
+    b'{"seq":3,"doc":{"_id":"a"},"id":"a"}',
+])
+def test_fallbacks(other):
+    assert decode_change(other) == codec.loads(other)
+
+def test_codecs():
+    assert 'json' in codec.available()
+    previous = codec.name_in_use
+    try:
+        codec.use('json')
+        assert codec.loads(codec.dumps({'a': [1]})) == {'a': [1]}
+        assert isinstance(codec.dumps({}), bytes)
+        with pytest.raises(ValueError):
+            codec.use('missing')
+    finally:
+        codec.use(previous)
@@ -0,0 +1,94 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from psynteract import Connection, MemoryTransport, field
+from psynteract.conditions import match, parse, as_condition
+
+doc = {'status': 'running', 'data': {'round': 3, 'choice': 'a'}}
+
+@pytest.mark.parametrize('selector, expected', [
+    ({'status': 'running'}, True),
+    ({'data.round': {'$gte': 3}}, True),
+    ({'data.round': {'$gt': 3}}, False),
+    ({'data.round': {'$gt': 1, '$lt': 5}}, True),
+    ({'data.choice': {'$in': ['a', 'b']}}, True),
+    ({'data.choice': {'$nin': ['a', 'b']}}, False),
+    ({'data.missing': {'$exists': False}}, True),
+    ({'data.missing': {'$ne': 1}}, False),
+    ({'data.choice': {'$lt': 3}}, False),
+    ({'$or': [{'status': 'closed'}, {'data.round': 3}]}, True),
+    ({'$and': [{'status': 'closed'}, {'data.round': 3}]}, False),
+    ({'$not': {'status': 'closed'}}, True),
+])
+def test_match(selector, expected):
+    assert match(selector, doc) == expected
+
+def test_unsupported_operator():
+    with pytest.raises(ValueError):
+        match({'data.round': {'$regex': '3'}}, doc)
+
+def test_fields_and_combinations():
+    condition = (field('data.round') >= 3) & ~(field('status') == 'closed')
+    assert condition.selector == {'$and': [
+        {'data.round': {'$gte': 3}},
+        {'$not': {'status': {'$eq': 'closed'}}},
+    ]}
+    assert condition(doc)
+    assert not ((field('data.round') < 3) |
+        field('data.choice').isin(['b']))(doc)
+
+def test_parse():
+    assert parse('data.round >= 3').selector == {'data.round': {'$gte': 3}}
+    assert parse('status == "running"')(doc)
+    assert as_condition('data.round != 2')(doc)
+    with pytest.raises(ValueError):
+        parse('data.round >=')
+
+def test_selector_filter(later):
+    # Declarative conditions are evaluated by the server, so that
+    # the feed only carries the documents that satisfy them
+    transport = MemoryTransport()
+    transport.open_session()
+    feeds = []
+    changes = transport.changes
+    def recording_changes(params, timeout=None, body=None):
+        feeds.append((params, body))
+        return changes(params, timeout, body)
+    transport.changes = recording_changes
+
+    c, other = [Connection(transport=transport, initial_data={'round': 0})
+        for i in range(2)]
+    c.data['round'] = 3
+    c.push()
+
+    def push(round):
+        other.data['round'] = round
+        other.push()
+    later(0.05, push, 1)
+    later(0.1, push, 3)
+
+    received = []
+    observe = c._observe
+    c._observe = lambda change: received.append(change['id']) or \
+        observe(change)
+    c.wait('data.round >= 3', timeout=5)
+
+    params, body = feeds[-1]
+    assert params['filter'] == '_selector'
+    assert {'data.round': {'$gte': 3}} in \
+        body['selector']['$or'][1]['$and']
+    # The intermediate update was not transferred
+    assert received == [other._id]
@@ -0,0 +1,86 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from psynteract import Connection
+
+@pytest.fixture
+def clients(transport):
+    clients = [Connection(transport=transport, initial_data={})
+        for i in range(2)]
+    transport.start_session(transport.session, group_size=2, seed=1)
+    return clients
+
+def test_events_are_separate_documents(clients, transport):
+    c = clients[0]
+    c.push_event(2, {'choice': 'b'})
+    c.push_event(1, {'choice': 'a'})
+
+    doc = transport.get(Connection.event_id(c._id, 1))
+    assert doc['type'] == 'event' and doc['client'] == c._id
+    assert doc['session'] == transport.session
+    # The client document itself is unaffected
+    assert transport.get(c._id)['data'] == {}
+
+    assert [(e['round'], e['data']['choice']) for e in c.history()] == \
+        [(1, 'a'), (2, 'b')]
+    assert clients[1].history(c._id) == c.history()
+
+def test_history_follows_replacements(clients, transport):
+    c, other = clients
+    replacement = Connection(transport=transport, initial_data={})
+    other.push_event(1, {'by': 'original'})
+    other.push_event(2, {'by': 'original'})
+    replacement.push_event(2, {'by': 'replacement'})
+    replacement.push_event(3, {'by': 'replacement'})
+    transport.update_session(transport.session,
+        replace={other._id: replacement._id})
+
+    # The replacement's events take precedence
+    assert [(e['round'], e['data']['by']) for e in c.history(other._id)] == \
+        [(1, 'original'), (2, 'replacement'), (3, 'replacement')]
+
+def test_wait_events(clients, later):
+    c, other = clients
+    c.push_event(1, {'choice': 'a'})
+    later(0.05, other.push_event, 1, {'choice': 'b'})
+    events = c.wait_events(1, timeout=5)
+    assert list(events) == [other._id]
+    assert events[other._id]['data'] == {'choice': 'b'}
+
+    # Events that already exist are reported right away
+    events = other.wait_events(1, check='clients', timeout=5)
+    assert {k: e['data']['choice'] for k, e in events.items()} == \
+        {c._id: 'a', other._id: 'b'}
+
+def test_wait_events_timeout(clients):
+    c, other = clients
+    assert c.wait_events(1, timeout=0.1) == {}
+
+def test_wait_events_from_replacements(clients, transport):
+    c, other = clients
+    replacement = Connection(transport=transport, initial_data={})
+    transport.update_session(transport.session,
+        replace={other._id: replacement._id})
+    replacement.push_event(1, {'choice': 'b'})
+    events = c.wait_events(1, timeout=5)
+    assert events[other._id]['client'] == replacement._id
+
+def test_offline_events():
+    c = Connection(offline=True)
+    c.push_event(2, {'choice': 'b'})
+    c.push_event(1, {'choice': 'a'})
+    assert [e['round'] for e in c.history()] == [1, 2]
+    assert c.wait_events(1) == {}
@@ -0,0 +1,72 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import csv
+import json
+
+import pytest
+
+from psynteract import Connection, export
+
+@pytest.fixture
+def clients(transport):
+    clients = [Connection(transport=transport,
+        initial_data={'round': 3, 'answer': {'a': i}}) for i in range(5)]
+    for c in clients:
+        for round in range(5):
+            c.push_event(round, {'choice': round * 10})
+    return clients
+
+def test_rows_per_client(transport, clients):
+    rows = list(export.rows(transport, page_size=2))
+    assert sorted(row['client'] for row in rows) == \
+        sorted(c._id for c in clients)
+    assert all(row['data.round'] == 3 for row in rows)
+    assert sorted(row['data.answer.a'] for row in rows) == list(range(5))
+
+def test_events_are_paged(transport, clients):
+    pages = []
+    all_docs = transport.all_docs
+    def counting_all_docs(**params):
+        result = all_docs(**params)
+        pages.append(len(result))
+        assert len(result) <= int(params['limit'])
+        return result
+    transport.all_docs = counting_all_docs
+
+    rows = list(export.rows(transport, page_size=2, events=True))
+    assert len(rows) == 25
+    assert max(pages) == 2
+    for c in clients:
+        assert [row['data.choice'] for row in rows
+            if row['client'] == c._id] == [0, 10, 20, 30, 40]
+
+def test_export_formats(transport, clients, tmp_path):
+    path = str(tmp_path / 'results.csv')
+    export.export(None, None, path, transport=transport)
+    with open(path) as f:
+        rows = list(csv.DictReader(f))
+    assert len(rows) == 5
+    assert set(rows[0]) >= {'client', 'data.round', 'data.answer.a'}
+
+    path = str(tmp_path / 'events.ndjson')
+    export.export(None, None, path, transport=transport, events=True)
+    with open(path) as f:
+        rows = [json.loads(line) for line in f]
+    assert len(rows) == 25
+    assert {row['round'] for row in rows} == set(range(5))
+
+def test_flatten():
+    assert export.flatten({'a': {'b': 1, 'c': {'d': [2]}}, 'e': None}) == \
+        {'a.b': 1, 'a.c.d': [2], 'e': None}
@@ -0,0 +1,60 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+
+from psynteract.feed import ChangeReader
+
+def line(seq, _id, doc=None):
+    change = {'seq': seq, 'id': _id, 'changes': [{'rev': '1-a'}]}
+    if doc is not None:
+        change['doc'] = doc
+    return json.dumps(change).encode() + b'\n'
+
+def test_complete_lines():
+    reader = ChangeReader()
+    changes = reader.feed(line(1, 'a') + line(2, 'b'))
+    assert [c['id'] for c in changes] == ['a', 'b']
+    assert reader.buffer == b''
+
+def test_lines_split_across_chunks():
+    data = line(1, 'a', {'_id': 'a', 'data': {'x': 'y' * 1000}}) + line(2, 'b')
+    reader = ChangeReader()
+    changes = []
+    for i in range(0, len(data), 7):
+        changes += reader.feed(data[i:i + 7])
+    assert [c['seq'] for c in changes] == [1, 2]
+    assert changes[0]['doc']['data']['x'] == 'y' * 1000
+
+def test_partial_line_is_kept():
+    data = line(1, 'a')
+    reader = ChangeReader()
+    assert reader.feed(data[:-1]) == []
+    assert [c['id'] for c in reader.feed(data[-1:])] == ['a']
+
+def test_heartbeats_are_skipped():
+    reader = ChangeReader()
+    changes = reader.feed(b'\n\n' + line(1, 'a') + b'\n')
+    assert [c['id'] for c in changes] == ['a']
+    assert reader.heartbeats == 3
+
+def test_carriage_returns():
+    reader = ChangeReader()
+    changes = reader.feed(line(1, 'a').replace(b'\n', b'\r\n'))
+    assert changes[0]['id'] == 'a'
+
+def test_last_seq():
+    reader = ChangeReader()
+    changes = reader.feed(b'{"last_seq": 5, "pending": 0}\n')
+    assert changes[0]['last_seq'] == 5
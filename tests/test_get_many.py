@@ -0,0 +1,78 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from psynteract import Connection
+
+@pytest.fixture
+def clients(transport):
+    clients = [Connection(transport=transport,
+        initial_data={'index': i}) for i in range(4)]
+    transport.start_session(transport.session, group_size=4, seed=1)
+    return clients
+
+def counting(transport):
+    # Record the requests made, but not the lookups
+    # that MemoryTransport.get_many makes internally
+    requests = []
+    nested = []
+    get, get_many = transport.get, transport.get_many
+    def counting_get(_id):
+        if not nested:
+            requests.append(('get', _id))
+        return get(_id)
+    def counting_get_many(ids):
+        requests.append(('get_many', set(ids)))
+        nested.append(True)
+        try:
+            return get_many(ids)
+        finally:
+            nested.pop()
+    transport.get, transport.get_many = counting_get, counting_get_many
+    return requests
+
+def test_single_request(clients, transport):
+    c = clients[0]
+    partners = c.current_partners
+    requests = counting(transport)
+    docs = c.get_many(partners)
+    assert requests == [('get_many', set(partners))]
+    assert {_id: doc['data']['index'] for _id, doc in docs.items()} == \
+        {other._id: i for i, other in enumerate(clients) if other is not c}
+    assert c.current_partner_docs == docs
+
+def test_replacements_and_session(clients, transport):
+    c, replaced, replacement = clients[0], clients[1], clients[2]
+    transport.update_session(transport.session,
+        replace={replaced._id: replacement._id})
+
+    docs = c.get_many([replaced._id, replacement._id, transport.session])
+    # Both ids map onto the replacement's document
+    assert docs[replaced._id]['_id'] == replacement._id
+    assert docs[replacement._id]['_id'] == replacement._id
+    assert docs[transport.session]['type'] == 'session'
+
+    docs = c.get_many([replaced._id], check_replacements=False)
+    assert docs[replaced._id]['_id'] == replaced._id
+
+def test_missing_documents_are_left_out(clients):
+    c = clients[0]
+    docs = c.get_many([clients[1]._id, 'ghost_1'])
+    assert set(docs) == {clients[1]._id}
+
+def test_offline():
+    c = Connection(offline=True, group_size=3)
+    docs = c.get_many(c.current_partners, offline_dummy={'data': 1})
+    assert docs == {p: {'data': 1} for p in c.current_partners}
@@ -0,0 +1,100 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import pytest
+
+from psynteract import grouping
+
+def clients(n):
+    return ['client_{}'.format(i) for i in range(n)]
+
+def check_groups(groupings, ids, group_size):
+    # Every client is part of exactly one complete group per grouping
+    for g in groupings:
+        assert set(g) == set(ids)
+        for client, partners in g.items():
+            assert len(partners) == group_size - 1
+            assert client not in partners
+            for partner in partners:
+                assert set(g[partner]) | {partner} == set(partners) | {client}
+
+@pytest.mark.parametrize('design', grouping.designs)
+def test_designs_form_complete_groups(design):
+    result = grouping.assign(clients(12), design, group_size=3,
+        groupings_needed=4, roles=['a', 'b', 'c'], seed=1)
+    check_groups(result['groupings'], clients(12), 3)
+    # Roles differ within groups, and stay the same across groupings
+    roles = result['roles'][0]
+    assert all(r == roles for r in result['roles'])
+    for client, partners in result['groupings'][0].items():
+        assert sorted(roles[c] for c in [client] + partners) == \
+            ['a', 'b', 'c']
+
+def test_partner_design_keeps_groups():
+    result = grouping.assign(clients(8), 'partner', groupings_needed=3)
+    assert all(g == result['groupings'][0] for g in result['groupings'])
+
+@pytest.mark.parametrize('n, group_size, groupings_needed', [
+    (12, 2, 6),     # pool size 6, by finite fields
+    (18, 3, 2),     # pool size 6, by rotation
+    (120, 3, 30),   # pool size 40, by finite fields
+    (64, 4, 16),    # pool size 16, by finite fields
+])
+def test_perfect_stranger(n, group_size, groupings_needed):
+    start = time.time()
+    result = grouping.assign(clients(n), 'perfect_stranger', group_size,
+        groupings_needed, seed=1)
+    assert time.time() - start < 5
+    check_groups(result['groupings'], clients(n), group_size)
+    assert grouping.quality(result['groupings'])['max_encounters'] == 1
+
+def test_impossible_perfect_stranger_fails_fast():
+    # This would require two orthogonal latin squares of order 6
+    start = time.time()
+    with pytest.raises(ValueError):
+        grouping.assign(clients(18), 'perfect_stranger', 3, 6, seed=1)
+    with pytest.raises(ValueError):
+        grouping.assign(clients(18), 'perfect_stranger', 3, 7, seed=1)
+    assert time.time() - start < 5
+
+def test_ghosts():
+    with pytest.raises(ValueError):
+        grouping.assign(clients(5), group_size=2)
+    result = grouping.assign(clients(5), group_size=2, ghosts=True, seed=1)
+    check_groups(result['groupings'], clients(5) + ['ghost_1'], 2)
+
+    # More ghosts than clients per position
+    result = grouping.assign(['a'], group_size=4, ghosts=True,
+        roles=['w', 'x', 'y', 'z'])
+    assert result['roles'][0] == \
+        {'a': 'w', 'ghost_1': 'x', 'ghost_2': 'y', 'ghost_3': 'z'}
+
+def test_assignments_are_reproducible():
+    first, second = [grouping.assign(clients(10), 'stranger',
+        groupings_needed=3, seed=42) for i in range(2)]
+    assert first == second
+
+@pytest.mark.parametrize('design', grouping.designs + ('custom',))
+def test_simulate(design):
+    result = grouping.simulate('me', design, group_size=3,
+        groupings_needed=3, roles=['a', 'b'], seed=1)
+    assert len(result['groupings']) == 3
+    for g in result['groupings']:
+        assert len(g['me']) == 2
+        assert all(p.startswith('offline_') for p in g['me'])
+    assert result['roles'][0]['me'] in ('a', 'b')
+    if design == 'perfect_stranger':
+        assert grouping.quality(result['groupings'])['max_encounters'] == 1
@@ -0,0 +1,112 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import pycouchdb.exceptions
+
+from psynteract import Connection, MemoryTransport
+
+class RecordingTransport(MemoryTransport):
+    # Keep track of the update handlers called
+    merge = True
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.handlers = []
+
+    def update(self, handler, doc, _id=None):
+        self.handlers.append(handler)
+        if handler == 'merge' and not self.merge:
+            raise pycouchdb.exceptions.NotFound('missing_update_handler')
+        return MemoryTransport.update(self, handler, doc, _id)
+
+def connect(merge=True, interval=0.2):
+    transport = RecordingTransport()
+    transport.merge = merge
+    transport.open_session()
+    return transport, Connection(transport=transport,
+        heartbeat_interval=interval, initial_data={})
+
+def test_pushes_suppress_heartbeats():
+    transport, c = connect()
+    try:
+        for i in range(6):
+            c.data['round'] = i
+            c.push()
+            time.sleep(0.1)
+        assert 'merge' not in transport.handlers
+    finally:
+        c.close()
+
+def test_heartbeat_while_idle(wait_until):
+    transport, c = connect()
+    try:
+        updated = transport.get(c._id)['updated']
+        assert wait_until(lambda: 'merge' in transport.handlers)
+        doc = transport.get(c._id)
+        assert doc['updated'] >= updated
+        assert doc['_rev'] == c._rev
+        assert c._heartbeat.error is None
+    finally:
+        c.close()
+
+def test_heartbeat_without_merge_handler(wait_until):
+    transport, c = connect(merge=False)
+    try:
+        c.data['round'] = 1
+        c.push()
+        # Local changes are not sent along with the heartbeat
+        c.data['round'] = 2
+        assert wait_until(lambda:
+            transport.handlers.count('add_timestamp') >= 3)
+        doc = transport.get(c._id)
+        assert doc['data'] == {'round': 1}
+        assert doc['_rev'] == c._rev
+        assert transport.handlers.count('merge') == 1
+        assert c._heartbeat.is_alive() and c._heartbeat.error is None
+
+        c.push()
+        assert transport.get(c._id)['data'] == {'round': 2}
+    finally:
+        c.close()
+
+def test_revisions_stay_consistent():
+    # Without the merge handler, heartbeats replace the entire
+    # document, which conflicts unless they send the latest revision
+    transport, c = connect(merge=False, interval=0.005)
+    try:
+        for i in range(50):
+            c.data['round'] = i
+            c.push(force=True)
+            time.sleep(0.005 * (i % 3))
+        assert transport.handlers.count('add_timestamp') > 51
+        assert transport.get(c._id)['_rev'] == c._rev
+        assert c._heartbeat.error is None
+    finally:
+        c.close()
+
+def test_close_stops_heartbeat(wait_until):
+    transport, c = connect(interval=0.05)
+    heartbeat = c._heartbeat
+    c.close()
+    assert wait_until(lambda: not heartbeat.is_alive())
+    count = len(transport.handlers)
+    time.sleep(0.2)
+    assert len(transport.handlers) == count
+
+def test_offline_heartbeat():
+    c = Connection(offline=True, heartbeat_interval=0.05)
+    c.heartbeat()
+    assert c._heartbeat is None
@@ -0,0 +1,197 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+import requests
+
+from psynteract import Connection, MemoryTransport
+
+def push(connection, **data):
+    connection.data.update(data)
+    connection.push()
+
+@pytest.fixture
+def clients(transport, wait_until):
+    # Four clients in pairs, the first of which listens
+    clients = [Connection(transport=transport, listen=(i == 0),
+        initial_data={'round': 0}) for i in range(4)]
+    transport.start_session(transport.session, group_size=2, seed=1)
+    assert wait_until(lambda: clients[0].get_session()['status'] == 'running')
+    yield clients
+    clients[0].close()
+
+def test_mirror_follows_updates(clients, wait_until):
+    listener = clients[0]._listener
+    push(clients[1], round=3)
+    assert wait_until(lambda:
+        listener.docs[clients[1]._id]['data']['round'] == 3)
+    assert set(clients[0].get_session()['groupings'][0]) == \
+        set(c._id for c in clients)
+
+def test_wait_for_all_clients(clients, later):
+    for delay, c in enumerate(clients):
+        later(0.05 * (delay + 1), push, c, round=1)
+    clients[0].wait(lambda doc: doc['data']['round'] >= 1, timeout=5)
+    assert all(c._id in clients[0]._listener.docs for c in clients)
+    assert all(clients[0]._listener.docs[c._id]['data']['round'] == 1
+        for c in clients[1:])
+
+def test_wait_for_partners_only(clients, later):
+    waiting = clients[0]
+    partner = next(c for c in clients if c._id in waiting.current_partners)
+    others = [c for c in clients if c not in (waiting, partner)]
+
+    for c in others:
+        push(c, round=1)
+    later(0.2, push, partner, round=1)
+
+    start = time.time()
+    waiting.wait(lambda doc: doc['data']['round'] >= 1, check='partners')
+    assert time.time() - start >= 0.15
+
+def test_wait_follows_replacements(clients, transport, later):
+    waiting = clients[0]
+    partner = waiting.current_partners[0]
+    replacement = Connection(transport=transport, initial_data={'round': 0})
+
+    later(0.05, transport.update_session, transport.session,
+        replace={partner: replacement._id})
+    later(0.2, push, replacement, round=2)
+
+    start = time.time()
+    waiting.wait(lambda doc: doc['data']['round'] >= 2, check='partners')
+    assert time.time() - start >= 0.15
+    assert waiting.replacements == {partner: replacement._id}
+
+def test_updates_are_logged(clients, wait_until):
+    listener = clients[0]._listener
+    version = listener.version
+    with listener.changed:
+        assert listener.changed_since(version) == set()
+
+    # Updating a document registers it as changed
+    push(clients[1], round=5)
+    assert wait_until(lambda: listener.version > version)
+    with listener.changed:
+        assert listener.changed_since(version) == {clients[1]._id}
+
+def test_unchanged_revisions_are_skipped(clients, transport, wait_until):
+    listener = clients[0]._listener
+    metrics = clients[0].metrics
+    version = listener.version
+    processed = metrics.events_processed
+    relevant = metrics.events_relevant
+
+    # Reconnect, replaying all changes from the start
+    changes = transport.changes
+    def replaying_changes(params, timeout=None, body=None):
+        transport.changes = changes
+        return changes(dict(params, since=0), timeout, body)
+    transport.changes = replaying_changes
+    listener._feed.close()
+
+    # The session and all client documents are received
+    # again, but none of them updates the mirror
+    assert wait_until(lambda:
+        metrics.events_processed - processed == len(clients) + 1)
+    assert metrics.events_relevant == relevant
+    assert listener.version == version
+
+    # Further updates are applied as usual
+    push(clients[1], round=5)
+    assert wait_until(lambda:
+        listener.docs[clients[1]._id]['data']['round'] == 5)
+    assert listener.version == version + 1
+
+def test_close_stops_listener(clients, wait_until):
+    listener = clients[0]._listener
+    clients[0].close()
+    assert clients[0]._listener is None
+    assert wait_until(lambda: not listener.is_alive())
+
+class FailingTransport(MemoryTransport):
+    # Raise the given errors when opening the next changes feeds
+    transient_errors = (requests.exceptions.Timeout,)
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.errors = []
+
+    def changes(self, *args, **kwargs):
+        if self.errors:
+            raise self.errors.pop(0)
+        return MemoryTransport.changes(self, *args, **kwargs)
+
+def test_listener_reconnects_after_transient_errors(later):
+    transport = FailingTransport()
+    transport.open_session()
+    transport.errors = [requests.exceptions.Timeout('Lost')]
+    c, other = [Connection(transport=transport, listen=(i == 0),
+        initial_data={'round': 0}) for i in range(2)]
+    try:
+        push(c, round=1)
+        later(0.05, push, other, round=1)
+        c.wait(lambda doc: doc['data']['round'] >= 1)
+        assert c._listener.is_alive() and c._listener.error is None
+    finally:
+        c.close()
+
+def test_listener_errors_reach_waiters(wait_until):
+    transport = FailingTransport()
+    transport.open_session()
+    transport.errors = [ValueError('Unexpected')]
+    c = Connection(transport=transport, listen=True,
+        initial_data={'round': 0})
+    try:
+        with pytest.raises(ValueError):
+            c.wait(lambda doc: doc['data']['round'] >= 1)
+        assert wait_until(lambda: not c._listener.is_alive())
+    finally:
+        c.close()
+
+def test_external_replacements_are_fetched_without_lock(clients, transport,
+    wait_until):
+    waiting = clients[0]
+    listener = waiting._listener
+    partner = waiting.current_partners[0]
+
+    # The replacement stems from another session
+    other = transport.open_session()
+    replacement = Connection(transport=transport, session=other,
+        initial_data={'round': 2})
+    transport.update_session(transport.session,
+        replace={partner: replacement._id})
+    assert wait_until(lambda: listener.docs[transport.session]
+        .get('replace') == {partner: replacement._id})
+
+    # Other threads can access the mirror in the meantime
+    acquired = []
+    get_many = transport.get_many
+    def checking_get_many(ids):
+        def acquire():
+            acquired.append(listener.changed.acquire(timeout=1))
+            if acquired[-1]:
+                listener.changed.release()
+        thread = threading.Thread(target=acquire)
+        thread.start()
+        thread.join()
+        return get_many(ids)
+    transport.get_many = checking_get_many
+
+    waiting.wait(lambda doc: doc['data']['round'] >= 2, check='partners',
+        timeout=5)
+    assert acquired == [True]
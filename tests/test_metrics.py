@@ -0,0 +1,92 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import pycouchdb.exceptions
+
+from psynteract import Connection, MemoryTransport
+from psynteract.metrics import Metrics, InstrumentedTransport, BUCKETS
+
+def test_timer_records_latencies_and_errors():
+    metrics = Metrics()
+    with metrics.timer('get'):
+        pass
+    with pytest.raises(ValueError):
+        with metrics.timer('get'):
+            raise ValueError()
+
+    summary = metrics.snapshot()['operations']['get']
+    assert summary['count'] == 2
+    assert summary['errors'] == 1
+    assert 0 <= summary['min'] <= summary['max']
+    assert summary['p50'] in BUCKETS
+
+def test_counters_and_events():
+    metrics = Metrics()
+    metrics.count('not_modified')
+    metrics.count('not_modified', 2)
+    metrics.transferred(sent=10, received=20)
+    metrics.event()
+    metrics.event(relevant=False)
+
+    snapshot = metrics.snapshot(reset=True)
+    assert snapshot['counters'] == {'not_modified': 3}
+    assert (snapshot['bytes_sent'], snapshot['bytes_received']) == (10, 20)
+    assert (snapshot['events_processed'], snapshot['events_relevant']) \
+        == (2, 1)
+
+    # Resetting starts anew
+    snapshot = metrics.snapshot()
+    assert snapshot['operations'] == {} and snapshot['counters'] == {}
+    assert snapshot['events_processed'] == 0
+
+def test_subscriptions():
+    metrics = Metrics()
+    calls = []
+    hook = metrics.subscribe(lambda *args: calls.append(args))
+    metrics.record('info', 0.5)
+    metrics.unsubscribe(hook)
+    metrics.record('info', 0.5)
+    assert calls == [('info', 0.5, None)]
+
+def test_instrumented_transport():
+    metrics = Metrics()
+    transport = InstrumentedTransport(MemoryTransport(), metrics)
+    session = transport.open_session()
+    doc = transport.get(session)
+    assert transport.get_if_modified(session, doc['_rev']) is None
+    with pytest.raises(pycouchdb.exceptions.NotFound):
+        transport.get('missing')
+
+    snapshot = metrics.snapshot()
+    assert snapshot['operations']['get']['count'] == 2
+    assert snapshot['operations']['get']['errors'] == 1
+    assert snapshot['operations']['get_if_modified']['count'] == 1
+    assert snapshot['counters'] == {'not_modified': 1}
+    # Other attributes are passed on without being timed
+    assert 'open_session' not in snapshot['operations']
+
+def test_connection_operations_are_recorded():
+    transport = MemoryTransport()
+    transport.open_session()
+    metrics = Metrics()
+    c, other = [Connection(transport=transport, metrics=metrics,
+        initial_data={'round': 0}) for i in range(2)]
+    c.push()
+    c.wait(lambda doc: doc['data']['round'] == 0, timeout=5)
+
+    operations = metrics.snapshot()['operations']
+    assert 'query psynteract/open_sessions' in operations
+    assert 'update add_timestamp' in operations
+    assert operations['wait clients']['count'] == 1
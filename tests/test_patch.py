@@ -0,0 +1,86 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+
+import pycouchdb.exceptions
+import pytest
+
+from psynteract import Connection, MemoryTransport
+from psynteract.patch import merge_patch, apply_merge_patch
+
+@pytest.mark.parametrize('old, new', [
+    ({}, {'a': 1}),
+    ({'a': 1, 'b': 2}, {'a': 1}),
+    ({'a': {'b': 1, 'c': 2}}, {'a': {'b': 1, 'c': 3, 'd': [1]}}),
+    ({'a': {'b': 1}}, {'a': [1, 2]}),
+    ({'a': 1}, {'a': {'b': {'c': 1}}}),
+])
+def test_patches_transform_documents(old, new):
+    patch = merge_patch(old, new)
+    assert apply_merge_patch(copy.deepcopy(old), patch) == new
+
+def test_patches_are_minimal():
+    old = {'data': {'round': 1, 'choices': [1, 2]}, 'status': 'x'}
+    new = {'data': {'round': 2, 'choices': [1, 2]}, 'status': 'x'}
+    assert merge_patch(old, new) == {'data': {'round': 2}}
+    assert merge_patch(new, new) == {}
+
+def test_none_values_cannot_be_patched():
+    with pytest.raises(ValueError):
+        merge_patch({'a': 1}, {'a': None})
+
+def test_nulls_are_removed_from_new_objects():
+    # Nested patches are merged into an empty object (RFC 7386)
+    doc = {'a': 1, 'b': 'text'}
+    apply_merge_patch(doc, {'a': {'c': None, 'd': 1}, 'e': {'f': None}})
+    assert doc == {'a': {'d': 1}, 'b': 'text', 'e': {}}
+
+class RecordingTransport(MemoryTransport):
+    # Keep track of the updates, optionally without a merge handler
+    merge = True
+
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.updates = []
+
+    def update(self, handler, doc, _id=None):
+        self.updates.append((handler, copy.deepcopy(doc)))
+        if handler == 'merge' and not self.merge:
+            raise pycouchdb.exceptions.NotFound('missing_update_handler')
+        return MemoryTransport.update(self, handler, doc, _id)
+
+@pytest.mark.parametrize('merge', [True, False])
+def test_delta_push(merge):
+    transport = RecordingTransport()
+    transport.merge = merge
+    transport.open_session()
+    c = Connection(transport=transport, delta_push=True,
+        initial_data={'round': 0, 'choices': []})
+
+    for i in range(1, 3):
+        c.data['round'] = i
+        c.push()
+        stored = transport.get(c._id)
+        assert stored['data'] == {'round': i, 'choices': []}
+        assert stored['_rev'] == c._rev
+
+    handlers = [handler for handler, doc in transport.updates]
+    if merge:
+        assert handlers == ['add_timestamp', 'merge', 'merge']
+        assert transport.updates[-1][1] == {'data': {'round': 2}}
+    else:
+        # The missing handler is tried only once
+        assert handlers == ['add_timestamp', 'merge',
+            'add_timestamp', 'add_timestamp']
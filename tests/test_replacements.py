@@ -0,0 +1,48 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from psynteract import ReplacementIndex
+
+def test_chains_are_resolved():
+    index = ReplacementIndex({'a': 'b', 'b': 'c'})
+    assert index['a'] == 'c' and index['b'] == 'c'
+    assert 'c' not in index
+    assert index.replaced_by('c') == {'a', 'b'}
+
+def test_shared_replacement():
+    index = ReplacementIndex({'a': 'x', 'b': 'x'})
+    assert index.replaced_by('x') == {'a', 'b'}
+    assert index.replaced_by('a') == ()
+
+def test_update_returns_modified_clients():
+    index = ReplacementIndex({'a': 'b'})
+    assert index.update({'a': 'b'}) == set()
+    # Extending the chain affects all clients along it
+    assert index.update({'a': 'b', 'b': 'c'}) == {'a', 'b'}
+    assert index['a'] == 'c'
+    # Unrelated additions leave the others alone
+    assert index.update({'a': 'b', 'b': 'c', 'd': 'e'}) == {'d'}
+
+def test_removal():
+    index = ReplacementIndex({'a': 'b', 'b': 'c'})
+    assert index.update({'a': 'b'}) == {'a', 'b'}
+    assert index['a'] == 'b' and 'b' not in index
+    assert index.replaced_by('c') == ()
+    assert index.replaced_by('b') == {'a'}
+
+def test_circular_replacements():
+    with pytest.raises(RuntimeError):
+        ReplacementIndex({'a': 'b', 'b': 'a'})
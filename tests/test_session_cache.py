@@ -0,0 +1,92 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+
+from psynteract import Connection, MemoryTransport
+
+class CountingTransport(MemoryTransport):
+    # Keep track of the requests concerning the session
+    def __init__(self):
+        MemoryTransport.__init__(self)
+        self.requests = []
+
+    def get(self, _id):
+        self.requests.append(('get', _id))
+        return MemoryTransport.get(self, _id)
+
+    def rev(self, _id):
+        # (without recording the underlying lookup)
+        self.requests.append(('rev', _id))
+        return MemoryTransport.get(self, _id)['_rev']
+
+    def changes(self, params, timeout=None, body=None):
+        if body and body.get('doc_ids') == [self.session]:
+            self.requests.append(('changes', self.session))
+        return MemoryTransport.changes(self, params, timeout, body)
+
+def session_requests(transport):
+    return [r for r in transport.requests if r[1] == transport.session]
+
+@pytest.fixture
+def pair():
+    transport = CountingTransport()
+    transport.session = transport.open_session()
+    return transport, [Connection(transport=transport,
+        initial_data={'round': 0}) for i in range(2)]
+
+def lookups(c):
+    # The lookups an experiment typically performs during a trial
+    c.current_partners
+    c.current_role
+    c.current_partner_roles
+    c.replacements
+    c.get(c.current_partners[0])
+
+@pytest.mark.parametrize('strategy', ['rev', 'feed'])
+def test_session_checked_once_per_trial(pair, strategy):
+    transport, (a, b) = pair
+    a.session_cache = strategy
+    transport.start_session(transport.session, group_size=2, seed=1)
+
+    lookups(a)
+    for trial in range(3):
+        del transport.requests[:]
+        b.data['round'] = a.data['round'] = trial + 1
+        b.push()
+        a.push()
+        a.wait(lambda doc: doc['data']['round'] > trial, check='partners')
+        lookups(a)
+        lookups(a)
+        # Outside of the wait, the session is brought up to date once
+        assert session_requests(transport) == \
+            [('rev' if strategy == 'rev' else 'changes', transport.session)]
+
+@pytest.mark.parametrize('strategy', ['rev', 'feed'])
+def test_session_changes_between_waits(pair, strategy):
+    transport, (a, b) = pair
+    a.session_cache = strategy
+    transport.start_session(transport.session, group_size=2, seed=1)
+    assert a.current_partners == [b._id]
+    a.wait(lambda doc: True, check='partners', timeout=1)
+
+    # The session changes while the client is not waiting,
+    # and is brought up to date in the next trial
+    replacement = Connection(transport=transport, initial_data={'round': 0})
+    transport.update_session(transport.session,
+        replace={b._id: replacement._id})
+    a.push()
+
+    assert a.replacements == {b._id: replacement._id}
+    assert a.get_session()['_rev'] == transport.get(transport.session)['_rev']
@@ -0,0 +1,107 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+
+import pytest
+import requests
+
+from psynteract import Connection, MemoryTransport
+
+def test_lazy_startup_completes_in_background(transport):
+    c = Connection(transport=transport, lazy=True, initial_data={'a': 1})
+    assert c.ready(5)
+    assert c.session == transport.session
+    assert transport.get(c._id)['data'] == {'a': 1}
+
+def test_operations_wait_for_startup(transport):
+    c = Connection(transport=transport, lazy=True, startup_jitter=0.2,
+        initial_data={})
+    c.data['a'] = 2
+    c.push()
+    assert transport.get(c._id)['data'] == {'a': 2}
+
+def test_startup_retries_until_session_opens(later):
+    transport = MemoryTransport()
+    c = Connection(transport=transport, lazy=True,
+        startup_retries=8, startup_backoff=0.02)
+    later(0.05, transport.open_session)
+    assert c.ready(10)
+    assert c.session is not None
+
+def test_startup_errors_are_raised():
+    # No session is ever opened
+    c = Connection(transport=MemoryTransport(), lazy=True)
+    with pytest.raises(KeyError):
+        c.ready(5)
+    with pytest.raises(KeyError):
+        c.push()
+
+def test_cached_session_discovery(transport):
+    queries = []
+    query = transport.query
+    def counting_query(name, **params):
+        queries.append(name)
+        return query(name, **params)
+    transport.query = counting_query
+
+    clients = [Connection(transport=transport, lazy=True,
+        cache_session=True) for i in range(5)]
+    assert all(c.ready(5) for c in clients)
+    assert queries.count('psynteract/open_sessions') == 1
+
+    # Closed sessions are discovered anew
+    transport.update_session(transport.session, status='closed')
+    session = transport.open_session()
+    c = Connection(transport=transport, cache_session=True)
+    assert c.session == session
+    assert queries.count('psynteract/open_sessions') == 2
+    assert Connection(transport=transport, cache_session=True).session \
+        == session
+
+class LossyTransport(MemoryTransport):
+    # Store the first updates, but lose the responses
+    transient_errors = (requests.exceptions.Timeout,)
+    lost = 2
+
+    def update(self, handler, doc, _id=None):
+        result = MemoryTransport.update(self, handler, doc, _id)
+        if self.lost:
+            self.lost -= 1
+            raise requests.exceptions.Timeout('Response lost')
+        return result
+
+def test_startup_retries_are_idempotent():
+    transport = LossyTransport()
+    session = transport.open_session()
+    c = Connection(transport=transport, lazy=True,
+        startup_retries=3, startup_backoff=0.01)
+    assert c.ready(5)
+    clients = transport.query('psynteract/session_clients', key=session)
+    assert [row['id'] for row in clients] == [c._id]
+
+class SlowTransport(MemoryTransport):
+    def update(self, handler, doc, _id=None):
+        time.sleep(0.2)
+        return MemoryTransport.update(self, handler, doc, _id)
+
+def test_changes_during_lazy_startup_are_pushed():
+    transport = SlowTransport()
+    transport.open_session()
+    c = Connection(transport=transport, lazy=True, initial_data={})
+    # Modify the data while the first push is underway
+    time.sleep(0.05)
+    c.data['condition'] = 'treatment'
+    c.push()
+    assert transport.get(c._id)['data'] == {'condition': 'treatment'}
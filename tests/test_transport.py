@@ -0,0 +1,48 @@
+# Copyright 2015- Felix Henninger
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pycouchdb.exceptions
+import pytest
+
+from psynteract import MemoryTransport
+
+def test_update_creates_and_replaces():
+    transport = MemoryTransport()
+    _id, rev = transport.update('add_timestamp', {'a': 1}, 'doc')
+    assert _id == 'doc' and rev.startswith('1-')
+    _id, rev = transport.update('add_timestamp', {'a': 2, '_rev': rev}, 'doc')
+    doc = transport.get('doc')
+    assert doc['a'] == 2 and doc['_rev'] == rev and 'updated' in doc
+
+def test_update_rejects_stale_revisions():
+    transport = MemoryTransport()
+    _id, rev = transport.update('add_timestamp', {'a': 1}, 'doc')
+    transport.update('add_timestamp', {'a': 2, '_rev': rev}, 'doc')
+    with pytest.raises(pycouchdb.exceptions.Conflict):
+        transport.update('add_timestamp', {'a': 3, '_rev': rev}, 'doc')
+    with pytest.raises(pycouchdb.exceptions.Conflict):
+        transport.update('add_timestamp', {'a': 3}, 'doc')
+    assert transport.get('doc')['a'] == 2
+
+def test_merge_applies_to_latest_revision():
+    transport = MemoryTransport()
+    transport.update('add_timestamp', {'a': 1, 'b': 1}, 'doc')
+    _id, rev = transport.update('merge', {'b': None, 'c': 3}, 'doc')
+    doc = transport.get('doc')
+    assert doc['a'] == 1 and 'b' not in doc and doc['c'] == 3
+    assert doc['_rev'] == rev
+
+def test_unknown_handler():
+    with pytest.raises(pycouchdb.exceptions.NotFound):
+        MemoryTransport().update('missing', {}, 'doc')